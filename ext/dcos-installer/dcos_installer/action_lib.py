@@ -5,6 +5,8 @@ import os
 
 import pkgpanda
 import ssh.utils
+from pkgpanda.package_cache import get_package_cache
+from pkgpanda.util import link_or_copy
 from ssh.ssh_runner import Node
 
 REMOTE_TEMP_DIR = '/opt/dcos_install_tmp'
@@ -127,10 +129,18 @@ def _add_copy_packages(chain, local_pkg_base_path='genconf/serve'):
         raise ExecuteException(err_msg)
 
     cluster_packages = pkgpanda.load_json(CLUSTER_PACKAGES_FILE)
+    package_cache = get_package_cache()
     for package, params in cluster_packages.items():
         destination_package_dir = os.path.join(REMOTE_TEMP_DIR, 'packages', package)
         local_pkg_path = os.path.join(local_pkg_base_path, params['filename'])
 
+        # Fill in packages missing from the serve directory from the local package cache.
+        if package_cache is not None and not os.path.isfile(local_pkg_path):
+            cached = package_cache.get(params['id'])
+            if cached is not None:
+                os.makedirs(os.path.dirname(local_pkg_path), exist_ok=True)
+                link_or_copy(cached, local_pkg_path)
+
         chain.add_execute(['mkdir', '-p', destination_package_dir], stage='Creating package directory')
         chain.add_copy(local_pkg_path, destination_package_dir,
                        stage='Copying packages')
@@ -11,24 +11,36 @@ environment variables from the package.
 """
 import grp
 import json
+import logging
 import os
 import os.path
 import pwd
 import re
 import shutil
-import tempfile
+import stat
+import threading
+import time
+from functools import partial
 from itertools import chain
 from subprocess import CalledProcessError, check_call, check_output
 
-from pkgpanda.constants import (DCOS_SERVICE_CONFIGURATION_FILE,
-                                RESERVED_UNIT_NAMES)
-from pkgpanda.exceptions import (InstallError, PackageError, PackageNotFound,
-                                 ValidationError)
-from pkgpanda.util import (download, extract_tarball, if_exists, load_json, write_json, write_string)
+from pkgpanda.constants import (ACTIVE_HISTORY_SIZE, CHOWN_JOBS,
+                                DCOS_SERVICE_CONFIGURATION_FILE,
+                                PACKAGE_DIGESTS_FILE, PACKAGE_MANIFEST_FILE,
+                                RESERVED_UNIT_NAMES, SYSTEMD_JOBS)
+from pkgpanda.delta import apply_delta, delta_filename
+from pkgpanda.exceptions import (FetchError, InstallError, PackageError,
+                                 PackageNotFound, ValidationError)
+from pkgpanda.mirrors import get_mirrors
+from pkgpanda.util import (chown_tree, download_extract, if_exists,
+                           load_json, run_concurrently, sha1, write_json,
+                           write_string)
 
 # TODO(cmaloney): Can we switch to something like a PKGBUILD from ArchLinux and
 # then just do the mutli-version stuff ourself and save a lot of re-implementation?
 
+log = logging.getLogger(__name__)
+
 reserved_env_vars = ["LD_LIBRARY_PATH", "PATH"]
 
 env_header = """# Pkgpanda provided environment variables
@@ -53,26 +65,62 @@ class Systemd:
         self.__active = active
         self.__block = block
 
-    def stop_all(self):
-        if not self.__active:
-            return
+    def unit_names(self):
         if not os.path.exists(self.__unit_directory):
-            return
-        for name in os.listdir(self.__unit_directory):
-            # Skip directories
-            if os.path.isdir(os.path.join(self.__unit_directory, name)):
-                continue
-            try:
-                cmd = ["systemctl", "stop", name]
-                if not self.__block:
-                    cmd.append("--no-block")
-                check_call(cmd)
-            except CalledProcessError as ex:
-                # If the service doesn't exist, don't error. This happens when a
-                # bootstrap tarball has just been extracted but nothing started
-                # yet during first activation.
-                if ex.returncode != 5:
-                    raise
+            return []
+        # Skip directories
+        return sorted(name for name in os.listdir(self.__unit_directory)
+                      if not os.path.isdir(os.path.join(self.__unit_directory, name)))
+
+    def stop(self, name):
+        try:
+            cmd = ["systemctl", "stop", name]
+            if not self.__block:
+                cmd.append("--no-block")
+            check_call(cmd)
+        except CalledProcessError as ex:
+            # If the service doesn't exist, don't error. This happens when a
+            # bootstrap tarball has just been extracted but nothing started
+            # yet during first activation.
+            if ex.returncode != 5:
+                raise
+
+    def stop_all(self, jobs=SYSTEMD_JOBS):
+        """Stop all the units, `jobs` at a time.
+
+        Returns a dictionary of unit name to the seconds it took to stop."""
+        if not self.__active:
+            return {}
+
+        latencies = dict()
+        for name, _, seconds in run_concurrently(self.stop, self.unit_names(), jobs):
+            log.info("Stopped %s in %.2fs", name, seconds)
+            latencies[name] = seconds
+        return latencies
+
+    def start_latencies(self):
+        """Return a dictionary of unit name to the seconds it took systemd to start it.
+
+        Uses the timestamps systemd keeps for every unit, read with a single
+        systemctl call. Units which haven't finished starting are left out."""
+        names = self.unit_names()
+        if not self.__active or not names:
+            return {}
+
+        output = check_output([
+            "systemctl", "show",
+            "--property=Id,InactiveExitTimestampMonotonic,ActiveEnterTimestampMonotonic"] + names)
+
+        latencies = dict()
+        # `systemctl show` prints a block of key=value lines per unit, in the
+        # order they were given.
+        for name, block in zip(names, output.decode().strip().split("\n\n")):
+            props = dict(line.split("=", 1) for line in block.splitlines() if "=" in line)
+            start = int(props.get("InactiveExitTimestampMonotonic") or 0)
+            end = int(props.get("ActiveEnterTimestampMonotonic") or 0)
+            if start and end >= start:
+                latencies[name] = (end - start) / 1e6
+        return latencies
 
     @property
     def unit_directory(self):
@@ -134,6 +182,7 @@ class Package:
         self.__id = id
         self.__path = path
         self.__pkginfo = pkginfo
+        self.__manifest = None
 
     @property
     def environment(self):
@@ -183,6 +232,13 @@ class Package:
     def group(self):
         return self.__pkginfo.get('group', None)
 
+    @property
+    def manifest(self):
+        """The directories, files and services in the package. See make_manifest."""
+        if self.__manifest is None:
+            self.__manifest = load_manifest(self.__path)
+        return self.__manifest
+
     def __repr__(self):
         return str(self.__id)
 
@@ -212,7 +268,51 @@ def expand_require(require):
 
 
 # Check that a set of packages is reasonable.
-def validate_compatible(packages, roles):
+def find_conflicting_files(packages, roles, dir_names):
+    """Find the files more than one package would put into the well known dirs dir_names.
+
+    Package directories `<dir>` and `<dir>_<role>` are both merged into `<dir>`,
+    so they are checked against each other too. Uses the package manifests
+    rather than the filesystem.
+
+    Returns a sorted list of (path, sources) where path is relative to the
+    install root and sources are the package files which would be put there.
+    """
+    dirs = dict()
+    files = dict()
+    for package in packages:
+        trees = package.manifest['trees']
+        for dir_name in dir_names:
+            for name in [dir_name] + ["{0}_{1}".format(dir_name, role) for role in roles]:
+                tree = trees.get(name)
+                if tree is None:
+                    continue
+                src = os.path.join(package.path, name)
+                for rel_path in tree['dirs']:
+                    dirs.setdefault(os.path.join(dir_name, rel_path), os.path.join(src, rel_path))
+                for rel_path in tree['files']:
+                    files.setdefault(os.path.join(dir_name, rel_path), []).append(os.path.join(src, rel_path))
+
+    conflicts = []
+    for path, sources in files.items():
+        # A file can't share its path with a directory either.
+        if path in dirs:
+            sources = sources + [dirs[path]]
+        if len(sources) > 1:
+            conflicts.append((path, sorted(sources)))
+    return sorted(conflicts)
+
+
+def _no_progress(stage):
+    pass
+
+
+def validate_compatible(packages, roles, dir_names=None):
+    """Check that packages can be activated together on a host with roles.
+
+    If dir_names, the well known dirs packages get symlinked into, is given,
+    the packages also must not have any conflicting files.
+    """
     # Every package name appears only once.
     names = set()
     ids = set()
@@ -280,35 +380,121 @@ def validate_compatible(packages, roles):
 
                 sysctl_map[sysctl_var] = sysctl_value
 
+    # No file is provided by more than one package, nor more than one role of a package.
+    if dir_names is not None:
+        conflicts = find_conflicting_files(packages, roles, dir_names)
+        if conflicts:
+            raise ValidationError(
+                "Multiple packages or roles {0} are trying to install the same files:\n{1}".format(
+                    roles,
+                    "\n".join("{0}: {1}".format(path, ", ".join(sources)) for path, sources in conflicts)))
+
     # TODO(cmaloney): More complete validation
-    #  - There are no repeated file/folder in the well_known_dirs
-    #       - Including the roles subfolders.
     #  - There is a base set of required package names (pkgpanda, mesos, config)
     #  - The config is for this specific type of host (master, slave)?
 
 
 # TODO(cmaloney): Add a github fetcher, useful for grabbing config tarballs.
-def requests_fetcher(base_url, id_str, target, work_dir):
+def requests_fetcher(base_url, id_str, target, work_dir, sha1=None, cache=None, peers=None, base=None):
+    """Stream the package id_str from the repository at base_url into target.
+
+    base_url may be several mirrors of the repository (see
+    pkgpanda.mirrors.get_mirrors), in which case the package is fetched from
+    the best one, failing over to the others if it errors.
+
+    If sha1 is given the package tarball must match it. If cache (a
+    pkgpanda.package_cache.PackageCache) is given, a cached tarball is used
+    instead of downloading when there is one, and downloaded tarballs are added
+    to it.
+
+    peers are other nodes' pkgpanda HTTP APIs, which serve the tarballs in
+    their package cache. They are tried before the repository, but only when
+    sha1 is given since their tarballs can't otherwise be trusted.
+
+    base is an optional (package id, path) of another version of the package
+    which is already extracted. If the repository has a delta from it (see
+    pkgpanda.delta), the package is made from base and the delta rather than
+    downloading the whole tarball. Deltas are only used when sha1 isn't given,
+    since they can't be checked against it.
+
+    Returns the sha1 of the package tarball, None if it was made from a delta."""
     assert base_url
     assert type(id_str) == str
     id = PackageId(id_str)
     # TODO(cmaloney): That file:// urls are allowed in base_url is likely a security hole.
     # TODO(cmaloney): Switch to mesos-fetcher or aci or something so
     # all the logic can go away, we gain integrity checking, etc.
-    base_url = base_url.rstrip('/')
-    url = base_url + "/packages/{0}/{1}.tar.xz".format(id.name, id_str)
-    # TODO(cmaloney): Use a private tmp directory so there is no chance of a user
-    # intercepting the tarball + other validation data locally.
-    with tempfile.NamedTemporaryFile(suffix=".tar.xz") as file:
-        download(file.name, url, work_dir)
-        extract_tarball(file.name, target)
+    mirrors = get_mirrors(base_url)
+    path = "/packages/{0}/{1}.tar.xz".format(id.name, id_str)
+
+    if cache is not None:
+        cached = cache.get(id_str, sha1)
+        if cached is not None:
+            try:
+                return download_extract('file://' + cached, target, work_dir, cache.entry_sha1(cached))
+            except FetchError as ex:
+                # A corrupt cache entry shouldn't stop us from fetching the package.
+                print("Ignoring bad cached package {}: {}".format(cached, ex))
+                if_exists(os.remove, cached)
+
+    def fetch(mirror_url, tee, **kwargs):
+        if cache is not None:
+            return download_extract(
+                mirror_url + path, target, work_dir, sha1, lambda chunks: cache.tee(id_str, tee(chunks), sha1),
+                **kwargs)
+        return download_extract(mirror_url + path, target, work_dir, sha1, tee, **kwargs)
+
+    if base is not None and sha1 is None:
+        base_id, base_path = base
+        delta_path = "/packages/{0}/{1}".format(id.name, delta_filename(base_id, id_str))
+        delta_dir = target + '.delta'
+
+        def fetch_delta(mirror_url, tee):
+            return download_extract(mirror_url + delta_path, delta_dir, work_dir, tee=tee)
+
+        try:
+            mirrors.fetch(fetch_delta)
+            apply_delta(delta_dir, base_id, base_path, target)
+            return None
+        except FetchError:
+            # No mirror has a delta from base, fetch the whole package.
+            pass
+        except Exception as ex:
+            print("Unable to apply the delta from {} to {}: {}".format(base_id, id_str, ex))
+            shutil.rmtree(target, ignore_errors=True)
+        finally:
+            shutil.rmtree(delta_dir, ignore_errors=True)
+
+    if peers is not None and sha1 is not None:
+        try:
+            # Peers aren't retried, it's quicker to move on to the next one.
+            return get_mirrors(peers).fetch(partial(fetch, retries=0))
+        except FetchError:
+            # No peer has the package (yet).
+            pass
+
+    return mirrors.fetch(fetch)
 
 
 class Repository:
+    """A folder of extracted packages, one subfolder per package id.
+
+    The package ids are indexed in memory (ids, parsed ids, ids by name). The
+    index is updated by add() and remove(), and rebuilt from a single scan of
+    the folder whenever the folder's mtime changes, so a long lived Repository
+    (like the one of pkgpanda.http) also sees packages added by other processes.
+    add() and remove() take the folder's new mtime as their own, so a change
+    another process makes at the same time is only seen with the next one.
+    """
 
     def __init__(self, path):
         self.__path = os.path.abspath(path)
+        self.__lock = threading.RLock()
+        # Package id string -> PackageId, None if the id doesn't parse.
         self.__packages = None
+        # Package name -> set of package id strings.
+        self.__ids_by_name = None
+        self.__mtime = None
 
     @property
     def path(self):
@@ -317,29 +503,74 @@ class Repository:
     def package_path(self, id):
         return os.path.join(self.__path, id)
 
+    def refresh(self):
+        """Rebuild the index from the repository folder."""
+        with self.__lock:
+            try:
+                mtime = os.stat(self.__path).st_mtime_ns
+                names = os.listdir(self.__path)
+            except FileNotFoundError:
+                mtime = None
+                names = []
+
+            packages = dict()
+            ids_by_name = dict()
+            for id in names:
+                if PackageId.is_id(id):
+                    self.__index_add(packages, ids_by_name, id)
+
+            self.__packages = packages
+            self.__ids_by_name = ids_by_name
+            self.__mtime = mtime
+
+    @staticmethod
+    def __index_add(packages, ids_by_name, id):
+        try:
+            pkg_id = PackageId(id)
+        except ValidationError:
+            pkg_id = None
+        packages[id] = pkg_id
+        if pkg_id is not None:
+            ids_by_name.setdefault(pkg_id.name, set()).add(id)
+
+    def __index_remove(self, id):
+        pkg_id = self.__packages.pop(id, None)
+        if pkg_id is not None:
+            self.__ids_by_name[pkg_id.name].discard(id)
+            if not self.__ids_by_name[pkg_id.name]:
+                del self.__ids_by_name[pkg_id.name]
+
+    def __index(self):
+        """Return the index, rebuilding it first if the folder changed since it was built."""
+        with self.__lock:
+            if self.__packages is None or self.__dir_mtime() != self.__mtime:
+                self.refresh()
+            return self.__packages, self.__ids_by_name
+
+    def __dir_mtime(self):
+        dir_stat = if_exists(os.stat, self.__path)
+        return dir_stat.st_mtime_ns if dir_stat else None
+
     def get_ids(self, name):
-        # TODO(cmaloney): There is a lot of excess re-parsing here...
-        return list(pkg_id for pkg_id in self.list() if PackageId(pkg_id).name == name)
+        return sorted(self.__index()[1].get(name, set()))
+
+    def get_package_id(self, id):
+        """Return the parsed PackageId of id, which must be in the repository."""
+        pkg_id = self.__index()[0].get(id)
+        if pkg_id is None:
+            # Not in the repository, or not a valid id. Let PackageId raise for the latter.
+            PackageId(id)
+            raise PackageNotFound(id)
+        return pkg_id
 
     def has_package(self, id):
-        return id in self.list()
+        return id in self.__index()[0]
 
     def list(self):
         """List the available packages in the repository.
 
         A package is a folder which contains a pkginfo.json"""
-        if self.__packages is not None:
-            return self.__packages
-
-        packages = set()
-        if not os.path.exists(self.__path):
-            return packages
-
-        for id in os.listdir(self.__path):
-            if PackageId.is_id(id):
-                packages.add(id)
-        self.__packages = packages
-        return self.__packages
+        return set(self.__index()[0])
 
     # Load the given package
     def load(self, id):
@@ -368,10 +599,40 @@ class Repository:
             packages.add(self.load(id))
         return packages
 
-    def integrity_check(self):
-        # Check that all packages in the local repository have valid
-        # signatures, are up to date, all packages valid contents, etc.
-        raise NotImplementedError()
+    def integrity_check(self, ids=None, full=False, jobs=None):
+        """Check packages against the digests recorded when they were added.
+
+        ids are the packages to check, all of them by default. Unless full, only
+        the size and mtime of files are compared, otherwise their contents are
+        hashed. Packages are checked `jobs` at a time, one per CPU by default.
+
+        Returns a dictionary of package id to the list of problems found. Packages
+        added without digests map to None.
+        """
+        if ids is None:
+            ids = self.list()
+        for id in ids:
+            if not self.has_package(id):
+                raise PackageNotFound(id)
+
+        def check(id):
+            path = self.package_path(id)
+            digests = if_exists(load_json, os.path.join(path, PACKAGE_DIGESTS_FILE))
+            if digests is None:
+                return None
+            return check_digests(path, digests, full)
+
+        return {id: problems for id, problems, _ in run_concurrently(check, ids, jobs or os.cpu_count() or 1)}
+
+    def added_time(self, id):
+        """Return the time id was added to the repository.
+
+        Packages added before the time was recorded fall back to the mtime of
+        their folder."""
+        digests = if_exists(load_json, os.path.join(self.package_path(id), PACKAGE_DIGESTS_FILE))
+        if digests is not None and 'added' in digests:
+            return digests['added']
+        return os.stat(self.package_path(id)).st_mtime
 
     # Add the given package to the repository.
     # If the package is already in the repository does a no-op and returns false.
@@ -403,14 +664,35 @@ class Repository:
         check_call(['rm', '-rf', tmp_path])
 
         fetcher(id, tmp_path)
-        os.rename(tmp_path, pkg_path)
+        # Packages built by mkpanda come with a manifest, generate one for anything else.
+        if not os.path.exists(os.path.join(tmp_path, PACKAGE_MANIFEST_FILE)):
+            write_manifest(tmp_path)
+        # Record what was extracted so integrity_check can find changes later,
+        # and when, for added_time.
+        digests = make_digests(tmp_path)
+        digests['added'] = time.time()
+        write_json(os.path.join(tmp_path, PACKAGE_DIGESTS_FILE), digests)
+        with self.__lock:
+            os.rename(tmp_path, pkg_path)
+            if self.__packages is not None:
+                # A rescan while the package was being fetched may have found
+                # the temporary folder.
+                self.__index_remove(os.path.basename(tmp_path))
+                self.__index_add(self.__packages, self.__ids_by_name, id)
+                # The rename changed the folder's mtime, which would otherwise
+                # make the next lookup rescan it.
+                self.__mtime = self.__dir_mtime()
         return True
 
     def remove(self, id):
         path = self.package_path(id)
         if not os.path.exists(path):
             raise PackageNotFound(id)
-        shutil.rmtree(path)
+        with self.__lock:
+            shutil.rmtree(path)
+            if self.__packages is not None:
+                self.__index_remove(id)
+                self.__mtime = self.__dir_mtime()
 
 
 class ConflictingFile(ValidationError):
@@ -421,35 +703,166 @@ class ConflictingFile(ValidationError):
         self.ex = ex
 
 
+def make_manifest(path):
+    """Return the manifest of the package at path.
+
+    The manifest lists, for every top level directory of the package, the
+    directories and the files (including symlinks) inside it, as well as all
+    the systemd services in the package. Activation uses it to avoid walking
+    the package contents again.
+    """
+    trees = dict()
+    services = []
+    for name in os.listdir(path):
+        tree_path = os.path.join(path, name)
+        if not os.path.isdir(tree_path):
+            if name.endswith('.service'):
+                services.append(name)
+            continue
+
+        dirs = []
+        files = []
+        for root, dirnames, filenames in os.walk(tree_path):
+            rel_root = os.path.relpath(root, tree_path)
+            for dirname in dirnames:
+                rel_path = os.path.normpath(os.path.join(rel_root, dirname))
+                # Symlinks to directories are linked rather than merged.
+                if os.path.islink(os.path.join(root, dirname)):
+                    files.append(rel_path)
+                else:
+                    dirs.append(rel_path)
+            for filename in filenames:
+                rel_path = os.path.normpath(os.path.join(rel_root, filename))
+                files.append(rel_path)
+                if filename.endswith('.service'):
+                    services.append(os.path.join(name, rel_path))
+        trees[name] = {'dirs': sorted(dirs), 'files': sorted(files)}
+
+    return {'trees': trees, 'services': sorted(services)}
+
+
+def write_manifest(path):
+    write_json(os.path.join(path, PACKAGE_MANIFEST_FILE), make_manifest(path))
+
+
+def load_manifest(path):
+    """Load the manifest of the package at path, making one if the package doesn't have one."""
+    manifest = if_exists(load_json, os.path.join(path, PACKAGE_MANIFEST_FILE))
+    if manifest is None:
+        manifest = make_manifest(path)
+    return manifest
+
+
+def make_digests(path, jobs=None):
+    """Return the size, mtime and sha1 of every file and the target of every symlink in the package at path.
+
+    Files are hashed `jobs` at a time, one per CPU by default."""
+    files = []
+    symlinks = dict()
+    for root, dirnames, filenames in os.walk(path):
+        for name in chain(dirnames, filenames):
+            full_path = os.path.join(root, name)
+            rel_path = os.path.relpath(full_path, path)
+            if rel_path == PACKAGE_DIGESTS_FILE:
+                continue
+            if os.path.islink(full_path):
+                symlinks[rel_path] = os.readlink(full_path)
+            elif os.path.isfile(full_path):
+                files.append(rel_path)
+
+    def digest(rel_path):
+        full_path = os.path.join(path, rel_path)
+        file_stat = os.stat(full_path)
+        return [file_stat.st_size, file_stat.st_mtime_ns, sha1(full_path)]
+
+    return {
+        'files': {rel_path: file_digest for rel_path, file_digest, _ in
+                  run_concurrently(digest, files, jobs or os.cpu_count() or 1)},
+        'symlinks': symlinks,
+    }
+
+
+def check_digests(path, digests, full=False):
+    """Return a list of the differences between the package at path and digests (see make_digests).
+
+    Unless full, files are only compared by size and mtime."""
+    problems = []
+    for rel_path, (size, mtime_ns, file_sha1) in sorted(digests['files'].items()):
+        full_path = os.path.join(path, rel_path)
+        try:
+            file_stat = os.lstat(full_path)
+        except FileNotFoundError:
+            problems.append("{}: missing".format(rel_path))
+            continue
+        if not stat.S_ISREG(file_stat.st_mode):
+            problems.append("{}: no longer a regular file".format(rel_path))
+        elif file_stat.st_size != size:
+            problems.append("{}: size changed from {} to {}".format(rel_path, size, file_stat.st_size))
+        elif full:
+            if sha1(full_path) != file_sha1:
+                problems.append("{}: contents changed".format(rel_path))
+        elif file_stat.st_mtime_ns != mtime_ns:
+            problems.append("{}: modified".format(rel_path))
+
+    for rel_path, target in sorted(digests['symlinks'].items()):
+        full_path = os.path.join(path, rel_path)
+        if not os.path.islink(full_path):
+            problems.append("{}: missing symlink".format(rel_path))
+        elif os.readlink(full_path) != target:
+            problems.append("{}: symlink changed from {} to {}".format(rel_path, target, os.readlink(full_path)))
+
+    return problems
+
+
 # Create folders and symlink files inside the folders. Allows multiple
 # packages to have the same folder and provide it publicly.
-def symlink_tree(src, dest):
-    for name in os.listdir(src):
+def symlink_manifest_tree(src, tree, dest):
+    """Symlink everything in the package directory src into dest.
+
+    Directories are merged, creating real directories in dest, everything else
+    is symlinked. tree is the manifest entry of src (see make_manifest), so
+    src itself doesn't need to be walked."""
+    # Parent directories always sort before their contents.
+    for name in tree['dirs']:
+        dest_path = os.path.join(dest, name)
+        if os.path.exists(dest_path):
+            # We can only merge a directory into a directory.
+            if not os.path.isdir(dest_path) and not os.path.islink(dest_path):
+                raise ValidationError(
+                    "Can't merge a file `{0}` and directory (or symlink) `{1}` with the same name."
+                    .format(os.path.join(src, name), dest_path))
+        else:
+            os.mkdir(dest_path)
+
+    for name in tree['files']:
         src_path = os.path.join(src, name)
         dest_path = os.path.join(dest, name)
-        # Symlink files and symlinks directly. For directories make a
-        # real directory and symlink everything inside.
-        # NOTE: We could relax this and follow symlinks, but then we
-        # need to be careful about recursive filesystem layouts.
-        if os.path.isdir(src_path) and not os.path.islink(src_path):
-            if os.path.exists(dest_path):
-                # We can only merge a directory into a directory.
-                # We won't merge into a symlink directory because that could
-                # result in a package editing inside another package.
-                if not os.path.isdir(dest_path) and not os.path.islink(dest_path):
-                    raise ValidationError(
-                        "Can't merge a file `{0}` and directory (or symlink) `{1}` with the same name."
-                        .format(src_path, dest_path))
-            else:
-                os.makedirs(dest_path)
+        try:
+            os.symlink(src_path, dest_path)
+        except (FileExistsError, FileNotFoundError) as ex:
+            raise ConflictingFile(src_path, dest_path, ex) from ex
 
-            # Recurse into the directory symlinking everything so long as the directory isn't
-            symlink_tree(src_path, dest_path)
-        else:
-            try:
-                os.symlink(src_path, dest_path)
-            except FileNotFoundError as ex:
-                raise ConflictingFile(src_path, dest_path, ex) from ex
+
+def unlink_manifest_tree(src, tree, dest, keep_dirs):
+    """Undo symlink_manifest_tree(src, tree, dest).
+
+    Symlinks in dest pointing into src are removed. Directories which are left
+    empty are removed as well, unless they are in keep_dirs (the directories of
+    the packages which stay symlinked into dest).
+    """
+    for name in tree['files']:
+        src_path = os.path.join(src, name)
+        dest_path = os.path.join(dest, name)
+        if os.path.islink(dest_path) and os.readlink(dest_path) == src_path:
+            os.remove(dest_path)
+
+    # Children before their parents.
+    for name in reversed(tree['dirs']):
+        dest_path = os.path.join(dest, name)
+        if name in keep_dirs or os.path.islink(dest_path) or not os.path.isdir(dest_path):
+            continue
+        if not os.listdir(dest_path):
+            os.rmdir(dest_path)
 
 
 # Manages a systemd-sysusers user set.
@@ -469,7 +882,10 @@ class UserManagement:
         assert isinstance(manage_users, bool)
         self._manage_users = manage_users
         self._add_users = add_users
-        self._users = set()
+        # username -> group of the users added so far.
+        self._requested = dict()
+        # username -> uid, set by ensure_users_exist.
+        self._users = None
 
     @staticmethod
     def validate_username(username):
@@ -516,55 +932,75 @@ class UserManagement:
                 "check `buildinfo.json`".format(username, user.pw_gid, group_name, group.gr_gid))
 
     def add_user(self, username, group):
+        assert self._users is None, "add_user() called after ensure_users_exist()"
         UserManagement.validate_username(username)
 
         if not self._manage_users:
             return
 
-        # Check if the user already exists and exit.
-        try:
-            UserManagement.validate_user_group(username, group)
-            self._users.add(username)
-            return
-        except KeyError as ex:
-            # Doesn't exist, fall through
-            pass
+        if self._requested.get(username, group) != group:
+            raise ValidationError("User {} is required with both group {} and group {}".format(
+                username, self._requested[username], group))
+        self._requested[username] = group
+
+    def ensure_users_exist(self):
+        """Check all the added users exist in their groups, creating the missing ones.
+
+        Users are looked up one by one rather than by enumerating the user
+        database, which NSS sources like LDAP or sssd don't do by default.
+        Nothing is created unless every missing user can be."""
+        assert self._users is None, "ensure_users_exist() called twice"
+        uids = dict()
+
+        missing = []
+        for username, group in sorted(self._requested.items()):
+            if group is not None:
+                UserManagement.validate_group(group)
+            try:
+                uids[username] = pwd.getpwnam(username).pw_uid
+            except KeyError:
+                missing.append((username, group))
+            else:
+                UserManagement.validate_user_group(username, group)
 
         # If we're not allowed to manage users, error
-        if not self._add_users:
-            raise ValidationError("User {} doesn't exist but is required by a DC/OS Component, and "
-                                  "automatic user addition is disabled".format(username))
-
-        # Add the user:
-        add_user_cmd = [
-            'useradd',
-            '--system',
-            '--home-dir', '/opt/mesosphere',
-            '--shell', '/sbin/nologin',
-            '-c', 'DCOS System User',
-        ]
-
-        if group is not None:
-            UserManagement.validate_group(group)
-            add_user_cmd += [
-                '-g', group
+        if missing and not self._add_users:
+            raise ValidationError("Users {} don't exist but are required by DC/OS Components, and "
+                                  "automatic user addition is disabled".format(
+                                      ', '.join(username for username, _ in missing)))
+
+        for username, group in missing:
+            add_user_cmd = [
+                'useradd',
+                '--system',
+                '--home-dir', '/opt/mesosphere',
+                '--shell', '/sbin/nologin',
+                '-c', 'DCOS System User',
             ]
 
-        add_user_cmd += [username]
+            if group is not None:
+                add_user_cmd += [
+                    '-g', group
+                ]
 
-        try:
-            check_output(add_user_cmd)
-            self._users.add(username)
-        except CalledProcessError as ex:
-            raise ValidationError("User {} doesn't exist and couldn't be created because of: {}"
-                                  .format(username, ex.output))
+            add_user_cmd += [username]
+
+            try:
+                check_output(add_user_cmd)
+            except CalledProcessError as ex:
+                raise ValidationError("User {} doesn't exist and couldn't be created because of: {}"
+                                      .format(username, ex.output))
+            uids[username] = pwd.getpwnam(username).pw_uid
+
+        self._users = {username: uids[username] for username in self._requested}
 
     def get_uid(self, username):
         # Code should have already asserted all users exist, and be passing us
         # a user we know about. This method only works for package users.
+        assert self._users is not None, "get_uid() called before ensure_users_exist()"
         assert username in self._users
 
-        return pwd.getpwnam(username).pw_uid
+        return self._users[username]
 
 
 # A rooted install tree.
@@ -619,12 +1055,76 @@ class Install:
         self.__add_users = add_users
         self.__manage_state_dir = manage_state_dir
 
+        # ((inode, mtime) of the active folder, active ids) from the last get_active().
+        self.__active_cache = None
+
+    @property
+    def systemd(self):
+        """Systemd for the units of the active packages, None if systemd dirs are skipped."""
+        if self.__skip_systemd_dirs:
+            return None
+        return Systemd(self._make_abs(self.__systemd_dir), self.__manage_systemd, self.__block_systemd)
+
     def _get_dcos_configuration_template(self):
         return {"sysctl": {}}
 
     def get_active_dir(self):
         return os.path.join(self.__root, "active")
 
+    def get_active_ids(self, extension):
+        """Return the package ids in the active folder with the given extension (".old", ".new").
+
+        Unlike get_active, returns an empty set if there is no such folder."""
+        active_dir = self.get_active_dir() + extension
+        return {os.path.basename(os.path.realpath(os.path.join(active_dir, name)))
+                for name in if_exists(os.listdir, active_dir) or []}
+
+    def get_history_filename(self):
+        return self._make_abs("active.history.json")
+
+    def get_history(self):
+        """Return the last ACTIVE_HISTORY_SIZE active sets, most recent first."""
+        return [set(ids) for ids in if_exists(load_json, self.get_history_filename()) or []]
+
+    def get_state_ownership_filename(self):
+        return self._make_abs("state-ownership.json")
+
+    def _ensure_state_dirs(self, packages, sysusers):
+        """Make sure the state directory in `/var/lib/dcos` of each package exists and is owned by its user.
+
+        Trees are only chowned when the ownership stamp doesn't show them
+        already belonging to the user, and then all at once."""
+        # TODO(cmaloney): On upgrade take a snapshot?
+        stamp_filename = self.get_state_ownership_filename()
+        stamp = if_exists(load_json, stamp_filename) or {}
+        to_chown = []
+        for package in packages:
+            if not package.state_directory:
+                continue
+            state_dir_path = '/var/lib/dcos/{}'.format(package.name)
+            os.makedirs(state_dir_path, exist_ok=True)
+
+            if package.username:
+                uid = sysusers.get_uid(package.username)
+                # The directory itself is checked in case it was recreated since.
+                if stamp.get(state_dir_path) != uid or os.lstat(state_dir_path).st_uid != uid:
+                    to_chown.append((state_dir_path, uid))
+
+        for (state_dir_path, uid), _, seconds in run_concurrently(
+                lambda item: chown_tree(*item), to_chown, CHOWN_JOBS):
+            log.info("Changed the owner of %s to %s in %.2fs", state_dir_path, uid, seconds)
+            stamp[state_dir_path] = uid
+
+        if to_chown:
+            write_json(stamp_filename + ".new", stamp)
+            os.rename(stamp_filename + ".new", stamp_filename)
+
+    def _record_history(self, ids):
+        history_filename = self.get_history_filename()
+        history = [sorted(ids)] + (if_exists(load_json, history_filename) or [])
+        write_json(history_filename + ".new", history[:ACTIVE_HISTORY_SIZE])
+        os.rename(history_filename + ".new", history_filename)
+
     def get_active(self):
         """the active folder has symlinks to all the active packages.
 
@@ -640,6 +1140,15 @@ class Install:
                 raise InstallError(
                     "Install directory {0} has no active folder. Has it been bootstrapped?".format(self.__root))
 
+        # Activation always swaps in a new active folder and anything changing
+        # the links inside it updates its mtime, so the last result is reused
+        # while both are the same.
+        active_stat = os.stat(active_dir)
+        key = (active_stat.st_ino, active_stat.st_mtime_ns)
+        cache = self.__active_cache
+        if cache is not None and cache[0] == key:
+            return set(cache[1])
+
         ids = set()
         for name in os.listdir(active_dir):
             package_path = os.path.realpath(os.path.join(active_dir, name))
@@ -647,6 +1156,7 @@ class Install:
             # cope if there is something invalid in the current active dir.
             ids.add(os.path.basename(package_path))
 
+        self.__active_cache = (key, frozenset(ids))
         return ids
 
     def has_flag(self, name):
@@ -667,11 +1177,53 @@ class Install:
                 "active",
                 "active.buildinfo.full.json"
             ]))
+
+    def _get_active_package_paths(self):
+        """Return a dictionary of package id to path for the active packages.
+
+        Returns None if any part of the active tree is missing, in which case it
+        can't be updated incrementally."""
+        if not all(map(os.path.exists, self.get_active_names())):
+            return None
+
+        active_dir = self.get_active_dir()
+        paths = dict()
+        for name in os.listdir(active_dir):
+            path = os.path.join(active_dir, os.readlink(os.path.join(active_dir, name)))
+            if not os.path.isdir(path):
+                return None
+            paths[os.path.basename(path)] = path
+        return paths
+
+    def _get_package_dir_names(self, dir_name):
+        """The directories of a package which get symlinked into the well known dir dir_name."""
+        return [dir_name] + ["{0}_{1}".format(dir_name, role) for role in self.__roles]
+
     # Builds new working directories for the new active set, then swaps it into place as atomically as possible.
 
-    def activate(self, packages):
-        # Ensure the new set is reasonable.
-        validate_compatible(packages, self.__roles)
+    def validate(self, packages):
+        """Raise ValidationError if packages can't be activated together on this host."""
+        validate_compatible(packages, self.__roles, [os.path.basename(name) for name in self.__well_known_dirs])
+
+    def activate(self, packages, incremental=False, progress=None):
+        """Make packages the active set.
+
+        If incremental, the new well known directories start out as a copy of the
+        current ones. Only the symlinks of packages which are removed from or
+        added to the active set are changed, rather than symlinking every package
+        again. Falls back to building everything when there is no complete
+        active set to start from.
+
+        progress, if given, is called with the name of each stage as it starts:
+        "validate", "symlink" then "swap".
+        """
+        progress = progress or _no_progress
+
+        # Ensure the new set is reasonable, before touching the filesystem.
+        progress("validate")
+        self.validate(packages)
+
+        progress("symlink")
 
         # Build the absolute paths for the running config, new config location,
         # and where to archive the config.
@@ -691,15 +1243,38 @@ class Install:
                 else:
                     os.remove(name)
 
-        # Make the directories for the new config
-        for name in new_dirs:
-            os.makedirs(name)
-
-        def symlink_all(src, dest):
-            if not os.path.isdir(src):
-                return
-
-            symlink_tree(src, dest)
+        previous = self._get_active_package_paths() if incremental else None
+        if previous is None:
+            # Make the directories for the new config
+            for name in new_dirs:
+                os.makedirs(name)
+            to_link = packages
+        else:
+            # Start from a copy of the current symlink trees, then unlink the
+            # packages which are no longer active.
+            for active, new in zip(active_dirs, new_dirs):
+                check_call(['cp', '-a', active, new])
+
+            new_ids = set(str(package.id) for package in packages)
+            kept = [package for package in packages if str(package.id) in previous]
+            for id_str, path in previous.items():
+                if id_str in new_ids:
+                    continue
+                trees = load_manifest(path)['trees']
+                for new, dir_name in zip(new_dirs, self.__well_known_dirs):
+                    dir_name = os.path.basename(dir_name)
+                    keep_dirs = set()
+                    for package in kept:
+                        for name in self._get_package_dir_names(dir_name):
+                            keep_dirs.update(package.manifest['trees'].get(name, {'dirs': []})['dirs'])
+                    # Also look at role directories of roles this machine may have had
+                    # when the package was activated.
+                    for name, tree in trees.items():
+                        if name == dir_name or name.startswith(dir_name + '_'):
+                            unlink_manifest_tree(os.path.join(path, name), tree, new, keep_dirs)
+                os.remove(os.path.join(self._make_abs("active.new"), PackageId(id_str).name))
+
+            to_link = [package for package in packages if str(package.id) not in previous]
 
         # Set the new LD_LIBRARY_PATH, PATH.
         env_contents = env_header.format("/opt/mesosphere" if self.__fake_path else self.__root)
@@ -712,23 +1287,11 @@ class Install:
         # Building up the set of users
         sysusers = UserManagement(self.__manage_users, self.__add_users)
 
-        def _get_service_files(_dir):
-            service_files = []
-            for root, directories, filenames in os.walk(_dir):
-                for filename in filter(lambda name: name.endswith(".service"), filenames):
-                    service_files.append(os.path.join(root, filename))
-            return service_files
-
-        def _get_service_names(_dir):
-            service_files = list(map(os.path.basename, _get_service_files(_dir)))
-
-            if not service_files:
-                return []
+        def _get_service_names(package):
+            return [os.path.splitext(os.path.basename(path))[0] for path in package.manifest['services']]
 
-            return list(map(lambda name: os.path.splitext(name)[0], service_files))
-
-        # Add the folders, config in each package.
-        for package in packages:
+        # Add the folders of each package which isn't already linked in.
+        for package in to_link:
             # Package folders
             # NOTE: Since active is at the end of the folder list it will be
             # removed by the zip. This is the desired behavior, since it will be
@@ -737,18 +1300,17 @@ class Install:
             # while inside the packages they are always top level directories.
             for new, dir_name in zip(new_dirs, self.__well_known_dirs):
                 dir_name = os.path.basename(dir_name)
-                pkg_dir = os.path.join(package.path, dir_name)
 
                 assert os.path.isabs(new)
-                assert os.path.isabs(pkg_dir)
 
                 try:
-                    symlink_all(pkg_dir, new)
-
-                    # Symlink all applicable role-based config
-                    for role in self.__roles:
-                        role_dir = os.path.join(package.path, "{0}_{1}".format(dir_name, role))
-                        symlink_all(role_dir, new)
+                    # Symlink the package directory and all applicable role-based config
+                    for name in self._get_package_dir_names(dir_name):
+                        if name not in package.manifest['trees']:
+                            continue
+                        pkg_dir = os.path.join(package.path, name)
+                        assert os.path.isabs(pkg_dir)
+                        symlink_manifest_tree(pkg_dir, package.manifest['trees'][name], new)
 
                 except ConflictingFile as ex:
                     raise ValidationError("Two packages are trying to install the same file {0} or "
@@ -761,6 +1323,8 @@ class Install:
             # Add to the active folder
             os.symlink(package.path, os.path.join(self._make_abs("active.new"), package.name))
 
+        # Add the config of each package.
+        for package in packages:
             # Add to the environment and environment.export contents
 
             env_contents += "# package: {0}\n".format(package.id)
@@ -788,19 +1352,8 @@ class Install:
             if package.username is not None:
                 sysusers.add_user(package.username, package.group)
 
-            # Ensure the state directory in `/var/lib/dcos` exists
-            # TODO(cmaloney): On upgrade take a snapshot?
-            if self.__manage_state_dir:
-                state_dir_path = '/var/lib/dcos/{}'.format(package.name)
-                if package.state_directory:
-                    check_call(['mkdir', '-p', state_dir_path])
-
-                    if package.username:
-                        uid = sysusers.get_uid(package.username)
-                        check_call(['chown', '-R', str(uid), state_dir_path])
-
             if package.sysctl:
-                service_names = _get_service_names(package.path)
+                service_names = _get_service_names(package)
 
                 if not service_names:
                     raise ValueError("service name required for sysctl could not be determined for {package}".format(
@@ -810,6 +1363,11 @@ class Install:
                     if service in package.sysctl:
                         dcos_service_configuration["sysctl"][service] = package.sysctl[service]
 
+        # Create all the users at once, then hand each package its state directory.
+        sysusers.ensure_users_exist()
+        if self.__manage_state_dir:
+            self._ensure_state_dirs(packages, sysusers)
+
         dcos_service_configuration_file = os.path.join(self._make_abs("etc.new"), DCOS_SERVICE_CONFIGURATION_FILE)
         write_json(dcos_service_configuration_file, dcos_service_configuration)
 
@@ -825,7 +1383,9 @@ class Install:
         new_buildinfo_meta = self._make_abs("active.buildinfo.full.json.new")
         write_json(new_buildinfo_meta, active_buildinfo_full)
 
+        progress("swap")
         self.swap_active(".new")
+        self._record_history(str(package.id) for package in packages)
 
     def recover_swap_active(self):
         state_filename = self._make_abs("install_progress")
@@ -849,9 +1409,7 @@ class Install:
     def swap_active(self, extension, archive=True):
         active_names = self.get_active_names()
         state_filename = self._make_abs("install_progress")
-        systemd = None
-        if not self.__skip_systemd_dirs:
-            systemd = Systemd(self._make_abs(self.__systemd_dir), self.__manage_systemd, self.__block_systemd)
+        systemd = self.systemd
 
         # Ensure all the new active files exist
         for active in active_names:
@@ -2,15 +2,19 @@ import collections
 import logging
 import os
 import sys
+import time
 from functools import partial
 from subprocess import CalledProcessError, check_call
 
 from pkgpanda import PackageId, requests_fetcher
 from pkgpanda.constants import (DCOS_SERVICE_CONFIGURATION_PATH,
-                                SYSCTL_SETTING_KEY)
+                                DEFAULT_FETCH_JOBS, GC_KEEP_HISTORY,
+                                GC_MIN_AGE, SYSCTL_SETTING_KEY)
 from pkgpanda.exceptions import FetchError, PackageConflict, ValidationError
-from pkgpanda.util import (extract_tarball, if_exists, load_json, load_string,
-                           write_string)
+from pkgpanda.mirrors import get_mirrors
+from pkgpanda.package_cache import get_package_cache
+from pkgpanda.util import (disk_usage, extract_tarball, if_exists, load_json,
+                           load_string, run_concurrently, write_string)
 
 DCOS_TARGET_CONTENTS = """[Install]
 WantedBy=multi-user.target
@@ -19,7 +23,8 @@ WantedBy=multi-user.target
 log = logging.getLogger(__name__)
 
 
-def activate_packages(install, repository, package_ids, systemd, block_systemd):
+def activate_packages(install, repository, package_ids, systemd, block_systemd, incremental=False,
+                      progress=None):
     """Replace the active package set with package_ids.
 
     install: pkgpanda.Install
@@ -27,12 +32,16 @@ def activate_packages(install, repository, package_ids, systemd, block_systemd):
     package_ids: sequence of package IDs to activate
     systemd: start/stop systemd services
     block_systemd: if systemd, block waiting for systemd services to come up
+    incremental: only relink the packages which change rather than the whole active set
+    progress: optional function called with the name of each activation stage as it starts
 
     """
     assert isinstance(package_ids, collections.Sequence)
-    install.activate(repository.load_packages(package_ids))
+    install.activate(repository.load_packages(package_ids), incremental, progress)
     if systemd:
-        _start_dcos_target(block_systemd)
+        if progress is not None:
+            progress("systemd")
+        _start_dcos_target(block_systemd, install.systemd)
 
 
 def swap_active_package(install, repository, package_id, systemd, block_systemd):
@@ -62,21 +71,37 @@ def swap_active_package(install, repository, package_id, systemd, block_systemd)
 
     packages_by_name[new_id.name] = new_id
     new_active = list(map(str, packages_by_name.values()))
-    # Activate with the new package name
-    activate_packages(install, repository, new_active, systemd, block_systemd)
+    # Activate with the new package name. Only the swapped package changes, so
+    # the rest of the active tree can be reused.
+    activate_packages(install, repository, new_active, systemd, block_systemd, incremental=True)
 
 
-def fetch_package(repository, repository_url, package_id, work_dir):
+def _delta_base(repository, package_id):
+    """Return the (id, path) of the most recently added other version of package_id in repository, if any."""
+    versions = [id_ for id_ in repository.get_ids(PackageId(package_id).name) if id_ != package_id]
+    if not versions:
+        return None
+    base_id = max(versions, key=lambda id_: os.stat(repository.package_path(id_)).st_mtime)
+    return base_id, repository.package_path(base_id)
+
+
+def fetch_package(repository, repository_url, package_id, work_dir, sha1=None, peers=None):
     """Fetch package_id from repository_url into repository.
 
     repository: pkgpanda.Repository
-    repository_url: URL for remote package repository
+    repository_url: URL for remote package repository, or mirrors of it (see pkgpanda.mirrors.get_mirrors)
     package_id: package ID to fetch
     work_dir: location for temporary files, used only if repository_url is a file URL with a relative path
+    sha1: optional sha1 the package tarball must have
+    peers: optional URLs of other nodes' pkgpanda HTTP APIs to fetch from first, only used if sha1 is given
 
     """
+    cache = get_package_cache()
+    mirrors = get_mirrors(repository_url)
+    peers = get_mirrors(peers) if peers else None
+
     def fetcher(id_, target):
-        return requests_fetcher(repository_url, id_, target, work_dir)
+        return requests_fetcher(mirrors, id_, target, work_dir, sha1, cache, peers, _delta_base(repository, id_))
 
     # TODO(cmaloney): Make this not use escape sequences when not at a
     # `real` terminal.
@@ -93,6 +118,72 @@ def fetch_package(repository, repository_url, package_id, work_dir):
         sys.stdout.flush()
 
 
+def fetch_packages(repository, repository_url, package_ids, work_dir, jobs=DEFAULT_FETCH_JOBS, checksums=None,
+                   peers=None):
+    """Fetch package_ids from repository_url into repository, `jobs` at a time.
+
+    Packages which are already in the repository are skipped. Every package
+    still goes through Repository.add, so each one is extracted to a temporary
+    folder and moved into place only once complete.
+
+    repository: pkgpanda.Repository
+    repository_url: URL for remote package repository, or mirrors of it (see pkgpanda.mirrors.get_mirrors)
+    package_ids: package IDs to fetch
+    work_dir: location for temporary files, used only if repository_url is a file URL with a relative path
+    jobs: maximum number of packages to download and extract at once
+    checksums: optional dictionary of package ID to the sha1 its tarball must have
+    peers: optional URLs of other nodes' pkgpanda HTTP APIs. Packages with a
+        checksum are fetched from the nearest peer which has them, falling back
+        to repository_url. Nodes share what they fetch (when they have a
+        package cache), so the more nodes have a package the faster it spreads.
+
+    Packages without a checksum are made from a delta from another version of
+    the package already in repository when the repository has one, see
+    pkgpanda.delta.
+
+    Returns a dictionary of package ID to the seconds it took to fetch.
+
+    """
+    to_fetch = []
+    for package_id in package_ids:
+        # Validate the package id before starting any downloads.
+        PackageId(package_id)
+        if package_id not in to_fetch and not repository.has_package(package_id):
+            to_fetch.append(package_id)
+
+    checksums = checksums or dict()
+    cache = get_package_cache()
+    mirrors = get_mirrors(repository_url)
+    if len(mirrors) > 1 and to_fetch:
+        mirrors.probe()
+    if peers:
+        peers = get_mirrors(peers)
+        if len(peers) > 1 and any(package_id in checksums for package_id in to_fetch):
+            peers.probe()
+    else:
+        peers = None
+
+    def fetcher(id_, target):
+        return requests_fetcher(
+            mirrors, id_, target, work_dir, checksums.get(id_), cache, peers, _delta_base(repository, id_))
+
+    def fetch(package_id):
+        try:
+            repository.add(fetcher, package_id, warn_added=False)
+        except FetchError as ex:
+            raise Exception("Unable to fetch package {0}: {1}".format(package_id, ex)) from ex
+
+    timings = dict()
+    for package_id, _, seconds in run_concurrently(fetch, to_fetch, jobs):
+        timings[package_id] = seconds
+        print("Fetched: {0} ({1:.2f}s)".format(package_id, seconds))
+        sys.stdout.flush()
+    if cache is not None and to_fetch:
+        print("Package cache: {} hits, {} misses".format(cache.hits, cache.misses))
+
+    return timings
+
+
 def add_package_file(repository, package_filename):
     """Add a package to the repository from a file.
 
@@ -149,6 +240,47 @@ def remove_package(install, repository, package_id):
         sys.stdout.flush()
 
 
+def collect_garbage(install, repository, keep=GC_KEEP_HISTORY, min_age=GC_MIN_AGE, dry_run=False,
+                    jobs=DEFAULT_FETCH_JOBS):
+    """Remove the packages of repository which haven't been active recently.
+
+    Packages in the active set, the previous one (active.old), one being
+    activated (active.new) or any of the `keep` most recent active sets are
+    kept, as are packages added to repository less than min_age seconds ago.
+
+    install: pkgpanda.Install
+    repository: pkgpanda.Repository
+    keep: number of recent active sets whose packages are kept
+    min_age: seconds a package must have been in the repository to be removed
+    dry_run: only report what would be removed
+    jobs: maximum number of packages to remove at once
+
+    Returns a dictionary of package ID to the bytes removing it reclaimed (or
+    would reclaim).
+
+    """
+    reachable = install.get_active() | install.get_active_ids(".old") | install.get_active_ids(".new")
+    for ids in install.get_history()[:keep]:
+        reachable |= ids
+
+    now = time.time()
+    garbage = [
+        package_id for package_id in sorted(repository.list())
+        if PackageId.is_id(package_id) and package_id not in reachable and
+        now - repository.added_time(package_id) >= min_age]
+
+    def remove(package_id):
+        size = disk_usage(repository.package_path(package_id))
+        if not dry_run:
+            repository.remove(package_id)
+        return size
+
+    reclaimed = dict()
+    for package_id, size, _ in run_concurrently(remove, garbage, jobs):
+        reclaimed[package_id] = size
+    return reclaimed
+
+
 def setup(install, repository):
     """Set up a fresh install of DC/OS.
 
@@ -173,7 +305,7 @@ def setup(install, repository):
         # Enable dcos.target only after we have populated it to prevent starting
         # up stuff inside of it before we activate the new set of packages.
         if install.manage_systemd:
-            _start_dcos_target(block_systemd=True)
+            _start_dcos_target(block_systemd=True, systemd=install.systemd)
         os.remove(bootstrap_path)
 
     # Check for /opt/mesosphere/install_progress. If found, recover the partial
@@ -184,24 +316,38 @@ def setup(install, repository):
             print("No recovery performed: {}".format(msg))
 
 
-def _start_dcos_target(block_systemd):
+def _start_dcos_target(block_systemd, systemd=None):
+    """Start dcos.target, which systemd starts all the DC/OS units for in parallel.
+
+    If block_systemd and systemd (a pkgpanda.Systemd) are given, how long each
+    unit took to start is logged, slowest first.
+    """
     no_block = [] if block_systemd else ["--no-block"]
+    start = time.monotonic()
     check_call(["systemctl", "daemon-reload"])
     check_call(["systemctl", "enable", "dcos.target", '--no-reload'])
     check_call(["systemctl", "start", "dcos.target"] + no_block)
+    log.info("Started dcos.target in %.2fs", time.monotonic() - start)
+
+    if block_systemd and systemd is not None:
+        latencies = systemd.start_latencies()
+        for name in sorted(latencies, key=latencies.get, reverse=True):
+            log.info("Started %s in %.2fs", name, latencies[name])
 
 
 def _do_bootstrap(install, repository):
     # These files should be set by the environment which initially builds
-    # the host (cloud-init).
+    # the host (cloud-init). repository-url may list several mirrors, one per
+    # line, see pkgpanda.mirrors.
     repository_url = if_exists(load_string, install.get_config_filename("setup-flags/repository-url"))
+    # Optionally, other nodes to fetch packages from (one pkgpanda HTTP API url
+    # per line) and the sha1 of each package tarball, which is what makes
+    # fetching from them safe.
+    peers = if_exists(load_string, install.get_config_filename("setup-flags/repository-peers"))
+    checksums = if_exists(load_json, install.get_config_filename("setup-flags/package-checksums.json"))
 
     # TODO(cmaloney): If there is 1+ master, grab the active config from a master.
     # If the config can't be grabbed from any of them, fail.
-    def fetcher(id, target):
-        if repository_url is None:
-            raise ValidationError("ERROR: Non-local package {} but no repository url given.".format(repository_url))
-        return requests_fetcher(repository_url, id, target, os.getcwd())
 
     # Copy host/cluster-specific packages written to the filesystem manually
     # from the setup-packages folder into the repository. Do not overwrite or
@@ -231,6 +377,7 @@ def _do_bootstrap(install, repository):
     # activate. Otherwise just use the set of currently active packages (those
     # active in the bootstrap tarball)
     to_activate = None
+    to_fetch = []
     active_path = install.get_config_filename("setup-flags/active.json")
     if os.path.exists(active_path):
         print("Loaded active packages from", active_path)
@@ -238,8 +385,7 @@ def _do_bootstrap(install, repository):
 
         # Ensure all packages are local
         print("Ensuring all packages in active set {} are local".format(",".join(to_activate)))
-        for package in to_activate:
-            repository.add(fetcher, package)
+        to_fetch = list(to_activate)
     else:
         print("Calculated active packages from bootstrap tarball")
         to_activate = list(install.get_active())
@@ -258,15 +404,22 @@ def _do_bootstrap(install, repository):
                 # Validate the package ids
                 pkg_id = PackageId(package_id_str)
 
-                # Fetch the packages if not local
-                if not repository.has_package(package_id_str):
-                    repository.add(fetcher, package_id_str)
-
-                # Add the package to the set to activate
+                # Fetch the packages if not local, add the package to the set to activate
+                to_fetch.append(package_id_str)
                 setup_packages_to_activate.append(package_id_str)
         else:
             print("No cluster-packages specified")
 
+    # Fetch all the packages which aren't local yet in parallel.
+    missing = [id_str for id_str in to_fetch if not repository.has_package(id_str)]
+    if missing:
+        if repository_url is None:
+            raise ValidationError("ERROR: Non-local packages {} but no repository url given.".format(
+                ','.join(missing)))
+        start = time.monotonic()
+        fetch_packages(repository, repository_url, missing, os.getcwd(), checksums=checksums, peers=peers)
+        print("Fetched {} packages in {:.2f}s".format(len(missing), time.monotonic() - start))
+
     # Calculate the full set of final packages (Explicit activations + setup packages).
     # De-duplicate using a set.
     to_activate = list(set(to_activate + setup_packages_to_activate))
@@ -4,6 +4,9 @@ import json
 import os.path
 import shutil
 import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from os import mkdir
 from os.path import exists
 from subprocess import CalledProcessError, check_call, check_output
@@ -11,13 +14,16 @@ from subprocess import CalledProcessError, check_call, check_output
 import pkgpanda.build.constants
 import pkgpanda.build.src_fetchers
 from pkgpanda import expand_require as expand_require_exceptions
-from pkgpanda import Install, PackageId, Repository
+from pkgpanda import Install, PackageId, Repository, write_manifest
 from pkgpanda.actions import add_package_file
+from pkgpanda.build.hash_cache import HashCache
 from pkgpanda.constants import RESERVED_UNIT_NAMES
 from pkgpanda.exceptions import FetchError, PackageError, ValidationError
-from pkgpanda.util import (check_forbidden_services, download_atomic, load_json,
-                           load_string, make_file, make_tar, rewrite_symlinks,
-                           write_json, write_string)
+from pkgpanda.package_cache import get_package_cache
+from pkgpanda.util import (check_forbidden_services, download_atomic,
+                           extract_tarball, get_codec, link_or_copy,
+                           load_json, load_string, make_file, make_tar,
+                           rewrite_symlinks, write_json, write_string)
 
 
 class BuildError(Exception):
@@ -214,8 +220,10 @@ class PackageSet:
 
 class PackageStore:
 
-    def __init__(self, packages_dir, repository_url):
+    def __init__(self, packages_dir, repository_url, build_cache=None):
         self._builders = {}
+        # Remote cache of built packages shared with other builders, see pkgpanda.build.build_cache.
+        self._build_cache = build_cache
         self._repository_url = repository_url.rstrip('/') if repository_url is not None else None
         self._packages_dir = packages_dir.rstrip('/')
 
@@ -227,6 +235,13 @@ class PackageStore:
         # Load an upstream if one exists
         # TODO(cmaloney): Allow upstreams to have upstreams
         self._package_cache_dir = self._packages_dir + "/cache/packages"
+        # Tarball cache shared with other trees / hosts, if one is configured.
+        self._package_cache = get_package_cache()
+        self._hash_cache = HashCache(self._packages_dir + "/cache/hashes.json")
+        # Docker image name -> id, resolved once for all the packages using the image.
+        self._docker_ids = dict()
+        self._docker_id_locks = dict()
+        self._docker_lock = threading.Lock()
         self._upstream_dir = self._packages_dir + "/cache/upstream/checkout"
         self._upstream = None
         self._upstream_package_dir = self._upstream_dir + "/packages"
@@ -288,6 +303,9 @@ class PackageStore:
     def get_bootstrap_cache_dir(self):
         return self._packages_dir + "/cache/bootstrap"
 
+    def get_git_cache_dir(self):
+        return self._packages_dir + "/cache/git"
+
     def get_complete_cache_dir(self):
         return self._packages_dir + "/cache/complete"
 
@@ -317,9 +335,26 @@ class PackageStore:
 
     def get_package_cache_folder(self, name):
         directory = self._package_cache_dir + '/' + name
-        check_call(['mkdir', '-p', directory])
+        os.makedirs(directory, exist_ok=True)
         return directory
 
+    def get_docker_id(self, docker_name):
+        """Return the id of the docker image docker_name, pulling it if it isn't available locally.
+
+        Each image is only inspected (and pulled) once per PackageStore."""
+        with self._docker_lock:
+            lock = self._docker_id_locks.setdefault(docker_name, threading.Lock())
+        with lock:
+            if docker_name not in self._docker_ids:
+                try:
+                    docker_id = get_docker_id(docker_name)
+                except CalledProcessError:
+                    # docker pull the container and try again
+                    check_call(['docker', 'pull', docker_name])
+                    docker_id = get_docker_id(docker_name)
+                self._docker_ids[docker_name] = docker_id
+            return self._docker_ids[docker_name]
+
     def list_trees(self):
         return get_variants_from_filesystem(self._packages_dir, 'treeinfo.json')
 
@@ -345,13 +380,41 @@ class PackageStore:
     def packages_dir(self):
         return self._packages_dir
 
+    @property
+    def package_cache(self):
+        return self._package_cache
+
+    @property
+    def hash_cache(self):
+        return self._hash_cache
+
+    @property
+    def build_cache(self):
+        return self._build_cache
+
     def try_fetch_by_id(self, pkg_id):
         assert isinstance(pkg_id, PackageId)
+        pkg_path = "{}.tar.xz".format(pkg_id)
+        if self._package_cache is not None:
+            cached = self._package_cache.get(str(pkg_id))
+            if cached is not None:
+                directory = self.get_package_cache_folder(pkg_id.name)
+                print("Using", pkg_id, "from package cache", cached)
+                link_or_copy(cached, directory + '/' + pkg_path)
+                return directory + '/' + pkg_path
+
+        if self._build_cache is not None:
+            directory = self.get_package_cache_folder(pkg_id.name)
+            if self._build_cache.fetch_package(pkg_id, directory + '/' + pkg_path):
+                print("Downloaded", pkg_id, "from the build cache")
+                if self._package_cache is not None:
+                    self._package_cache.add(str(pkg_id), directory + '/' + pkg_path)
+                return directory + '/' + pkg_path
+
         if self._repository_url is None:
             return False
 
         # TODO(cmaloney): Use storage providers to download instead of open coding.
-        pkg_path = "{}.tar.xz".format(pkg_id)
         url = self._repository_url + '/packages/{0}/{1}'.format(pkg_id.name, pkg_path)
         try:
             directory = self.get_package_cache_folder(pkg_id.name)
@@ -359,11 +422,18 @@ class PackageStore:
             print("Attempting to download", pkg_id, "from", url, "to", directory)
             download_atomic(directory + '/' + pkg_path, url, directory)
             assert os.path.exists(directory + '/' + pkg_path)
+            if self._package_cache is not None:
+                self._package_cache.add(str(pkg_id), directory + '/' + pkg_path)
             return directory + '/' + pkg_path
         except FetchError:
             return False
 
     def try_fetch_bootstrap_and_active(self, bootstrap_id):
+        if self._build_cache is not None:
+            if self._build_cache.fetch_bootstrap(bootstrap_id, self.get_bootstrap_cache_dir()):
+                print("Downloaded bootstrap", bootstrap_id, "from the build cache")
+                return True
+
         if self._repository_url is None:
             return False
 
@@ -435,12 +505,15 @@ def hash_checkout(item):
         raise NotImplementedError("{} of type {}".format(item, type(item)))
 
 
-def hash_folder(directory):
-    file_hash_dict = {}
-    for root, dirs, filenames in os.walk(directory):
-        for name in filenames:
-            filename = root + '/' + name
-            file_hash_dict[filename] = pkgpanda.util.sha1(filename)
+def hash_folder(directory, hash_cache=None):
+    filenames = []
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            filenames.append(root + '/' + name)
+    if hash_cache is None:
+        file_hash_dict = {filename: pkgpanda.util.sha1(filename) for filename in filenames}
+    else:
+        file_hash_dict = hash_cache.sha1_files(filenames)
     return hash_checkout(file_hash_dict)
 
 
@@ -517,7 +590,7 @@ def make_bootstrap_tarball(package_store, packages, variant):
 
     # Try downloading.
     if package_store.try_fetch_bootstrap_and_active(bootstrap_id):
-        print("Bootstrap already up to date, Not recreating. Downloaded from repository-url.")
+        print("Bootstrap already up to date, Not recreating. Downloaded from the build cache or repository-url.")
         return mark_latest()
 
     print("Unable to download from cache. Building.")
@@ -538,7 +611,7 @@ def make_bootstrap_tarball(package_store, packages, variant):
         pkg_id = filename[:-len(".tar.xz")]
 
         def local_fetcher(id, target):
-            shutil.unpack_archive(pkg_path, target, "gztar")
+            extract_tarball(pkg_path, target)
         repository.add(local_fetcher, pkg_id, False)
 
     # Activate the packages inside the repository.
@@ -570,6 +643,9 @@ def make_bootstrap_tarball(package_store, packages, variant):
 
     shutil.rmtree(work_dir)
 
+    if package_store.build_cache is not None:
+        package_store.build_cache.upload_bootstrap(bootstrap_id, bootstrap_cache_dir)
+
     # Update latest last so that we don't ever use partially-built things.
     write_string(latest_name, bootstrap_id)
 
@@ -577,12 +653,126 @@ def make_bootstrap_tarball(package_store, packages, variant):
     return mark_latest()
 
 
-def build_tree(package_store, mkbootstrap, tree_variant):
+def _critical_path(requires, timings):
+    """Return the chain of builds which determined when the last build finished, first build first.
+
+    Each build on the path is the require which finished last before the
+    next one could start."""
+    if not timings:
+        return []
+    path = [max(timings, key=lambda pkg_tuple: timings[pkg_tuple][1])]
+    while True:
+        finished_requires = [require for require in requires[path[-1]] if require in timings]
+        if not finished_requires:
+            return list(reversed(path))
+        path.append(max(finished_requires, key=lambda require: timings[require][1]))
+
+
+def schedule_builds(build_order, requires, build_fn, jobs):
+    """Call build_fn(pkg_tuple) for every package, running up to `jobs` builds at once.
+
+    A package is built once all of its requires have been built. Variants of
+    the same package share a build cache folder, so they are never built at
+    the same time. Packages which many others wait on (the longest chains of
+    dependents) are started first, then build_order breaks ties.
+
+    If a build fails, the packages which require it aren't built but
+    unrelated builds carry on. Once nothing else can be built BuildError is
+    raised listing the failures. Otherwise returns a dict of package tuple to
+    the result of build_fn, and prints a timing report including the
+    critical path.
+    """
+    dependents = {pkg_tuple: set() for pkg_tuple in build_order}
+    for pkg_tuple in build_order:
+        for require in requires[pkg_tuple]:
+            dependents[require].add(pkg_tuple)
+
+    # Length of the longest chain of packages waiting on each package.
+    # build_order has requires before dependents, so walk it backwards.
+    height = dict()
+    for pkg_tuple in reversed(build_order):
+        height[pkg_tuple] = 1 + max((height[dependent] for dependent in dependents[pkg_tuple]), default=0)
+    position = {pkg_tuple: index for index, pkg_tuple in enumerate(build_order)}
+
+    results = dict()
+    failed = dict()
+    skipped = set()
+    timings = dict()
+    waiting = set(build_order)
+    running = dict()
+    start = time.monotonic()
+
+    def timed_build(pkg_tuple):
+        build_start = time.monotonic()
+        try:
+            return build_fn(pkg_tuple)
+        finally:
+            timings[pkg_tuple] = (build_start - start, time.monotonic() - start)
+
+    def skip_dependents(pkg_tuple):
+        for dependent in dependents[pkg_tuple]:
+            if dependent in waiting:
+                waiting.remove(dependent)
+                skipped.add(dependent)
+                skip_dependents(dependent)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        while waiting or running:
+            building_names = {name for name, _ in running.values()}
+            ready = sorted(
+                (pkg_tuple for pkg_tuple in waiting
+                 if all(require in results for require in requires[pkg_tuple]) and
+                 pkg_tuple[0] not in building_names),
+                key=lambda pkg_tuple: (-height[pkg_tuple], position[pkg_tuple]))
+            for pkg_tuple in ready:
+                if len(running) >= max(1, jobs):
+                    break
+                if pkg_tuple[0] in building_names:
+                    continue
+                waiting.remove(pkg_tuple)
+                building_names.add(pkg_tuple[0])
+                running[executor.submit(timed_build, pkg_tuple)] = pkg_tuple
+
+            # Failed requires take their dependents out of waiting, so there
+            # is always something running here.
+            assert running
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                pkg_tuple = running.pop(future)
+                try:
+                    results[pkg_tuple] = future.result()
+                except Exception as ex:
+                    print("Build of {} variant {} failed: {}".format(
+                        pkg_tuple[0], pkgpanda.util.variant_name(pkg_tuple[1]), ex))
+                    failed[pkg_tuple] = ex
+                    skip_dependents(pkg_tuple)
+
+    total = time.monotonic() - start
+    path = _critical_path(requires, timings)
+    print("Built {} packages in {:.2f}s ({:.2f}s of builds)".format(
+        len(results), total, sum(finish - started for started, finish in timings.values())))
+    if path:
+        print("Critical path:")
+        for name, variant in path:
+            started, finish = timings[(name, variant)]
+            print("  {} variant {}: {:.2f}s".format(name, pkgpanda.util.variant_name(variant), finish - started))
+
+    if failed:
+        raise BuildError("Failed building: {}. Not built because a requirement failed: {}".format(
+            ', '.join(sorted('{} variant {}'.format(name, pkgpanda.util.variant_name(variant))
+                             for name, variant in failed)),
+            ', '.join(sorted('{} variant {}'.format(name, pkgpanda.util.variant_name(variant))
+                             for name, variant in skipped)) or 'none'))
+    return results
+
+
+def build_tree(package_store, mkbootstrap, tree_variant, jobs=1):
     """Build packages and bootstrap tarballs for one or all tree variants.
 
     Returns a dict mapping tree variants to bootstrap IDs.
 
-    If tree_variant is None, builds all available tree variants.
+    If tree_variant is None, builds all available tree variants. Up to `jobs`
+    packages are built at once, see schedule_builds.
 
     """
     # TODO(cmaloney): Add support for circular dependencies. They are doable
@@ -591,6 +781,7 @@ def build_tree(package_store, mkbootstrap, tree_variant):
     # TODO(cmaloney): Make it so when we're building a treeinfo which has a
     # explicit package list we don't build all the other packages.
     build_order = list()
+    requires = dict()
     visited = set()
     built = set()
 
@@ -608,10 +799,12 @@ def build_tree(package_store, mkbootstrap, tree_variant):
         # Visit the node for the first (and only) time.
         assert pkg_tuple not in visited
         visited.add(pkg_tuple)
+        requires[pkg_tuple] = set()
 
         # Ensure all dependencies are built. Sorted for stability
         for require in sorted(package_store.packages[pkg_tuple]['requires']):
             require_tuple = expand_require(require)
+            requires[pkg_tuple].add(require_tuple)
 
             # If the dependency has already been built, we can move on.
             if require_tuple in built:
@@ -655,18 +848,16 @@ def build_tree(package_store, mkbootstrap, tree_variant):
     for package_set in package_sets:
         visit_packages(package_set.all_packages)
 
-    built_packages = dict()
-    for (name, variant) in build_order:
+    def build_one(pkg_tuple):
+        name, variant = pkg_tuple
         print("Building: {} variant {}".format(name, pkgpanda.util.variant_str(variant)))
-        built_packages.setdefault(name, dict())
+        return build(package_store, name, variant, True)
 
-        # Run the build, store the built package path for later use.
-        # TODO(cmaloney): Only build the requested variants, rather than all variants.
-        built_packages[name][variant] = build(
-            package_store,
-            name,
-            variant,
-            True)
+    # Run the builds, store the built package paths for later use.
+    # TODO(cmaloney): Only build the requested variants, rather than all variants.
+    built_packages = dict()
+    for (name, variant), pkg_path in schedule_builds(build_order, requires, build_one, jobs).items():
+        built_packages.setdefault(name, dict())[variant] = pkg_path
 
     # Build bootstrap tarballs for all tree variants.
     def make_bootstrap(package_set):
@@ -813,8 +1004,12 @@ def build(package_store, name, variant, clean_after_build, recursive=False):
     try:
         for src_name, src_info in sorted(sources.items()):
             # TODO(cmaloney): Switch to a unified top level cache directory shared by all packages
-            cache_dir = package_store.get_package_cache_folder(name) + '/' + src_name
-            check_call(['mkdir', '-p', cache_dir])
+            if src_info.get('kind') == 'git':
+                # Mirrors of git repositories are shared by all packages.
+                cache_dir = package_store.get_git_cache_dir()
+            else:
+                cache_dir = package_store.get_package_cache_folder(name) + '/' + src_name
+            os.makedirs(cache_dir, exist_ok=True)
             fetcher = get_src_fetcher(src_info, cache_dir, package_dir)
             fetchers[src_name] = fetcher
             checkout_ids[src_name] = fetcher.get_id()
@@ -834,30 +1029,24 @@ def build(package_store, name, variant, clean_after_build, recursive=False):
     builder.update('sources', checkout_ids)
     build_script = src_abs(builder.take('build_script'))
     # TODO(cmaloney): Change dest name to build_script_sha1
-    builder.replace('build_script', 'build', pkgpanda.util.sha1(build_script))
+    builder.replace('build_script', 'build', package_store.hash_cache.sha1(build_script))
     builder.add('pkgpanda_version', pkgpanda.build.constants.version)
 
     extra_dir = src_abs("extra")
     # Add the "extra" folder inside the package as an additional source if it
     # exists
     if os.path.exists(extra_dir):
-        extra_id = hash_folder(extra_dir)
+        extra_id = hash_folder(extra_dir, package_store.hash_cache)
         builder.add('extra_source', extra_id)
         final_buildinfo['extra_source'] = extra_id
+    package_store.hash_cache.save()
 
     # Figure out the docker name.
     docker_name = builder.take('docker')
     cmd.container = docker_name
 
     # Add the id of the docker build environment to the build_ids.
-    try:
-        docker_id = get_docker_id(docker_name)
-    except CalledProcessError:
-        # docker pull the container and try again
-        check_call(['docker', 'pull', docker_name])
-        docker_id = get_docker_id(docker_name)
-
-    builder.update('docker', docker_id)
+    builder.update('docker', package_store.get_docker_id(docker_name))
 
     # TODO(cmaloney): The environment variables should be generated during build
     # not live in buildinfo.json.
@@ -1030,7 +1219,7 @@ def build(package_store, name, variant, clean_after_build, recursive=False):
     # Try downloading.
     dl_path = package_store.try_fetch_by_id(pkg_id)
     if dl_path:
-        print("Package up to date. Not re-building. Downloaded from repository-url.")
+        print("Package up to date. Not re-building. Downloaded from a cache or repository-url.")
         # TODO(cmaloney): Updating / filling last_build should be moved out of
         # the build function.
         write_string(package_store.get_last_build_filename(name, variant), str(pkg_id))
@@ -1117,6 +1306,10 @@ def build(package_store, name, variant, clean_after_build, recursive=False):
     # Run the build, prepping the environment as necessary.
     mkdir(cache_abs("result"))
 
+    # Record the compression of the package tarball along with the build info.
+    codec = get_codec()
+    final_buildinfo['compression'] = codec.name
+
     # Copy the build info to the resulting tarball
     write_json(cache_abs("src/buildinfo.full.json"), final_buildinfo)
     write_json(cache_abs("result/buildinfo.full.json"), final_buildinfo)
@@ -1179,10 +1372,17 @@ def build(package_store, name, variant, clean_after_build, recursive=False):
     # the build function.
     write_string(package_store.get_last_build_filename(name, variant), str(pkg_id))
 
+    # List the package contents so activating it doesn't need to walk them.
+    write_manifest(cache_abs("result"))
+
     # Bundle the artifacts into the pkgpanda package
     tmp_name = pkg_path + "-tmp.tar.xz"
-    make_tar(tmp_name, cache_abs("result"))
+    make_tar(tmp_name, cache_abs("result"), codec.name)
     os.rename(tmp_name, pkg_path)
+    if package_store.package_cache is not None:
+        package_store.package_cache.add(str(pkg_id), pkg_path)
+    if package_store.build_cache is not None:
+        package_store.build_cache.upload_package(pkg_id, pkg_path)
     print("Package built.")
     if clean_after_build:
         clean()
@@ -0,0 +1,127 @@
+"""Build cache shared by builders through a release storage provider.
+
+The cache is laid out like a release repository:
+
+    packages/<name>/<package id>.tar.xz
+    bootstrap/<bootstrap id>.bootstrap.tar.xz
+    bootstrap/<bootstrap id>.active.json
+
+with the sha1 of each artifact next to it in <artifact>.sha1. A package id is
+the hash of everything that went into building the package, so a package
+found under its id is the package the build would have produced, and
+builders only ever upload what isn't there yet.
+
+The sha1 is uploaded after the artifact, so an artifact only counts as being
+in the cache once its upload completed. Downloads are checked against it,
+which catches artifacts truncated or corrupted in storage.
+
+What the cache holds is listed once, in one call, the first time it's needed.
+Providers which can't list (http) are asked about each artifact instead.
+Artifacts which other builders add after the listing are found on the next
+run, or by their upload being skipped.
+"""
+import os
+import threading
+
+from pkgpanda.util import sha1
+from release.storage import UnsupportedOperation
+
+
+def package_path(pkg_id):
+    return 'packages/{}/{}.tar.xz'.format(pkg_id.name, pkg_id)
+
+
+def sha1_path(path):
+    return path + '.sha1'
+
+
+def bootstrap_paths(bootstrap_id):
+    return ['bootstrap/{}.bootstrap.tar.xz'.format(bootstrap_id), 'bootstrap/{}.active.json'.format(bootstrap_id)]
+
+
+class BuildCache:
+
+    def __init__(self, storage):
+        self.__storage = storage
+        self.__lock = threading.Lock()
+        # Set of the paths in the cache, False if the storage can't list them.
+        self.__listing = None
+
+    @property
+    def storage(self):
+        return self.__storage
+
+    def _listing(self):
+        with self.__lock:
+            if self.__listing is None:
+                try:
+                    self.__listing = set()
+                    for folder in ['packages', 'bootstrap']:
+                        self.__listing |= self.__storage.list_recursive(folder)
+                except (NotImplementedError, UnsupportedOperation):
+                    self.__listing = False
+            return self.__listing
+
+    def has(self, path):
+        listing = self._listing()
+        if listing is False:
+            return self.__storage.exists(sha1_path(path))
+        return path in listing and sha1_path(path) in listing
+
+    def download(self, path, local_path):
+        """Download path to local_path if it is in the cache, returning whether it was.
+
+        local_path only ever exists once the download is complete."""
+        if not self.has(path):
+            return False
+        tmp_path = '{}.tmp-{}'.format(local_path, os.getpid())
+        try:
+            expected_sha1 = self.__storage.fetch(sha1_path(path)).decode().strip()
+            self.__storage.download(path, tmp_path)
+            if sha1(tmp_path) != expected_sha1:
+                raise ValueError("sha1 of the download doesn't match {}".format(sha1_path(path)))
+            os.rename(tmp_path, local_path)
+        except Exception as ex:
+            print("Unable to download {} from the build cache: {}".format(path, ex))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        return True
+
+    def upload(self, path, local_path):
+        """Upload local_path to path unless the cache already has it or can't be written to.
+
+        Failures are reported but not raised, the build itself succeeded."""
+        if self.__storage.read_only:
+            return
+        try:
+            if self.__storage.exists(sha1_path(path)):
+                return
+            print("Uploading", path, "to the build cache")
+            self.__storage.upload(path, local_path=local_path)
+            self.__storage.upload(sha1_path(path), blob=sha1(local_path).encode())
+        except Exception as ex:
+            print("Unable to upload {} to the build cache: {}".format(path, ex))
+            return
+        with self.__lock:
+            if self.__listing:
+                self.__listing |= {path, sha1_path(path)}
+
+    def fetch_package(self, pkg_id, local_path):
+        return self.download(package_path(pkg_id), local_path)
+
+    def upload_package(self, pkg_id, local_path):
+        self.upload(package_path(pkg_id), local_path)
+
+    def fetch_bootstrap(self, bootstrap_id, local_dir):
+        """Download the bootstrap tarball and active.json of bootstrap_id into local_dir.
+
+        Returns whether both were in the cache."""
+        paths = bootstrap_paths(bootstrap_id)
+        if not all(self.has(path) for path in paths):
+            return False
+        return all(self.download(path, local_dir + '/' + os.path.basename(path)) for path in paths)
+
+    def upload_bootstrap(self, bootstrap_id, local_dir):
+        for path in bootstrap_paths(bootstrap_id):
+            self.upload(path, local_dir + '/' + os.path.basename(path))
@@ -5,18 +5,51 @@ package version, then builds the package in an isolated environment along with
 the necessary dependencies.
 
 Usage:
-  mkpanda [--repository-url=<repository_url>] [--dont-clean-after-build] [--recursive]
-  mkpanda tree [--mkbootstrap] [--repository-url=<repository_url>] [<variant>]
+  mkpanda [--repository-url=<repository_url>] [--build-cache=<storage>] [--dont-clean-after-build] [--recursive]
+  mkpanda tree [--mkbootstrap] [--repository-url=<repository_url>] [--build-cache=<storage>] [--jobs=<jobs>]
+               [<variant>]
+  mkpanda delta <base-tarball> <target-tarball>
+
+Options:
+  --build-cache=<storage>  Share built packages and bootstraps with other builders through a
+                           directory, an http(s) url (download only) or a storage provider
+                           configured as in release configs, e.g.
+                           '{"kind": "aws_s3", "bucket": ..., "object_prefix": ..., "download_url": ...}'
+  --jobs=<jobs>            Number of packages to build at once [default: 1]
 """
 
+import json
 import sys
 from os import getcwd, umask
-from os.path import basename, normpath
+from os.path import abspath, basename, normpath
 
 from docopt import docopt
 
 import pkgpanda.build
 import pkgpanda.build.constants
+import pkgpanda.delta
+
+
+def get_build_cache(storage):
+    """Return the BuildCache for the --build-cache option, None if it isn't set."""
+    if storage is None:
+        return None
+
+    # Importing release pulls in gen, which needs a dcos-image checkout. Only
+    # builders using a build cache need it.
+    import release
+    from pkgpanda.build.build_cache import BuildCache
+
+    try:
+        if storage.startswith('{'):
+            options = json.loads(storage)
+        elif storage.startswith(('http://', 'https://')):
+            options = {'kind': 'http_read', 'url': storage}
+        else:
+            options = {'kind': 'local_path', 'path': abspath(storage).rstrip('/')}
+        return BuildCache(release.make_storage_provider(options))
+    except (ValueError, release.ConfigError) as ex:
+        raise pkgpanda.build.BuildError("Invalid --build-cache {}: {}".format(storage, ex))
 
 
 def main():
@@ -24,17 +57,33 @@ def main():
         arguments = docopt(__doc__, version="mkpanda {}".format(pkgpanda.build.constants.version))
         umask(0o022)
 
+        # Make the delta to upgrade from one package tarball to another, written
+        # next to the target tarball so it gets published along with it.
+        if arguments['delta']:
+            print(pkgpanda.delta.make_delta_tarball(arguments['<base-tarball>'], arguments['<target-tarball>']))
+            sys.exit(0)
+
         # Make a local repository for build dependencies
         if arguments['tree']:
-            package_store = pkgpanda.build.PackageStore(getcwd(), arguments['--repository-url'])
-            pkgpanda.build.build_tree(package_store, arguments['--mkbootstrap'], arguments['<variant>'])
+            package_store = pkgpanda.build.PackageStore(
+                getcwd(),
+                arguments['--repository-url'],
+                get_build_cache(arguments['--build-cache']))
+            pkgpanda.build.build_tree(
+                package_store,
+                arguments['--mkbootstrap'],
+                arguments['<variant>'],
+                int(arguments['--jobs']))
             sys.exit(0)
 
         # Package name is the folder name.
         name = basename(getcwd())
 
         # Package store is always the parent directory
-        package_store = pkgpanda.build.PackageStore(normpath(getcwd() + '/../'), arguments['--repository-url'])
+        package_store = pkgpanda.build.PackageStore(
+            normpath(getcwd() + '/../'),
+            arguments['--repository-url'],
+            get_build_cache(arguments['--build-cache']))
 
         # Check that the folder is a package folder (the name was found by the package store as a
         # valid package with 1+ variants).
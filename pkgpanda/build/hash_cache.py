@@ -0,0 +1,66 @@
+"""Persistent cache of the SHA-1 of files.
+
+Computing a package's id hashes its build script and every file of its extra/
+folder, which for a whole tree adds up to a lot of reading for builds where
+nothing changed. The cache remembers the hash of each file along with its
+size, mtime and inode, and only hashes a file again once one of those changes.
+
+Files modified within HASH_CACHE_RACY_SECONDS of being hashed aren't cached,
+since a change made within the same mtime tick wouldn't be noticed.
+"""
+import os
+import threading
+import time
+
+from pkgpanda.constants import HASH_CACHE_RACY_SECONDS, HASH_JOBS
+from pkgpanda.util import if_exists, load_json, run_concurrently, sha1, write_json
+
+
+class HashCache:
+
+    def __init__(self, filename):
+        self.__filename = filename
+        self.__lock = threading.Lock()
+        # path -> [size, mtime_ns, inode, sha1]
+        self.__entries = if_exists(load_json, filename) or {}
+        self.__dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def sha1(self, path):
+        """Return the sha1 of the file at path, from the cache if it hasn't changed."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = [st.st_size, st.st_mtime_ns, st.st_ino]
+        with self.__lock:
+            entry = self.__entries.get(path)
+            if entry is not None and entry[:3] == key:
+                self.hits += 1
+                return entry[3]
+            self.misses += 1
+
+        file_sha1 = sha1(path)
+        if time.time() - st.st_mtime >= HASH_CACHE_RACY_SECONDS:
+            with self.__lock:
+                self.__entries[path] = key + [file_sha1]
+                self.__dirty = True
+        return file_sha1
+
+    def sha1_files(self, paths, jobs=HASH_JOBS):
+        """Return a dict of path to the sha1 of each of paths, hashing `jobs` files at once."""
+        return {path: file_sha1 for path, file_sha1, _ in run_concurrently(self.sha1, paths, jobs)}
+
+    def save(self):
+        """Write the cache out if anything was added, forgetting files which no longer exist."""
+        # Builds running in threads of the same process all save, the lock keeps
+        # them from sharing the temporary file.
+        with self.__lock:
+            if not self.__dirty:
+                return
+            self.__entries = {path: entry for path, entry in self.__entries.items() if os.path.exists(path)}
+            self.__dirty = False
+
+            os.makedirs(os.path.dirname(self.__filename), exist_ok=True)
+            tmp_filename = '{}.tmp-{}'.format(self.__filename, os.getpid())
+            write_json(tmp_filename, self.__entries)
+            os.rename(tmp_filename, self.__filename)
@@ -1,6 +1,10 @@
 import abc
+import fcntl
+import hashlib
 import os.path
+import re
 import shutil
+import subprocess
 from subprocess import CalledProcessError, check_call, check_output
 
 from pkgpanda.exceptions import ValidationError
@@ -70,7 +74,28 @@ def get_git_sha1(bare_folder, ref):
                 "Unable to find ref '{}' in '{}': {}".format(ref, bare_folder, ex)) from ex
 
 
+def git_cache_folder(cache_dir, git_uri):
+    """Return the bare repository in cache_dir shared by all the sources fetched from git_uri."""
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', git_uri.rstrip('/').split('/')[-1])
+    return "{}/{}-{}.git".format(cache_dir, name, hashlib.sha1(git_uri.encode()).hexdigest()[:12])
+
+
+def has_git_commit(bare_folder, ref):
+    if not os.path.exists(bare_folder):
+        return False
+    return subprocess.call(
+        ["git", "--git-dir", bare_folder, "cat-file", "-e", ref + "^{commit}"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL) == 0
+
+
 class GitSrcFetcher(SourceFetcher):
+    """Fetches sources from a bare mirror of the git repository.
+
+    cache_dir holds one mirror per repository url, so every package (and
+    variant) using the same repository shares its objects. The mirror is only
+    updated when it doesn't have the pinned ref yet."""
+
     def __init__(self, src_info, cache_dir):
         super().__init__(src_info)
 
@@ -87,18 +112,23 @@ class GitSrcFetcher(SourceFetcher):
         self.url = src_info['git']
         self.ref = src_info['ref']
         self.ref_origin = src_info['ref_origin']
-        self.bare_folder = cache_dir + "/cache.git".format()
+        self.bare_folder = git_cache_folder(cache_dir, self.url)
 
     def get_id(self):
         return {"commit": self.ref}
 
     def checkout_to(self, directory):
         # fetch into a bare repository so if we're on a host which has a cache we can
-        # only get the new commits.
-        fetch_git(self.bare_folder, self.url)
+        # only get the new commits. Builds running at the same time (or other
+        # mkpanda processes) may be using the same mirror.
+        os.makedirs(os.path.dirname(self.bare_folder), exist_ok=True)
+        with open(self.bare_folder + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not has_git_commit(self.bare_folder, self.ref):
+                fetch_git(self.bare_folder, self.url)
 
         # Warn if the ref_origin is set and gives a different sha1 than the
-        # current ref.
+        # current ref. The mirror is only as recent as the last fetch.
         try:
             origin_commit = get_git_sha1(self.bare_folder, self.ref_origin)
         except Exception as ex:
@@ -111,10 +141,13 @@ class GitSrcFetcher(SourceFetcher):
                 " Current: {}, Origin: {}".format(self.ref,
                                                   origin_commit))
 
-        # Clone into `src/`.
-        check_call(["git", "clone", "-q", self.bare_folder, directory])
-
-        # Checkout from the bare repo in the cache folder at the specific sha1
+        # Clone into `src/` without checking anything out, then check out only
+        # ref. Builds use git in `src/` (to describe the version, ...), so it
+        # has to be a repository of its own. A worktree of the mirror isn't
+        # enough since its `.git` points to the mirror, which isn't there when
+        # `src/` is mounted into the build container. A local clone hardlinks
+        # the mirror's objects rather than copying them.
+        check_call(["git", "clone", "-q", "--no-checkout", self.bare_folder, directory])
         check_call([
             "git",
             "--git-dir",
@@ -1,5 +1,7 @@
 import json
 import os
+import threading
+import time
 from shutil import copytree
 from subprocess import CalledProcessError, check_call, check_output
 
@@ -7,7 +9,11 @@ import pytest
 
 import pkgpanda.build
 import pkgpanda.build.cli
+from pkgpanda.build.build_cache import BuildCache
+from pkgpanda.build.hash_cache import HashCache
 from pkgpanda.util import expect_fs
+from release.storage import ReadOnlyProxy
+from release.storage.local import LocalStorageProvider
 
 
 def get_tar_contents(filename):
@@ -152,11 +158,11 @@ def test_bootstrap(tmpdir):
             './include/'}
 
         assert package_files == {
-            'url_extract-zip': {'pkginfo.json', 'buildinfo.full.json'},
-            'url_extract-tar': {'pkginfo.json', 'buildinfo.full.json'},
-            'single_source': {'pkginfo.json', 'buildinfo.full.json'},
-            'single_source_extra': {'pkginfo.json', 'buildinfo.full.json'},
-            'variant': {'pkginfo.json', 'buildinfo.full.json'},
+            'url_extract-zip': {'pkginfo.json', 'buildinfo.full.json', 'manifest.json'},
+            'url_extract-tar': {'pkginfo.json', 'buildinfo.full.json', 'manifest.json'},
+            'single_source': {'pkginfo.json', 'buildinfo.full.json', 'manifest.json'},
+            'single_source_extra': {'pkginfo.json', 'buildinfo.full.json', 'manifest.json'},
+            'variant': {'pkginfo.json', 'buildinfo.full.json', 'manifest.json'},
             'base': {
                 'base',
                 'bin/',
@@ -166,5 +172,186 @@ def test_bootstrap(tmpdir):
                 'buildinfo.full.json',
                 'bin/mesos-master',
                 'pkginfo.json',
+                'manifest.json',
                 'lib/',
                 'lib/libmesos.so'}}
+
+
+def test_schedule_builds():
+    build_order = [('a', None), ('b', None), ('b', 'x'), ('c', None), ('d', None), ('e', None)]
+    requires = {
+        ('a', None): set(),
+        ('b', None): {('a', None)},
+        ('b', 'x'): {('a', None)},
+        ('c', None): set(),
+        ('d', None): {('c', None)},
+        ('e', None): {('b', None), ('d', None)},
+    }
+    lock = threading.Lock()
+    running = set()
+    overlapped = []
+
+    def build_fn(pkg_tuple):
+        with lock:
+            # Requires are built first, variants of a package one at a time.
+            assert all(require not in running for require in requires[pkg_tuple])
+            assert pkg_tuple[0] not in {name for name, _ in running}
+            running.add(pkg_tuple)
+            overlapped.append(len(running) > 1)
+        time.sleep(0.05)
+        with lock:
+            running.remove(pkg_tuple)
+        if pkg_tuple == ('c', None):
+            raise Exception("c failed")
+        return pkg_tuple[0] + '.tar.xz'
+
+    with pytest.raises(pkgpanda.build.BuildError) as excinfo:
+        pkgpanda.build.schedule_builds(build_order, requires, build_fn, 4)
+    # Packages requiring the failed one aren't built, unrelated ones are.
+    assert str(excinfo.value) == (
+        "Failed building: c variant <default>. "
+        "Not built because a requirement failed: d variant <default>, e variant <default>")
+    assert any(overlapped)
+
+    results = pkgpanda.build.schedule_builds(build_order[:3], requires, build_fn, 1)
+    assert results == {('a', None): 'a.tar.xz', ('b', None): 'b.tar.xz', ('b', 'x'): 'b.tar.xz'}
+
+
+def test_hash_cache(tmpdir):
+    extra = tmpdir.join("extra")
+    extra.ensure("a").write("a")
+    extra.ensure("sub", "b").write("b")
+    # Old enough for the hashes to be cached.
+    for path in extra.visit():
+        if path.isfile():
+            os.utime(str(path), (0, 0))
+
+    cache = HashCache(str(tmpdir.join("cache", "hashes.json")))
+    expected = pkgpanda.build.hash_folder(str(extra))
+    assert pkgpanda.build.hash_folder(str(extra), cache) == expected
+    assert cache.misses == 2
+    cache.save()
+
+    # A new cache loads the hashes, until a file changes.
+    cache = HashCache(str(tmpdir.join("cache", "hashes.json")))
+    assert pkgpanda.build.hash_folder(str(extra), cache) == expected
+    assert (cache.hits, cache.misses) == (2, 0)
+    extra.join("a").write("changed")
+    assert pkgpanda.build.hash_folder(str(extra), cache) != expected
+    assert cache.misses == 1
+
+
+def test_hash_cache_concurrent_save(tmpdir):
+    # Parallel tree builds share the cache and save it from several threads.
+    cache = HashCache(str(tmpdir.join("cache", "hashes.json")))
+    paths = []
+    for i in range(80):
+        path = tmpdir.join("extra", str(i))
+        path.write(str(i), ensure=True)
+        os.utime(str(path), (0, 0))
+        paths.append(str(path))
+    errors = []
+
+    def hash_and_save(paths):
+        try:
+            for path in paths:
+                cache.sha1(path)
+                cache.save()
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=hash_and_save, args=(paths[i::4],)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    cache = HashCache(str(tmpdir.join("cache", "hashes.json")))
+    cache.sha1_files(paths)
+    assert (cache.hits, cache.misses) == (80, 0)
+
+
+def test_docker_id_memoized(tmpdir, monkeypatch):
+    inspected = []
+
+    def get_docker_id(docker_name):
+        inspected.append(docker_name)
+        return 'sha256:' + docker_name
+
+    monkeypatch.setattr(pkgpanda.build, 'get_docker_id', get_docker_id)
+    copytree("resources/", str(tmpdir.join("packages")))
+    package_store = pkgpanda.build.PackageStore(str(tmpdir.join("packages")), None)
+    assert package_store.get_docker_id('ubuntu:14.04') == 'sha256:ubuntu:14.04'
+    assert package_store.get_docker_id('ubuntu:14.04') == 'sha256:ubuntu:14.04'
+    assert package_store.get_docker_id('centos:7') == 'sha256:centos:7'
+    assert inspected == ['ubuntu:14.04', 'centos:7']
+
+
+def test_git_src_fetcher(tmpdir):
+    repo = str(tmpdir.join("repo"))
+
+    def commit(filename):
+        tmpdir.join("repo", filename).write(filename, ensure=True)
+        check_call(["git", "-C", repo, "add", filename])
+        check_call(["git", "-C", repo, "-c", "user.name=test", "-c", "user.email=test@example.com",
+                    "commit", "-q", "-m", filename])
+        return check_output(["git", "-C", repo, "rev-parse", "HEAD"]).decode().strip()
+
+    check_call(["git", "init", "-q", repo])
+    first = commit("a")
+    second = commit("b")
+
+    def checkout(ref, name):
+        fetcher = pkgpanda.build.src_fetchers.GitSrcFetcher(
+            {'kind': 'git', 'git': 'file://' + repo, 'ref': ref, 'ref_origin': 'HEAD'},
+            str(tmpdir.join("cache")))
+        fetcher.checkout_to(str(tmpdir.join(name)))
+        return sorted(os.listdir(str(tmpdir.join(name))))
+
+    assert checkout(first, "src1") == [".git", "a"]
+    assert checkout(second, "src2") == [".git", "a", "b"]
+    # Builds can use git in src/, at ref.
+    assert check_output(["git", "-C", str(tmpdir.join("src1")), "rev-parse", "HEAD"]).decode().strip() == first
+
+    # The packages share one mirror, which isn't updated while it has the ref.
+    assert len(tmpdir.join("cache").listdir(lambda path: path.ext == '.git')) == 1
+    tmpdir.join("repo").remove()
+    assert checkout(first, "src3") == [".git", "a"]
+
+
+def test_build_cache(tmpdir):
+    storage = LocalStorageProvider(str(tmpdir.join("storage")))
+    build_cache = BuildCache(storage)
+    pkg_id = pkgpanda.PackageId("base--0123456789abcdef")
+    tarball = tmpdir.join("base--0123456789abcdef.tar.xz")
+    tarball.write("package")
+
+    # Nothing is listed as cached until uploaded, uploads only happen once.
+    assert not build_cache.fetch_package(pkg_id, str(tmpdir.join("fetched")))
+    build_cache.upload_package(pkg_id, str(tarball))
+    assert storage.exists("packages/base/base--0123456789abcdef.tar.xz")
+    tarball.write("changed")
+    build_cache.upload_package(pkg_id, str(tarball))
+    assert storage.fetch("packages/base/base--0123456789abcdef.tar.xz") == b"package"
+
+    # Another builder gets the package instead of building it.
+    copytree("resources/", str(tmpdir.join("packages")))
+    package_store = pkgpanda.build.PackageStore(str(tmpdir.join("packages")), None, BuildCache(storage))
+    path = package_store.try_fetch_by_id(pkg_id)
+    assert path == package_store.get_package_path(pkg_id)
+    assert open(path).read() == "package"
+    assert not package_store.try_fetch_by_id(pkgpanda.PackageId("base--missing"))
+
+    # Artifacts without a sha1, whose upload didn't complete, aren't hits.
+    # Ones which don't match their sha1 aren't used.
+    storage.upload("packages/base/base--partial.tar.xz", blob=b"pack")
+    assert not BuildCache(storage).fetch_package(pkgpanda.PackageId("base--partial"), str(tmpdir.join("partial")))
+    storage.upload("packages/base/base--partial.tar.xz.sha1", blob=b"0" * 40)
+    assert not BuildCache(storage).fetch_package(pkgpanda.PackageId("base--partial"), str(tmpdir.join("partial")))
+    assert not tmpdir.join("partial").check()
+
+    # Read only caches are only downloaded from.
+    read_only = BuildCache(ReadOnlyProxy(storage))
+    read_only.upload_package(pkgpanda.PackageId("base--new"), str(tarball))
+    assert not storage.exists("packages/base/base--new.tar.xz")
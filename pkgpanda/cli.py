@@ -10,7 +10,9 @@ Usage:
   pkgpanda remove <id>... [options]
   pkgpanda setup [options]
   pkgpanda uninstall [options]
-  pkgpanda check [--list] [options]
+  pkgpanda check [--list] [--json] [--max-age=<seconds>] [options]
+  pkgpanda check-integrity [<id>...] [--full] [options]
+  pkgpanda gc [--dry-run] [--json] [--keep=<n>] [--min-age=<seconds>] [options]
 
 Options:
     --config-dir=<conf-dir>     Use an alternate directory for finding machine
@@ -20,20 +22,38 @@ Options:
     --root=<root>               Testing only: Use an alternate root [default: {default_root}]
     --repository=<repository>   Testing only: Use an alternate local package
                                 repository directory [default: {default_repository}]
+    --jobs=<jobs>               Number of packages to fetch, check or remove, or of checks
+                                to run, at once [default: {default_jobs}]
+    --full                      Check the contents of package files, not just their size and mtime
+    --json                      Print the results of checks as JSON
+    --check-timeout=<seconds>   Kill checks which run for longer [default: {default_check_timeout}]
+    --max-age=<seconds>         Reuse the last results of checks if they are at most this old
+    --results-file=<path>       Where the last results of checks are kept [default: {default_check_results}]
+    --dry-run                   Only show which packages would be removed
+    --keep=<n>                  Keep the packages of this many recent active sets [default: {default_gc_keep}]
+    --min-age=<seconds>         Keep packages added to the repository more recently [default: {default_gc_min_age}]
+    --repository-url=<url>      URL of the remote package repository. Several
+                                mirrors of it may be given separated by commas.
     --rooted-systemd            Use $ROOT/dcos.target.wants for systemd management
                                 rather than /etc/systemd/system/dcos.target.wants
 """
 
+import json
+import logging
 import os
+import signal
 import sys
+import time
+from functools import partial
 from itertools import groupby
 from os import umask
-from subprocess import CalledProcessError, check_call
+from subprocess import check_call, PIPE, Popen, TimeoutExpired
 
 from docopt import docopt
 
 from pkgpanda import actions, constants, Install, PackageId, Repository
 from pkgpanda.exceptions import PackageError, PackageNotFound, ValidationError
+from pkgpanda.util import if_exists, load_json, run_concurrently, write_json
 
 
 def print_repo_list(packages):
@@ -69,7 +89,8 @@ def uninstall(install, repository):
     new_names = [name + '.new' for name in active_names]
     old_names = [name + '.old' for name in active_names]
 
-    all_names = active_names + new_names + old_names
+    all_names = active_names + new_names + old_names + [
+        install.get_history_filename(), install.get_state_ownership_filename()]
 
     assert len(all_names) > 0
 
@@ -85,52 +106,162 @@ def uninstall(install, repository):
 
 
 def find_checks(install, repository):
+    """Return a dictionary of active package id to the paths of the package's checks."""
     checks = {}
     for active_package in install.get_active():
-        tmp_checks = {}
-        tmp_checks[active_package] = []
         package_check_dir = repository.load(active_package).check_dir
         if not os.path.isdir(package_check_dir):
             continue
+        check_paths = []
         for check_file in sorted(os.listdir(package_check_dir)):
-            if not os.access(os.path.join(package_check_dir, check_file), os.X_OK):
+            check_path = os.path.join(package_check_dir, check_file)
+            if not os.access(check_path, os.X_OK):
                 print('WARNING: `{}` is not executable'.format(check_file), file=sys.stderr)
                 continue
-            tmp_checks[active_package].append(check_file)
-        if tmp_checks[active_package]:
-            checks.update(tmp_checks)
+            check_paths.append(check_path)
+        if check_paths:
+            checks[active_package] = check_paths
     return checks
 
 
 def list_checks(checks):
-    for check_dir, check_files in sorted(checks.items()):
+    for check_dir, check_paths in sorted(checks.items()):
         print('{}'.format(check_dir))
-        for check_file in check_files:
-            print(' - {}'.format(check_file))
+        for check_path in check_paths:
+            print(' - {}'.format(os.path.basename(check_path)))
 
 
-def run_checks(checks, install, repository):
+def run_check(check, timeout):
+    """Run the check (package id, check path), returning its result."""
+    pkg_id, check_path = check
+    start = time.monotonic()
+    # The check runs in its own process group so everything it started can be
+    # killed on timeout, not only the check itself.
+    proc = Popen([check_path], stdout=PIPE, stderr=PIPE, start_new_session=True)
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+        status = 'ok' if proc.returncode == 0 else 'failed'
+    except TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        stdout, stderr = proc.communicate()
+        status = 'timeout'
+    return {
+        'package': pkg_id,
+        'check': os.path.basename(check_path),
+        'status': status,
+        'returncode': proc.returncode,
+        'duration': time.monotonic() - start,
+        'stdout': stdout.decode('utf-8', 'replace'),
+        'stderr': stderr.decode('utf-8', 'replace'),
+    }
+
+
+def run_checks(checks, jobs, timeout):
+    """Run all the checks, `jobs` at a time, returning their results in package and check order."""
+    all_checks = [(pkg_id, check_path)
+                  for pkg_id, check_paths in sorted(checks.items())
+                  for check_path in check_paths]
+    results = dict()
+    for check, result, _ in run_concurrently(partial(run_check, timeout=timeout), all_checks, jobs):
+        results[check] = result
+    return [results[check] for check in all_checks]
+
+
+def print_check_results(results, timeout):
+    """Replay the output of the checks as if they ran one after another, returning the exit code."""
+    exit_code = 0
+    for result in results:
+        sys.stdout.write(result['stdout'])
+        sys.stderr.write(result['stderr'])
+        if result['status'] == 'failed':
+            print('Check failed: {}'.format(result['check']))
+            exit_code = 1
+        elif result['status'] == 'timeout':
+            print('Check timed out after {}s: {}'.format(timeout, result['check']))
+            exit_code = 1
+    return exit_code
+
+
+def check_packages(install, repository, arguments):
+    timeout = float(arguments['--check-timeout'])
+    results = None
+    results_file = arguments['--results-file']
+    max_age = arguments['--max-age']
+    if max_age is not None:
+        # Monitoring calls this often, reuse recent enough results.
+        cached = if_exists(load_json, results_file)
+        if cached is not None and time.time() - cached['time'] <= float(max_age):
+            results = cached['results']
+
+    if results is None:
+        results = run_checks(find_checks(install, repository), int(arguments['--jobs']), timeout)
+        if max_age is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(results_file)), exist_ok=True)
+            write_json(results_file + '.tmp', {'time': time.time(), 'results': results})
+            os.rename(results_file + '.tmp', results_file)
+
+    if arguments['--json']:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return int(any(result['status'] != 'ok' for result in results))
+    return print_check_results(results, timeout)
+
+
+def check_integrity(repository, ids, full, jobs):
     exit_code = 0
-    for pkg_id, check_files in sorted(checks.items()):
-        check_dir = repository.load(pkg_id).check_dir
-        for check_file in check_files:
-            try:
-                check_call([os.path.join(check_dir, check_file)])
-            except CalledProcessError:
-                print('Check failed: {}'.format(check_file))
-                exit_code = 1
+    results = repository.integrity_check(ids or None, full, jobs)
+    for pkg_id, problems in sorted(results.items()):
+        if problems is None:
+            print('{}: no digests recorded'.format(pkg_id))
+        elif problems:
+            exit_code = 1
+            print('{}: FAILED'.format(pkg_id))
+            for problem in problems:
+                print('  {}'.format(problem))
+        else:
+            print('{}: OK'.format(pkg_id))
     return exit_code
 
 
+def collect_garbage(install, repository, arguments):
+    dry_run = arguments['--dry-run']
+    reclaimed = actions.collect_garbage(
+        install,
+        repository,
+        int(arguments['--keep']),
+        float(arguments['--min-age']),
+        dry_run,
+        int(arguments['--jobs']))
+
+    if arguments['--json']:
+        print(json.dumps({
+            'dry_run': dry_run,
+            'removed': sorted(reclaimed),
+            'reclaimed_bytes': sum(reclaimed.values()),
+        }, indent=2, sort_keys=True))
+        return
+
+    for pkg_id, size in sorted(reclaimed.items()):
+        print('{} {} ({} bytes)'.format('Would remove' if dry_run else 'Removed', pkg_id, size))
+    print('{} {} bytes'.format('Would reclaim' if dry_run else 'Reclaimed', sum(reclaimed.values())))
+
+
 def main():
     arguments = docopt(
         __doc__.format(
             default_config_dir=constants.config_dir,
             default_root=constants.install_root,
             default_repository=constants.repository_base,
+            default_jobs=constants.DEFAULT_FETCH_JOBS,
+            default_check_timeout=constants.CHECK_TIMEOUT,
+            default_check_results=constants.CHECK_RESULTS_FILE,
+            default_gc_keep=constants.GC_KEEP_HISTORY,
+            default_gc_min_age=constants.GC_MIN_AGE,
         ),
     )
     umask(0o022)
+    # Timings of stopping, starting and chowning go to stderr alongside the
+    # rest of the output.
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
 
     # NOTE: Changing root or repository will likely break actually running packages.
     install = Install(
@@ -164,12 +295,12 @@ def main():
             sys.exit(0)
 
         if arguments['fetch']:
-            for package_id in arguments['<id>']:
-                actions.fetch_package(
-                    repository,
-                    arguments['--repository-url'],
-                    package_id,
-                    os.getcwd())
+            actions.fetch_packages(
+                repository,
+                arguments['--repository-url'],
+                arguments['<id>'],
+                os.getcwd(),
+                int(arguments['--jobs']))
             sys.exit(0)
 
         if arguments['activate']:
@@ -202,13 +333,19 @@ def main():
             uninstall(install, repository)
             sys.exit(0)
 
+        if arguments['gc']:
+            collect_garbage(install, repository, arguments)
+            sys.exit(0)
+
+        if arguments['check-integrity']:
+            sys.exit(check_integrity(repository, arguments['<id>'], arguments['--full'], int(arguments['--jobs'])))
+
         if arguments['check']:
-            checks = find_checks(install, repository)
             if arguments['--list']:
-                list_checks(checks)
+                list_checks(find_checks(install, repository))
                 sys.exit(0)
             # Run all checks
-            sys.exit(run_checks(checks, install, repository))
+            sys.exit(check_packages(install, repository, arguments))
     except ValidationError as ex:
         print("Validation Error: {0}".format(ex))
         sys.exit(1)
@@ -8,6 +8,68 @@ DCOS_SERVICE_CONFIGURATION_FILE = "dcos-service-configuration.json"
 DCOS_SERVICE_CONFIGURATION_PATH = "/opt/mesosphere/etc/" + DCOS_SERVICE_CONFIGURATION_FILE
 SYSCTL_SETTING_KEY = "sysctl"
 
+# Listing of the contents of a package, see pkgpanda.make_manifest.
+PACKAGE_MANIFEST_FILE = "manifest.json"
+
+# Digests of the files of a package, see pkgpanda.Repository.integrity_check.
+PACKAGE_DIGESTS_FILE = "digests.json"
+
+# Retries of a failed download, the first after DOWNLOAD_BACKOFF seconds then
+# doubling each time. See pkgpanda.util.download.
+DOWNLOAD_RETRIES = 4
+DOWNLOAD_BACKOFF = 1
+# Seconds to wait for the server to respond / send more data.
+DOWNLOAD_TIMEOUT = 60
+# Bytes read from the server at a time. An interrupted read loses what it had
+# received, so this is also the most a retry has to fetch again.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Compression of the tarballs pkgpanda makes, overridden by the environment
+# variable. See pkgpanda.util.CODECS. Extraction detects the compression, so
+# tarballs keep their .tar.xz names whatever they are compressed with.
+COMPRESSION_ENV = "PKGPANDA_COMPRESSION"
+DEFAULT_COMPRESSION = "xz"
+
+# Seconds to wait for a repository mirror to answer when measuring its latency.
+MIRROR_PROBE_TIMEOUT = 5
+# Seconds a repository mirror which failed is avoided for, see pkgpanda.mirrors.
+MIRROR_RETRY_AFTER = 60
+
+# Number of packages to download / extract at once.
+DEFAULT_FETCH_JOBS = 4
+
+# Number of systemd units to stop at once when swapping the active set.
+SYSTEMD_JOBS = 8
+
+# Number of package state directories to chown at once on activation.
+CHOWN_JOBS = 4
+
+# Number of threads scanning directories in pkgpanda.util.rewrite_symlinks.
+REWRITE_SYMLINKS_JOBS = 8
+
+# Number of previous active sets recorded by pkgpanda.Install.activate.
+ACTIVE_HISTORY_SIZE = 10
+# `pkgpanda gc` keeps the packages of this many of the most recent active sets,
+# as well as any package added to the repository less than GC_MIN_AGE seconds
+# ago (it may have been fetched for an upcoming activation).
+GC_KEEP_HISTORY = 3
+GC_MIN_AGE = 24 * 60 * 60
+
+# Seconds a package check may run for before `pkgpanda check` kills it.
+CHECK_TIMEOUT = 60
+# Where `pkgpanda check --max-age` keeps the last results.
+CHECK_RESULTS_FILE = "/var/lib/dcos/pkgpanda/check-results.json"
+
+# Shared package tarball cache, see pkgpanda.package_cache.
+PACKAGE_CACHE_DIR_ENV = "PKGPANDA_PACKAGE_CACHE"
+PACKAGE_CACHE_MAX_SIZE_ENV = "PKGPANDA_PACKAGE_CACHE_MAX_SIZE"
+PACKAGE_CACHE_MAX_SIZE = 10 * 1024 ** 3
+
+# Number of files mkpanda hashes at once, see pkgpanda.build.hash_cache.
+HASH_JOBS = 8
+# Files modified less than this many seconds before being hashed aren't cached.
+HASH_CACHE_RACY_SECONDS = 2
+
 config_dir = '/etc/mesosphere'
 install_root = '/opt/mesosphere'
 repository_base = '/opt/mesosphere/packages'
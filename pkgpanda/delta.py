@@ -0,0 +1,188 @@
+"""File level deltas between two versions of a package.
+
+A delta turns an extracted base package into an extracted target package. It
+is a tarball containing:
+
+    delta.json    {"base": <base id>, "target": <target id>,
+                   "removed": [paths of base which target doesn't have as is],
+                   "digest": tree_digest() of the target package}
+    files/        every file, symlink and directory of target which is new or
+                  differs from base
+
+Files and symlinks which changed, and paths whose type changed (file to
+directory, ...), are both removed and added.
+
+Applying a delta checks the result against the target's digest, so a delta
+applied to the wrong or a modified base fails rather than producing a broken
+package.
+
+Deltas are published in the repository next to the package tarballs as
+packages/<name>/<target id>.from-<base id>.delta.tar.xz, see
+pkgpanda.requests_fetcher.
+"""
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+from subprocess import check_call
+
+from pkgpanda.constants import PACKAGE_DIGESTS_FILE
+from pkgpanda.exceptions import ValidationError
+from pkgpanda.util import extract_tarball, load_json, make_tar, sha1, write_json
+
+DELTA_INFO_FILE = "delta.json"
+
+
+def delta_filename(base_id, target_id):
+    return "{}.from-{}.delta.tar.xz".format(target_id, base_id)
+
+
+def _tree(path):
+    """Return a dictionary of path relative to path to (kind, mode, content) for everything under path.
+
+    content is the sha1 of files and the target of symlinks. The digests pkgpanda
+    records for a package in the repository aren't part of the package."""
+    tree = dict()
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            full_path = os.path.join(root, name)
+            rel_path = os.path.relpath(full_path, path)
+            if rel_path == PACKAGE_DIGESTS_FILE:
+                continue
+            st = os.lstat(full_path)
+            mode = stat.S_IMODE(st.st_mode)
+            if stat.S_ISLNK(st.st_mode):
+                tree[rel_path] = ('l', 0, os.readlink(full_path))
+            elif stat.S_ISDIR(st.st_mode):
+                tree[rel_path] = ('d', mode, '')
+            else:
+                tree[rel_path] = ('f', mode, sha1(full_path))
+    return tree
+
+
+def tree_digest(path):
+    """Return the sha1 of the names, types, permissions and contents of everything under path."""
+    hasher = hashlib.sha1()
+    for rel_path, (kind, mode, content) in sorted(_tree(path).items()):
+        hasher.update("{} {:o} {}\0{}\0".format(kind, mode, rel_path, content).encode())
+    return hasher.hexdigest()
+
+
+def make_delta(base_id, base_path, target_id, target_path, out_filename):
+    """Write the delta turning the extracted package base_path into target_path to out_filename."""
+    base = _tree(base_path)
+    target = _tree(target_path)
+    removed = sorted(
+        rel_path for rel_path, entry in base.items()
+        if rel_path not in target or target[rel_path][0] != entry[0] or
+        (entry[0] != 'd' and target[rel_path] != entry))
+
+    with tempfile.TemporaryDirectory() as staging:
+        files_dir = os.path.join(staging, 'files')
+
+        # Directories are copied with their permissions, since applying the
+        # delta copies them over the ones of the base package.
+        def make_dir(rel_path):
+            dest = os.path.join(files_dir, rel_path)
+            if not os.path.isdir(dest):
+                if rel_path:
+                    make_dir(os.path.dirname(rel_path))
+                os.mkdir(dest)
+                shutil.copystat(os.path.join(target_path, rel_path), dest)
+
+        make_dir('')
+        for rel_path in sorted(target):
+            entry = target[rel_path]
+            if base.get(rel_path) == entry:
+                continue
+            src = os.path.join(target_path, rel_path)
+            dest = os.path.join(files_dir, rel_path)
+            if entry[0] == 'd':
+                make_dir(rel_path)
+                continue
+            make_dir(os.path.dirname(rel_path))
+            if entry[0] == 'l':
+                os.symlink(entry[2], dest)
+            else:
+                shutil.copy2(src, dest)
+
+        write_json(os.path.join(staging, DELTA_INFO_FILE), {
+            'base': base_id,
+            'target': target_id,
+            'removed': removed,
+            'digest': tree_digest(target_path),
+        })
+        make_tar(out_filename, staging)
+
+
+def _target_path(target, rel_path):
+    """Return the path of rel_path in target, raising ValidationError if it isn't inside target.
+
+    Like tar does for the members of a tarball, paths which are absolute or lead
+    up out of target are refused, as are ones whose parent is a symlink out of it."""
+    norm_path = os.path.normpath(rel_path)
+    if os.path.isabs(norm_path) or norm_path == '.' or norm_path.split(os.sep)[0] == '..':
+        raise ValidationError("Delta contains path {} which is outside the package".format(rel_path))
+    path = os.path.join(target, norm_path)
+    real_target = os.path.realpath(target)
+    real_parent = os.path.realpath(os.path.dirname(path))
+    if real_parent != real_target and not real_parent.startswith(real_target + os.sep):
+        raise ValidationError("Delta contains path {} which leads outside the package".format(rel_path))
+    return path
+
+
+def apply_delta(delta_path, base_id, base_path, target):
+    """Make target the package the extracted delta at delta_path turns base_path into.
+
+    Raises ValidationError if the delta isn't for base_id or the result doesn't
+    match the package the delta was made for. The caller is responsible for
+    cleaning up target on errors."""
+    info = load_json(os.path.join(delta_path, DELTA_INFO_FILE))
+    if info['base'] != base_id:
+        raise ValidationError("Delta is from {}, not {}".format(info['base'], base_id))
+    # Refuse paths which are outside the package before touching anything.
+    for rel_path in info['removed']:
+        _target_path(target, rel_path)
+
+    check_call(['cp', '-a', base_path, target])
+    digests_path = os.path.join(target, PACKAGE_DIGESTS_FILE)
+    if os.path.exists(digests_path):
+        os.remove(digests_path)
+
+    # Deepest first, so directories are removed after their contents.
+    for rel_path in sorted(info['removed'], reverse=True):
+        path = _target_path(target, rel_path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    files_path = os.path.join(delta_path, 'files')
+    for root, dirs, files in os.walk(files_path):
+        for name in dirs + files:
+            _target_path(target, os.path.relpath(os.path.join(root, name), files_path))
+    check_call(['cp', '-a', files_path + '/.', target])
+
+    if tree_digest(target) != info['digest']:
+        raise ValidationError("Applying the delta from {} to {} didn't produce {}".format(
+            base_id, info['target'], info['target']))
+
+
+def make_delta_tarball(base_tarball, target_tarball, out_dir=None):
+    """Make the delta between two package tarballs, named by their package ids.
+
+    The delta is written to out_dir, by default the directory of target_tarball.
+    Returns the path of the delta."""
+    base_id = os.path.basename(base_tarball)[:-len('.tar.xz')]
+    target_id = os.path.basename(target_tarball)[:-len('.tar.xz')]
+    out_dir = out_dir or os.path.dirname(os.path.abspath(target_tarball))
+    out_filename = os.path.join(out_dir, delta_filename(base_id, target_id))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        base_path = os.path.join(work_dir, 'base')
+        target_path = os.path.join(work_dir, 'target')
+        extract_tarball(base_tarball, base_path)
+        extract_tarball(target_tarball, target_path)
+        make_delta(base_id, base_path, target_id, target_path, out_filename)
+    return out_filename
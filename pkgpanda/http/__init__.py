@@ -1,22 +1,31 @@
 """Pkgpanda HTTP API"""
 
+import hashlib
 import http.client
 import logging
 import os
 import sys
+import threading
+from functools import partial
 
-from flask import current_app, Flask, jsonify, make_response, request
+from flask import current_app, Flask, jsonify, make_response, request, send_file
 
-from pkgpanda import actions, Install, Repository
-from pkgpanda.exceptions import (PackageConflict, PackageError,
+from pkgpanda import actions, Install, PackageId, Repository
+from pkgpanda.constants import GC_KEEP_HISTORY, GC_MIN_AGE
+from pkgpanda.exceptions import (InstallError, PackageConflict, PackageError,
                                  PackageNotFound, ValidationError)
+from pkgpanda.http.jobs import FAILED, JobStore, SUCCEEDED
+from pkgpanda.package_cache import get_package_cache
 
 
 empty_response = ('', http.client.NO_CONTENT)
 
 
 def package_listing_response(package_ids):
-    return jsonify(sorted(package_ids))
+    """Respond with the sorted package_ids, supporting conditional GETs with an ETag."""
+    response = jsonify(sorted(package_ids))
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    return response.make_conditional(request)
 
 
 def error_response(message, **kwargs):
@@ -70,6 +79,10 @@ def package_response(package_id, repository):
     return response
 
 
+# gunicorn only sets up its own loggers. Activation timings and job failures
+# go to stderr, which systemd puts in the journal.
+logging.basicConfig(level=logging.INFO, format='%(levelname)s %(name)s: %(message)s')
+
 app = Flask(__name__)
 app.config.from_object('pkgpanda.http.config')
 app.config.from_envvar('PKGPANDA_HTTP_CONFIG', silent=True)
@@ -86,21 +99,68 @@ def uncaught_exception_handler(exc):
     return exception_response(str(exc), exc)
 
 
-@app.before_request
-def set_app_attrs_from_config():
-    current_app.install = Install(
-        current_app.config['DCOS_ROOT'],
-        current_app.config['DCOS_CONFIG_DIR'],
-        current_app.config['DCOS_ROOTED_SYSTEMD'],
-        manage_systemd=True,
-        block_systemd=False)
-    current_app.repository = Repository(
-        current_app.config['DCOS_REPO_DIR'])
+# (Install, Repository) by the config they were made from. They are kept for
+# the lifetime of the process, both pick up changes made on disk by others.
+_state = dict()
+_state_lock = threading.Lock()
+
+# JobStore by jobs directory.
+_jobs = dict()
+
+# Work directories which have been created.
+_work_dirs = set()
+
+
+def get_state(config):
+    key = (
+        config['DCOS_ROOT'],
+        config['DCOS_CONFIG_DIR'],
+        config['DCOS_ROOTED_SYSTEMD'],
+        config['DCOS_REPO_DIR'])
+    with _state_lock:
+        if key not in _state:
+            install = Install(
+                config['DCOS_ROOT'],
+                config['DCOS_CONFIG_DIR'],
+                config['DCOS_ROOTED_SYSTEMD'],
+                manage_systemd=True,
+                block_systemd=False)
+            _state[key] = install, Repository(config['DCOS_REPO_DIR'])
+        return _state[key]
+
+
+def reconcile_activation(install, job):
+    """Work out how an activation job interrupted by the API restarting ended."""
+    try:
+        active = install.get_active()
+    except InstallError as ex:
+        # The swap itself was interrupted, the install needs recovering by hand.
+        return FAILED, "Interrupted by the pkgpanda API restarting during the {} stage: {}".format(job['stage'], ex)
+    if set(job['params']['packages']) == active:
+        return SUCCEEDED, None
+    return FAILED, "Interrupted by the pkgpanda API restarting during the {} stage.".format(job['stage'])
+
+
+def get_jobs(config, install):
+    with _state_lock:
+        if config['JOBS_DIR'] not in _jobs:
+            jobs = JobStore(config['JOBS_DIR'], config['JOBS_KEEP'])
+            jobs.reconcile(partial(reconcile_activation, install))
+            _jobs[config['JOBS_DIR']] = jobs
+        return _jobs[config['JOBS_DIR']]
+
+
+def get_work_dir():
+    work_dir = current_app.config['WORK_DIR']
+    if work_dir not in _work_dirs:
+        os.makedirs(work_dir, exist_ok=True)
+        _work_dirs.add(work_dir)
+    return work_dir
 
 
 @app.before_request
-def create_work_dir():
-    os.makedirs(current_app.config['WORK_DIR'], exist_ok=True)
+def set_app_attrs_from_config():
+    current_app.install, current_app.repository = get_state(current_app.config)
 
 
 @app.route('/repository/', methods=['GET'])
@@ -131,7 +191,9 @@ def fetch_package(package_id):
             current_app.repository,
             repository_url,
             package_id,
-            current_app.config['WORK_DIR'])
+            get_work_dir(),
+            sha1=request.json.get('sha1'),
+            peers=request.json.get('peers'))
     except ValidationError:
         response = (
             invalid_package_id_response(package_id),
@@ -143,6 +205,21 @@ def fetch_package(package_id):
     return response
 
 
+@app.route('/packages/<name>/<package_id>.tar.xz', methods=['GET'])
+def get_package_tarball(name, package_id):
+    """Serve a package tarball from the package cache to peers, see actions.fetch_packages.
+
+    The url matches the layout of a package repository, so the API can be used
+    as one."""
+    cache = get_package_cache()
+    path = None
+    if cache is not None and PackageId.is_id(package_id) and PackageId(package_id).name == name:
+        path = cache.get(package_id)
+    if path is None:
+        return package_not_found_response(package_id), http.client.NOT_FOUND
+    return send_file(path, mimetype='application/x-xz', conditional=True)
+
+
 @app.route('/repository/<package_id>', methods=['DELETE'])
 def remove_package(package_id):
     try:
@@ -214,20 +291,85 @@ def activate_packages():
             http.client.CONFLICT,
         )
 
-    # This will stop all DC/OS services, including this app. Use a web server
-    # that supports graceful shutdown to ensure that activation is completed
-    # and a response is returned.
+    # Reject sets which can't be activated before queuing the job, so the
+    # client finds out right away.
     try:
-        actions.activate_packages(
-            current_app.install,
-            current_app.repository,
-            request.json,
-            systemd=(not current_app.config.get('TESTING')),
-            block_systemd=False)
+        current_app.install.validate(current_app.repository.load_packages(request.json))
     except ValidationError as exc:
         return error_response(str(exc)), http.client.CONFLICT
 
-    return empty_response
+    # This will stop all DC/OS services, including this app, so it is done in
+    # the background. The job records how far activation got, including across
+    # this app restarting. Stopping this app waits for the job to finish, see
+    # dcos-pkgpanda-api.service.
+    package_ids = request.json
+    install = current_app.install
+    repository = current_app.repository
+    systemd = not current_app.config.get('TESTING')
+
+    def activate(progress):
+        actions.activate_packages(
+            install,
+            repository,
+            package_ids,
+            systemd=systemd,
+            block_systemd=False,
+            progress=progress)
+
+    job = get_jobs(current_app.config, install).submit('activate', {'packages': package_ids}, activate)
+    response = jsonify(job)
+    response.status_code = http.client.ACCEPTED
+    response.headers['Location'] = '/jobs/{}'.format(job['id'])
+    return response
+
+
+@app.route('/integrity/', methods=['GET'])
+def check_integrity():
+    """Check every package against its recorded digests. ?full=true hashes file contents."""
+    full = request.args.get('full', 'false').lower() in ('1', 'true')
+    return jsonify(current_app.repository.integrity_check(full=full))
+
+
+@app.route('/gc/', methods=['POST'])
+def collect_garbage():
+    """Remove packages which haven't been active recently, see actions.collect_garbage.
+
+    Takes the optional query parameters dry_run, keep and min_age."""
+    dry_run = request.args.get('dry_run', 'false').lower() in ('1', 'true')
+    try:
+        keep = int(request.args.get('keep', GC_KEEP_HISTORY))
+        min_age = float(request.args.get('min_age', GC_MIN_AGE))
+    except ValueError:
+        return error_response('keep and min_age must be numbers.'), http.client.BAD_REQUEST
+
+    # No activation may start while packages are being removed.
+    with get_jobs(current_app.config, current_app.install).exclusive() as idle:
+        if not idle:
+            return error_response('Packages are being activated, try again later.'), http.client.CONFLICT
+        reclaimed = actions.collect_garbage(
+            current_app.install,
+            current_app.repository,
+            keep,
+            min_age,
+            dry_run)
+    return jsonify({
+        'dry_run': dry_run,
+        'removed': sorted(reclaimed),
+        'reclaimed_bytes': sum(reclaimed.values()),
+    })
+
+
+@app.route('/jobs/', methods=['GET'])
+def get_job_list():
+    return jsonify([job['id'] for job in get_jobs(current_app.config, current_app.install).list()])
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = get_jobs(current_app.config, current_app.install).get(job_id)
+    if job is None:
+        return error_response('Job {} not found.'.format(job_id)), http.client.NOT_FOUND
+    return jsonify(job)
 
 
 if __name__ == '__main__':
@@ -10,3 +10,8 @@ DCOS_REPO_DIR = constants.repository_base
 DCOS_ROOTED_SYSTEMD = False
 
 WORK_DIR = os.path.join(tempfile.gettempdir(), 'pkgpanda_api')
+
+# Where activation jobs are kept. Must survive the API restarting.
+JOBS_DIR = '/var/lib/dcos/pkgpanda-api/jobs'
+# Number of finished jobs kept there.
+JOBS_KEEP = 100
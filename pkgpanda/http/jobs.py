@@ -0,0 +1,168 @@
+"""Background jobs for the pkgpanda HTTP API.
+
+Jobs run one at a time in a worker thread. Each job is persisted as a JSON
+file so its state can still be queried after the API restarts (which it does
+when activation restarts DC/OS services). A process with a job running waits
+for it before exiting. Jobs left unfinished by a restart anyway (for instance
+because the process was killed) are reconciled when the JobStore is created.
+
+Only the `keep` most recently updated finished jobs are kept, older ones are
+removed as new jobs are submitted. The API runs a single worker process, so
+the JobStore knows which jobs are pending or running without reading them.
+"""
+import atexit
+import copy
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from pkgpanda.util import if_exists, load_json, write_json
+
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+job_id_regex = '^[0-9a-f]{32}$'
+
+log = logging.getLogger(__name__)
+
+
+class JobStore:
+
+    def __init__(self, directory, keep=100):
+        self.__directory = os.path.abspath(directory)
+        self.__keep = keep
+        os.makedirs(self.__directory, exist_ok=True)
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+        atexit.register(self.__executor.shutdown)
+        # Held while submitting jobs, and by exclusive().
+        self.__submit_lock = threading.Lock()
+        # Ids of the jobs submitted which haven't finished yet.
+        self.__unfinished = set()
+        self.__unfinished_lock = threading.Lock()
+
+    def _path(self, job_id):
+        return os.path.join(self.__directory, job_id + '.json')
+
+    def _save(self, job):
+        # Write then rename so readers never see a partially written job.
+        job['updated'] = time.time()
+        tmp_path = self._path(job['id']) + '.tmp'
+        write_json(tmp_path, job)
+        os.rename(tmp_path, self._path(job['id']))
+
+    def get(self, job_id):
+        """Return the job with job_id, None if there isn't one."""
+        if not re.match(job_id_regex, job_id):
+            return None
+        return if_exists(load_json, self._path(job_id))
+
+    def list(self):
+        jobs = []
+        for name in os.listdir(self.__directory):
+            if name.endswith('.json'):
+                job = self.get(name[:-len('.json')])
+                if job is not None:
+                    jobs.append(job)
+        return sorted(jobs, key=lambda job: job['created'])
+
+    def submit(self, kind, params, fn):
+        """Queue fn to run in the background as a job, returning the job.
+
+        fn is called with a progress function, which it should call with the
+        name of each stage of the job as it starts. The job fails if fn raises.
+        """
+        job = {
+            'id': uuid.uuid4().hex,
+            'type': kind,
+            'params': params,
+            'state': PENDING,
+            'stage': None,
+            'stages': [],
+            'error': None,
+            'created': time.time(),
+        }
+        with self.__submit_lock:
+            with self.__unfinished_lock:
+                self.__unfinished.add(job['id'])
+            self._save(job)
+            # The worker updates job as it goes, hand back a copy.
+            submitted = copy.deepcopy(job)
+            self.__executor.submit(self._run, job, fn)
+            self._prune()
+        return submitted
+
+    def _prune(self):
+        """Remove all but the `keep` most recently updated finished jobs."""
+        with self.__unfinished_lock:
+            unfinished = set(self.__unfinished)
+        finished = []
+        for name in os.listdir(self.__directory):
+            if name.endswith('.json') and name[:-len('.json')] not in unfinished:
+                path = os.path.join(self.__directory, name)
+                try:
+                    finished.append((os.stat(path).st_mtime, path))
+                except FileNotFoundError:
+                    pass
+        finished.sort(reverse=True)
+        for _, path in finished[self.__keep:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def exclusive(self):
+        """Keep jobs from being submitted until the with block ends.
+
+        Yields whether no job is pending or running, in which case none will be
+        until the block ends."""
+        with self.__submit_lock:
+            with self.__unfinished_lock:
+                idle = not self.__unfinished
+            yield idle
+
+    def _finish_stage(self, job):
+        if job['stages'] and job['stages'][-1]['finished'] is None:
+            job['stages'][-1]['finished'] = time.time()
+
+    def _run(self, job, fn):
+        def progress(stage):
+            self._finish_stage(job)
+            job['stage'] = stage
+            job['stages'].append({'name': stage, 'started': time.time(), 'finished': None})
+            self._save(job)
+
+        job['state'] = RUNNING
+        self._save(job)
+        try:
+            fn(progress)
+        except Exception as ex:
+            log.exception("Job %s failed", job['id'])
+            job['state'] = FAILED
+            job['error'] = str(ex)
+        else:
+            job['state'] = SUCCEEDED
+        self._finish_stage(job)
+        self._save(job)
+        with self.__unfinished_lock:
+            self.__unfinished.discard(job['id'])
+
+    def reconcile(self, fn):
+        """Settle the jobs which were queued or running when the API last stopped.
+
+        fn is called with each such job and returns the state it should now be
+        in along with an error message (or None).
+        """
+        for job in self.list():
+            if job['state'] not in (PENDING, RUNNING):
+                continue
+            job['state'], job['error'] = fn(job)
+            self._finish_stage(job)
+            self._save(job)
@@ -0,0 +1,182 @@
+"""Mirrors of a package repository.
+
+A repository url may be an ordered list of mirrors (bootstrap servers, other
+masters, ...) separated by commas or whitespace. Each fetch goes to the mirror
+expected to serve it soonest: the one with the best measured latency and
+throughput, taking into account how many fetches it is already serving, so
+that concurrent fetches are spread over the healthy mirrors. The order the
+mirrors were given in breaks ties.
+
+A fetch which fails part way through is retried from the next mirror. Mirrors
+which fail are avoided for MIRROR_RETRY_AFTER seconds, unless every mirror
+has failed.
+"""
+import re
+import threading
+import time
+
+import requests
+
+from pkgpanda.constants import MIRROR_PROBE_TIMEOUT, MIRROR_RETRY_AFTER
+from pkgpanda.exceptions import FetchError
+from pkgpanda.util import run_concurrently
+
+# Size of a typical package tarball, used to weigh latency against throughput.
+TYPICAL_SIZE = 10 * 1024 ** 2
+
+
+class Mirror:
+
+    def __init__(self, url, index):
+        self.url = url
+        self.index = index
+        # Exponentially weighted averages, None until measured.
+        self.latency = None
+        self.throughput = None
+        self.in_flight = 0
+        self.failed_at = None
+
+    def expected_seconds(self):
+        """Seconds a typical fetch is expected to take, None if it hasn't been measured."""
+        if self.latency is None and self.throughput is None:
+            return None
+        seconds = self.latency or 0
+        if self.throughput:
+            seconds += TYPICAL_SIZE / self.throughput
+        return seconds
+
+    def healthy(self, now):
+        return self.failed_at is None or now - self.failed_at >= MIRROR_RETRY_AFTER
+
+    def update_latency(self, seconds):
+        self.latency = seconds if self.latency is None else (self.latency + seconds) / 2
+
+    def update_throughput(self, bytes_per_second):
+        self.throughput = bytes_per_second if self.throughput is None else (self.throughput + bytes_per_second) / 2
+
+
+def _is_client_error(ex):
+    """Return True if ex is the mirror saying it doesn't have something, rather than the mirror being broken."""
+    base = getattr(ex, 'base_exception', None)
+    if isinstance(base, FileNotFoundError):
+        # A file:// mirror.
+        return True
+    return (isinstance(base, requests.exceptions.HTTPError) and base.response is not None and
+            400 <= base.response.status_code < 500)
+
+
+class MirrorSet:
+
+    def __init__(self, urls):
+        urls = [url.strip().rstrip('/') for url in urls]
+        urls = [url for url in urls if url]
+        if not urls:
+            raise ValueError("At least one repository url is required")
+        self.__lock = threading.Lock()
+        self.__mirrors = [Mirror(url, index) for index, url in enumerate(urls)]
+
+    @classmethod
+    def parse(cls, urls):
+        """Return the MirrorSet of a string of urls separated by commas or whitespace."""
+        return cls(re.split(r'[\s,]+', urls))
+
+    @property
+    def urls(self):
+        return [mirror.url for mirror in self.__mirrors]
+
+    def __len__(self):
+        return len(self.__mirrors)
+
+    def probe(self, timeout=MIRROR_PROBE_TIMEOUT):
+        """Measure the latency of every http(s) mirror, marking the unreachable ones as failed."""
+        def probe_one(mirror):
+            start = time.monotonic()
+            try:
+                requests.head(mirror.url + '/', timeout=timeout)
+                return time.monotonic() - start
+            except requests.exceptions.RequestException as ex:
+                print("Repository mirror {} is unreachable: {}".format(mirror.url, ex))
+                return None
+
+        remote = [mirror for mirror in self.__mirrors if mirror.url.startswith(('http://', 'https://'))]
+        for mirror, seconds, _ in run_concurrently(probe_one, remote, len(remote)):
+            with self.__lock:
+                if seconds is None:
+                    mirror.failed_at = time.monotonic()
+                else:
+                    mirror.update_latency(seconds)
+                    mirror.failed_at = None
+
+    def _rank(self, tried):
+        """Return the untried mirrors, best first."""
+        now = time.monotonic()
+
+        def key(mirror):
+            seconds = mirror.expected_seconds()
+            if seconds is None:
+                # Unmeasured mirrors are assumed to be as good as any other,
+                # but are still spread over by the fetches they are serving.
+                seconds = 1
+            return (not mirror.healthy(now), (mirror.in_flight + 1) * seconds, mirror.index)
+
+        return sorted((mirror for mirror in self.__mirrors if mirror.url not in tried), key=key)
+
+    def fetch(self, fn):
+        """Call fn(base_url, tee) with mirrors in turn until one call succeeds, returning its result.
+
+        tee wraps the iterator of downloaded chunks, so that the throughput of
+        the mirror can be measured. fn should raise FetchError if the mirror
+        fails; once every mirror has failed the last FetchError is raised.
+        """
+        tried = set()
+        error = None
+        while True:
+            with self.__lock:
+                candidates = self._rank(tried)
+                if not candidates:
+                    raise error
+                mirror = candidates[0]
+                mirror.in_flight += 1
+            tried.add(mirror.url)
+
+            received = [0]
+
+            def tee(chunks):
+                for chunk in chunks:
+                    received[0] += len(chunk)
+                    yield chunk
+
+            start = time.monotonic()
+            try:
+                result = fn(mirror.url, tee)
+            except FetchError as ex:
+                error = ex
+                if _is_client_error(ex):
+                    continue
+                with self.__lock:
+                    mirror.failed_at = time.monotonic()
+                if len(tried) < len(self.__mirrors):
+                    print("Fetch from mirror {} failed, trying the next mirror: {}".format(mirror.url, ex))
+                continue
+            finally:
+                with self.__lock:
+                    mirror.in_flight -= 1
+
+            seconds = time.monotonic() - start
+            with self.__lock:
+                mirror.failed_at = None
+                if received[0] and seconds > 0:
+                    mirror.update_throughput(received[0] / seconds)
+            return result
+
+
+def get_mirrors(repository_url):
+    """Return repository_url as a MirrorSet.
+
+    repository_url may be a MirrorSet, a list of urls or a string of urls
+    separated by commas or whitespace."""
+    if isinstance(repository_url, MirrorSet):
+        return repository_url
+    if isinstance(repository_url, str):
+        return MirrorSet.parse(repository_url)
+    return MirrorSet(repository_url)
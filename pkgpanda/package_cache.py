@@ -0,0 +1,168 @@
+"""Content-addressed cache of package tarballs.
+
+Tarballs are stored as `<cache>/<name>/<package-id>.<sha1>.tar.xz`, so the same
+package id with different contents can never be confused. The cache is safe to
+share between repositories, tools and (over a shared filesystem) hosts: entries
+are only ever added by an atomic rename and never modified afterwards.
+
+When the total size of the cache goes over its limit the least recently used
+tarballs (by mtime, which is bumped on every hit) are removed.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+
+from pkgpanda import PackageId
+from pkgpanda.constants import (PACKAGE_CACHE_DIR_ENV, PACKAGE_CACHE_MAX_SIZE,
+                                PACKAGE_CACHE_MAX_SIZE_ENV)
+from pkgpanda.exceptions import ValidationError
+from pkgpanda.util import link_or_copy, sha1
+
+
+class PackageCache:
+
+    def __init__(self, path, max_size=PACKAGE_CACHE_MAX_SIZE):
+        self.__path = os.path.abspath(path)
+        self.__max_size = max_size
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self):
+        return self.__path
+
+    @staticmethod
+    def entry_sha1(path):
+        """Return the sha1 of the tarball at path, a path returned by get() or add()."""
+        return os.path.basename(path)[-len('.tar.xz') - 40:-len('.tar.xz')]
+
+    def _entry_path(self, id_str, sha1):
+        return os.path.join(self.__path, PackageId(id_str).name, '{}.{}.tar.xz'.format(id_str, sha1))
+
+    def _count(self, hit):
+        with self.__lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, id_str, sha1=None):
+        """Return the path to the cached tarball of id_str, or None if it isn't cached.
+
+        If sha1 is None, any cached tarball for the package id matches."""
+        path = None
+        if sha1 is not None:
+            candidate = self._entry_path(id_str, sha1)
+            if os.path.exists(candidate):
+                path = candidate
+        else:
+            name_dir = os.path.join(self.__path, PackageId(id_str).name)
+            prefix = id_str + '.'
+            matches = [
+                os.path.join(name_dir, filename)
+                for filename in (os.listdir(name_dir) if os.path.isdir(name_dir) else [])
+                if filename.startswith(prefix) and filename.endswith('.tar.xz') and
+                len(filename) == len(prefix) + 40 + len('.tar.xz')]
+            if matches:
+                path = max(matches, key=lambda match: os.stat(match).st_mtime)
+
+        self._count(path is not None)
+        if path is None:
+            return None
+
+        # Mark the entry as recently used. Another host may have just evicted it.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def add(self, id_str, filename, sha1_str=None):
+        """Add the tarball at filename to the cache as id_str, returning the cached path.
+
+        The tarball is hardlinked into the cache when possible, copied otherwise."""
+        if sha1_str is None:
+            sha1_str = sha1(filename)
+        path = self._entry_path(id_str, sha1_str)
+        if os.path.exists(path):
+            os.utime(path)
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_or_copy(filename, path)
+        self.evict()
+        return path
+
+    def tee(self, id_str, chunks, expected_sha1=None):
+        """Yield chunks, a tarball of id_str being downloaded, writing them into the cache.
+
+        The tarball is only added to the cache once all the chunks have been
+        read and, if expected_sha1 is given, its sha1 matches."""
+        name_dir = os.path.join(self.__path, PackageId(id_str).name)
+        os.makedirs(name_dir, exist_ok=True)
+        hasher = hashlib.sha1()
+        with tempfile.NamedTemporaryFile(prefix='.tmp-', dir=name_dir, delete=False) as f:
+            try:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    yield chunk
+                f.flush()
+                # The cache is shared, NamedTemporaryFile only lets its owner read.
+                os.fchmod(f.fileno(), 0o644)
+                sha1_str = hasher.hexdigest()
+                if expected_sha1 is not None and sha1_str != expected_sha1:
+                    raise ValidationError("sha1 of {} is {}, expected {}".format(id_str, sha1_str, expected_sha1))
+                os.rename(f.name, self._entry_path(id_str, sha1_str))
+            finally:
+                if os.path.exists(f.name):
+                    os.remove(f.name)
+
+        self.evict()
+
+    def size(self):
+        return sum(os.stat(path).st_size for path in self._entries())
+
+    def _entries(self):
+        for root, _, filenames in os.walk(self.__path):
+            for filename in filenames:
+                if filename.endswith('.tar.xz') and not filename.startswith('.tmp-'):
+                    yield os.path.join(root, filename)
+
+    def evict(self):
+        """Remove least recently used tarballs until the cache fits in its maximum size."""
+        if self.__max_size is None:
+            return
+
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.__max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def get_package_cache():
+    """Return the PackageCache configured by the environment, or None if there isn't one.
+
+    PKGPANDA_PACKAGE_CACHE is the cache directory. PKGPANDA_PACKAGE_CACHE_MAX_SIZE
+    optionally overrides the maximum size of the cache in bytes."""
+    path = os.environ.get(PACKAGE_CACHE_DIR_ENV)
+    if not path:
+        return None
+
+    max_size = os.environ.get(PACKAGE_CACHE_MAX_SIZE_ENV)
+    return PackageCache(path, int(max_size) if max_size else PACKAGE_CACHE_MAX_SIZE)
@@ -1,8 +1,40 @@
 import os
+import re
+import socket
+import sys
+import time
+from subprocess import CalledProcessError, Popen
 
-from pkgpanda.util import expect_fs, run
+import pytest
 
-fetch_output = """\rFetching: mesos--0.22.0\rFetched: mesos--0.22.0\n"""
+from pkgpanda import Repository
+from pkgpanda.actions import fetch_packages
+from pkgpanda.util import expect_fs, run, sha1
+
+fetch_output_regex = r"^Fetched: mesos--0\.22\.0 \([0-9]+\.[0-9]{2}s\)\n$"
+cache_fetch_output_regex = r"^Fetched: mesos--0\.22\.0 \([0-9]+\.[0-9]{{2}}s\)\nPackage cache: {} hits, {} misses\n$"
+
+
+@pytest.fixture
+def remote_repo_url():
+    """Serve ../resources/remote_repo over HTTP, returning the base url."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = Popen(
+        [sys.executable, '-m', 'http.server', '--bind', '127.0.0.1', str(port)],
+        cwd='../resources/remote_repo')
+    try:
+        for _ in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        yield 'http://127.0.0.1:{}'.format(port)
+    finally:
+        server.terminate()
+        server.wait()
 
 
 def test_fetch(tmpdir):
@@ -10,24 +42,118 @@ def test_fetch(tmpdir):
     # succeeds when there isn't anything yet.
     # Start a simpleHTTPServer to serve the packages
     # fetch a couple packages
-    assert run([
-               "pkgpanda",
-               "fetch",
-               "mesos--0.22.0",
-               "--repository={0}".format(tmpdir),
-               "--repository-url=file://{0}/../resources/remote_repo/".format(os.getcwd())
-               ]) == fetch_output
+    assert re.match(fetch_output_regex, run([
+        "pkgpanda",
+        "fetch",
+        "mesos--0.22.0",
+        "--repository={0}".format(tmpdir),
+        "--repository-url=file://{0}/../resources/remote_repo/".format(os.getcwd())
+    ]))
 
     # Ensure that the package at least somewhat extracted correctly.
     expect_fs(
         "{0}".format(tmpdir),
         {
-            "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"]
+            "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin", "manifest.json", "digests.json"]
         })
-    # TODO(cmaloney): Test multiple fetches on one line.
     # TODO(cmaloney): Test unable to fetch case.
 
 
+def test_fetch_http(tmpdir, remote_repo_url):
+    # Repeated ids are only fetched once, the tarball is extracted as it downloads.
+    assert re.match(fetch_output_regex, run([
+        "pkgpanda",
+        "fetch",
+        "mesos--0.22.0",
+        "mesos--0.22.0",
+        "--jobs=2",
+        "--repository={0}".format(tmpdir),
+        "--repository-url={0}".format(remote_repo_url)
+    ]))
+
+    expect_fs(
+        "{0}".format(tmpdir),
+        {
+            "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin", "manifest.json", "digests.json"]
+        })
+
+    # A package the remote doesn't have leaves nothing behind.
+    with pytest.raises(Exception):
+        run([
+            "pkgpanda",
+            "fetch",
+            "mesos--0.23.0",
+            "--repository={0}".format(tmpdir),
+            "--repository-url={0}".format(remote_repo_url)
+        ])
+    expect_fs("{0}".format(tmpdir), ["mesos--0.22.0"])
+
+
+def test_fetch_mirrors(tmpdir, remote_repo_url):
+    # Mirrors which can't be reached are skipped.
+    output = run([
+        "pkgpanda",
+        "fetch",
+        "mesos--0.22.0",
+        "--repository={0}".format(tmpdir),
+        "--repository-url=http://127.0.0.1:1,{0}".format(remote_repo_url)
+    ])
+    assert "Repository mirror http://127.0.0.1:1 is unreachable" in output
+    assert re.search(fetch_output_regex[1:], output)
+    expect_fs(
+        "{0}".format(tmpdir),
+        {
+            "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin", "manifest.json", "digests.json"]
+        })
+
+
+def test_fetch_peers(tmpdir, remote_repo_url):
+    tarball = "../resources/remote_repo/packages/mesos/mesos--0.22.0.tar.xz"
+    repository = Repository(str(tmpdir))
+    # A repository without the package, which (unlike one that is down) fails without retrying.
+    empty_repo_url = remote_repo_url + "/empty"
+
+    # Peers are only trusted with packages whose checksum is known.
+    with pytest.raises(Exception):
+        fetch_packages(repository, empty_repo_url, ["mesos--0.22.0"], str(tmpdir), peers=[remote_repo_url])
+
+    # Peers which are down are skipped without retrying them.
+    fetch_packages(
+        repository,
+        empty_repo_url,
+        ["mesos--0.22.0"],
+        str(tmpdir),
+        checksums={"mesos--0.22.0": sha1(tarball)},
+        peers=["http://127.0.0.1:1", remote_repo_url])
+    assert repository.has_package("mesos--0.22.0")
+
+
+def test_fetch_package_cache(tmpdir, remote_repo_url):
+    env = dict(os.environ, PKGPANDA_PACKAGE_CACHE=str(tmpdir.join("cache")))
+    assert re.match(cache_fetch_output_regex.format(0, 1), run([
+        "pkgpanda",
+        "fetch",
+        "mesos--0.22.0",
+        "--repository={0}".format(tmpdir.join("repo1")),
+        "--repository-url={0}".format(remote_repo_url)
+    ], env=env))
+    assert len(tmpdir.join("cache", "mesos").listdir()) == 1
+
+    # The second repository is filled from the cache, the repository url isn't used.
+    assert re.match(cache_fetch_output_regex.format(1, 0), run([
+        "pkgpanda",
+        "fetch",
+        "mesos--0.22.0",
+        "--repository={0}".format(tmpdir.join("repo2")),
+        "--repository-url=http://127.0.0.1:1"
+    ], env=env))
+    expect_fs(
+        "{0}".format(tmpdir.join("repo2")),
+        {
+            "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin", "manifest.json", "digests.json"]
+        })
+
+
 def test_add(tmpdir):
     assert run([
                "pkgpanda",
@@ -40,6 +166,22 @@ def test_add(tmpdir):
     expect_fs(
         "{0}".format(tmpdir),
         {
-            "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"]
+            "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin", "manifest.json", "digests.json"]
         })
     # TODO(branden): Test unable to add case.
+
+    assert run([
+        "pkgpanda",
+        "check-integrity",
+        "--full",
+        "--repository={0}".format(tmpdir),
+    ]) == "mesos--0.22.0: OK\n"
+
+    tmpdir.join("mesos--0.22.0", "lib", "libmesos.so").write("corrupt")
+    with pytest.raises(CalledProcessError):
+        run([
+            "pkgpanda",
+            "check-integrity",
+            "mesos--0.22.0",
+            "--repository={0}".format(tmpdir),
+        ])
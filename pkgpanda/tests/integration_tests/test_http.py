@@ -1,9 +1,16 @@
 import json
 import operator
 import os
+import threading
+import time
+from functools import partial
 from shutil import copytree
 
-from pkgpanda.http import app
+from pkgpanda import Install
+from pkgpanda.http import app, reconcile_activation
+from pkgpanda.http.jobs import JobStore
+from pkgpanda.package_cache import PackageCache
+from pkgpanda.util import write_json
 
 
 def assert_response(response, status_code, body, headers=None, body_cmp=operator.eq):
@@ -93,6 +100,26 @@ def test_list_packages():
     ])
 
 
+def test_list_packages_conditional(tmpdir):
+    _set_test_config(app)
+    repo_dir = str(tmpdir.join('repo'))
+    copytree('../resources/packages', repo_dir)
+    app.config['DCOS_REPO_DIR'] = repo_dir
+    client = app.test_client()
+
+    for path in ['/repository/', '/active/']:
+        response = client.get(path)
+        etag = response.headers['ETag']
+        assert_response(client.get(path, headers={'If-None-Match': etag}), 304, b'')
+
+    # The listing changes when a package is removed from disk.
+    etag = client.get('/repository/').headers['ETag']
+    os.rename(repo_dir + '/mesos--0.23.0', str(tmpdir.join('mesos--0.23.0')))
+    response = client.get('/repository/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert 'mesos--0.23.0' not in json.loads(response.data.decode('utf-8'))
+
+
 def test_get_package():
     _set_test_config(app)
     client = app.test_client()
@@ -136,11 +163,22 @@ def test_get_active_package():
     assert_error(client.get('/active/!@#*'), 404)
 
 
+def wait_for_job(client, path):
+    """Poll the job at path until it has finished, returning it."""
+    for _ in range(100):
+        job = json.loads(client.get(path).data.decode('utf-8'))
+        if job['state'] in ('succeeded', 'failed'):
+            return job
+        time.sleep(0.1)
+    raise AssertionError('Job {} did not finish: {}'.format(path, job))
+
+
 def test_activate_packages(tmpdir):
     _set_test_config(app)
     install_dir = str(tmpdir.join('install'))
     copytree('../resources/install', install_dir, symlinks=True)
     app.config['DCOS_ROOT'] = install_dir
+    app.config['JOBS_DIR'] = str(tmpdir.join('jobs'))
     app.config['DCOS_ROOTED_SYSTEMD'] = True
     client = app.test_client()
 
@@ -154,16 +192,32 @@ def test_activate_packages(tmpdir):
         'mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8',
     ]
     assert_json_response(client.get('/active/'), 200, old_packages)
-    assert_response(
-        client.put(
-            '/active/',
-            content_type='application/json',
-            data=json.dumps(new_packages),
-        ),
-        204,
-        b'',
+    response = client.put(
+        '/active/',
+        content_type='application/json',
+        data=json.dumps(new_packages),
     )
+    assert response.status_code == 202
+    job = wait_for_job(client, response.headers['Location'])
+    assert job['state'] == 'succeeded'
+    assert job['params'] == {'packages': new_packages}
+    assert [stage['name'] for stage in job['stages']] == ['validate', 'symlink', 'swap']
     assert_json_response(client.get('/active/'), 200, new_packages)
+    assert_json_response(client.get('/jobs/'), 200, [job['id']])
+
+    # Sets which can't be activated are rejected before any job is queued.
+    response = client.put(
+        '/active/',
+        content_type='application/json',
+        data=json.dumps(['mesos--0.22.0', 'mesos--0.23.0']),
+    )
+    assert response.status_code == 409
+    assert 'Repeated name mesos' in json.loads(response.data.decode('utf-8'))['error']
+    assert_json_response(client.get('/jobs/'), 200, [job['id']])
+    assert_json_response(client.get('/active/'), 200, new_packages)
+
+    assert_error(client.get('/jobs/' + '0' * 32), 404)
+    assert_error(client.get('/jobs/not-a-job-id'), 404)
 
     # Attempt to activate nonexistent packages.
     nonexistent_packages = [
@@ -181,6 +235,127 @@ def test_activate_packages(tmpdir):
     )
 
 
+def test_collect_garbage(tmpdir):
+    _set_test_config(app)
+    install_dir = str(tmpdir.join('install'))
+    repo_dir = str(tmpdir.join('repo'))
+    copytree('../resources/install', install_dir, symlinks=True)
+    copytree('../resources/packages', repo_dir)
+    app.config['DCOS_ROOT'] = install_dir
+    app.config['DCOS_REPO_DIR'] = repo_dir
+    app.config['JOBS_DIR'] = str(tmpdir.join('jobs'))
+    client = app.test_client()
+
+    response = client.post('/gc/?dry_run=true&min_age=0')
+    assert response.status_code == 200
+    result = json.loads(response.data.decode('utf-8'))
+    assert result['dry_run']
+    assert result['removed'] == ['mesos--0.23.0', 'mesos-config--justmesos']
+    assert os.path.exists(os.path.join(repo_dir, 'mesos--0.23.0'))
+
+    response = client.post('/gc/?min_age=0')
+    assert json.loads(response.data.decode('utf-8'))['removed'] == ['mesos--0.23.0', 'mesos-config--justmesos']
+    assert_json_response(client.get('/repository/'), 200, [
+        'mesos--0.22.0',
+        'mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8',
+    ])
+
+    assert_error(client.post('/gc/?keep=lots'), 400)
+
+
+def test_jobs_reconciled_after_restart(tmpdir):
+    install = Install('../resources/install', '../resources/etc-active', True, False, False)
+    jobs_dir = str(tmpdir)
+    for job_id, packages in [('1' * 32, ['mesos--0.22.0', 'mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8']),
+                             ('2' * 32, ['mesos--0.23.0'])]:
+        write_json(os.path.join(jobs_dir, job_id + '.json'), {
+            'id': job_id,
+            'type': 'activate',
+            'params': {'packages': packages},
+            'state': 'running',
+            'stage': 'swap',
+            'stages': [{'name': 'swap', 'started': 0, 'finished': None}],
+            'error': None,
+            'created': 0})
+
+    jobs = JobStore(jobs_dir)
+    jobs.reconcile(partial(reconcile_activation, install))
+    assert jobs.get('1' * 32)['state'] == 'succeeded'
+    assert jobs.get('2' * 32)['state'] == 'failed'
+    assert jobs.get('2' * 32)['stages'][0]['finished'] is not None
+
+
+def test_jobs_reconciled_after_broken_swap(tmpdir):
+    # An interrupted swap leaves only active.old / active.new behind.
+    root = tmpdir.join('root')
+    root.ensure('active.new', dir=True)
+    install = Install(str(root), '../resources/etc-active', True, False, False)
+    jobs_dir = tmpdir.join('jobs')
+    jobs_dir.ensure(dir=True)
+    write_json(str(jobs_dir.join('1' * 32 + '.json')), {
+        'id': '1' * 32,
+        'type': 'activate',
+        'params': {'packages': ['mesos--0.22.0']},
+        'state': 'running',
+        'stage': 'swap',
+        'stages': [{'name': 'swap', 'started': 0, 'finished': None}],
+        'error': None,
+        'created': 0})
+
+    jobs = JobStore(str(jobs_dir))
+    jobs.reconcile(partial(reconcile_activation, install))
+    job = jobs.get('1' * 32)
+    assert job['state'] == 'failed'
+    assert 'Broken past deploy' in job['error']
+
+
+def test_jobs_exclusive(tmpdir):
+    jobs = JobStore(str(tmpdir))
+    submitted = threading.Event()
+
+    def submit():
+        jobs.submit('test', {}, lambda progress: None)
+        submitted.set()
+
+    with jobs.exclusive() as idle:
+        assert idle
+        # Nothing can be submitted until the block ends.
+        thread = threading.Thread(target=submit)
+        thread.start()
+        assert not submitted.wait(0.2)
+    assert submitted.wait(5)
+    thread.join()
+
+    release = threading.Event()
+    jobs.submit('test', {}, lambda progress: release.wait(5))
+    with jobs.exclusive() as idle:
+        assert not idle
+    release.set()
+
+
+def test_jobs_pruned(tmpdir):
+    jobs = JobStore(str(tmpdir), keep=2)
+
+    def wait_idle():
+        while True:
+            with jobs.exclusive() as idle:
+                if idle:
+                    return
+            time.sleep(0.01)
+
+    for _ in range(4):
+        job = jobs.submit('test', {}, lambda progress: None)
+        wait_idle()
+
+    # Only the last 2 finished jobs are kept, along with the new one.
+    release = threading.Event()
+    running = jobs.submit('test', {}, lambda progress: release.wait(5))
+    assert len(jobs.list()) == 3
+    assert jobs.get(running['id']) is not None
+    assert jobs.get(job['id']) is not None
+    release.set()
+
+
 def test_fetch_package(tmpdir):
     _set_test_config(app)
     client = app.test_client()
@@ -224,6 +399,42 @@ def test_fetch_package(tmpdir):
     )
 
 
+def test_get_package_tarball(tmpdir, monkeypatch):
+    _set_test_config(app)
+    client = app.test_client()
+    path = '/packages/mesos/mesos--0.22.0.tar.xz'
+    tarball = '../resources/remote_repo/packages/mesos/mesos--0.22.0.tar.xz'
+
+    # Without a package cache there are no tarballs to serve.
+    monkeypatch.delenv('PKGPANDA_PACKAGE_CACHE', raising=False)
+    assert_error(client.get(path), 404)
+
+    monkeypatch.setenv('PKGPANDA_PACKAGE_CACHE', str(tmpdir))
+    assert_error(client.get(path), 404)
+    PackageCache(str(tmpdir)).add('mesos--0.22.0', tarball)
+    with open(tarball, 'rb') as f:
+        assert_response(client.get(path), 200, f.read())
+    assert client.get(path, headers={'Range': 'bytes=10-'}).status_code == 206
+    assert_error(client.get('/packages/marathon/mesos--0.22.0.tar.xz'), 404)
+
+
+def test_check_integrity(tmpdir):
+    _set_test_config(app)
+    app.config['DCOS_REPO_DIR'] = str(tmpdir)
+    client = app.test_client()
+    client.post(
+        '/repository/mesos--0.22.0',
+        content_type='application/json',
+        data=json.dumps({
+            'repository_url': 'file://{}/../resources/remote_repo'.format(os.getcwd())
+        }),
+    )
+    assert_json_response(client.get('/integrity/?full=true'), 200, {'mesos--0.22.0': []})
+
+    tmpdir.join('mesos--0.22.0', 'lib', 'libmesos.so').remove()
+    assert_json_response(client.get('/integrity/'), 200, {'mesos--0.22.0': ['lib/libmesos.so: missing']})
+
+
 def test_remove_package(tmpdir):
     _set_test_config(app)
     repo_dir = str(tmpdir.join('repo'))
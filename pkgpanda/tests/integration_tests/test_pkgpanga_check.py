@@ -1,5 +1,8 @@
+import json
 from subprocess import check_output, PIPE, Popen, STDOUT
 
+from pkgpanda.cli import run_check
+
 
 list_output = """WARNING: `not_executable.py` is not executable
 pkg1--12345
@@ -33,3 +36,43 @@ def test_check_target_run():
     stdout, stderr = cmd.communicate()
     assert stdout.decode('UTF-8') == run_output_stdout
     assert stderr.decode('UTF-8') == run_output_stderr
+
+
+def test_check_target_run_json(tmpdir):
+    cmd = ('pkgpanda check --json --root ../resources/opt/mesosphere'
+           ' --repository ../resources/opt/mesosphere/packages'
+           ' --max-age=3600 --results-file={}'.format(tmpdir.join('results.json')))
+    results = json.loads(check_output(cmd, shell=True).decode('UTF-8'))
+    assert [(result['package'], result['check'], result['status']) for result in results] == [
+        ('pkg1--12345', 'hello_world_ok.py', 'ok'),
+        ('pkg2--12345', 'failed_check.py', 'ok'),
+        ('pkg2--12345', 'shell_script_check.sh', 'ok')]
+    assert results[0]['stdout'] == 'Hello World\n'
+
+    # Recent results are reused rather than running the checks again.
+    cached = json.loads(tmpdir.join('results.json').read())
+    cached['results'][0]['stdout'] = 'cached\n'
+    tmpdir.join('results.json').write(json.dumps(cached))
+    cmd = cmd.replace('--json ', '')
+    assert check_output(cmd, shell=True).decode('UTF-8') == run_output_stdout.replace('Hello World', 'cached', 1)
+
+
+def test_run_check_timeout(tmpdir):
+    check = tmpdir.join('slow_check.sh')
+    check.write('#!/bin/sh\necho starting\nexec sleep 10\n')
+    check.chmod(0o755)
+    result = run_check(('pkg--1', str(check)), timeout=0.5)
+    assert result['status'] == 'timeout'
+    assert result['stdout'] == 'starting\n'
+    assert result['duration'] < 5
+
+
+def test_run_check_timeout_child(tmpdir):
+    # The children of the check are killed too, rather than holding its output open.
+    check = tmpdir.join('slow_check.sh')
+    check.write('#!/bin/sh\necho starting\nsleep 10\necho done\n')
+    check.chmod(0o755)
+    result = run_check(('pkg--1', str(check)), timeout=0.5)
+    assert result['status'] == 'timeout'
+    assert result['stdout'] == 'starting\n'
+    assert result['duration'] < 5
@@ -1,3 +1,5 @@
+import json
+import os
 from shutil import copytree
 from subprocess import check_call, check_output
 
@@ -31,6 +33,7 @@ def test_setup(tmpdir):
         {
             "active": ["env", "mesos", "mesos-config"],
             "active.buildinfo.full.json": None,
+            "active.history.json": None,
             "bin": [
                 "mesos",
                 "mesos-dir",
@@ -89,6 +92,7 @@ def test_setup(tmpdir):
             "active": ["env", "mesos", "mesos-config"],
             "active.buildinfo.full.json.old": None,
             "active.buildinfo.full.json": None,
+            "active.history.json": None,
             "bin": [
                 "mesos",
                 "mesos-dir",
@@ -227,3 +231,52 @@ def test_activate(tmpdir):
 
     # TODO(cmaloney): expect_fs
     # TODO(cmaloney): Test a full OS setup using http://0pointer.de/blog/projects/changing-roots.html
+
+
+def test_gc(tmpdir):
+    repo_path = tmp_repository(tmpdir)
+    # The copied packages have no recorded added time, so their age comes from
+    # their folder's mtime. Make them old whenever the fixtures were checked out.
+    for package_path in repo_path.listdir():
+        os.utime(str(package_path), (0, 0))
+    tmpdir.join("root", "bootstrap").write("", ensure=True)
+    options = [
+        "--root={0}/root".format(tmpdir),
+        "--rooted-systemd",
+        "--repository={}".format(repo_path),
+        "--config-dir=../resources/etc-active",
+        "--no-systemd"]
+
+    check_call(["pkgpanda", "setup"] + options)
+    for package_ids in [
+            ["mesos--0.22.0", "mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8"],
+            ["mesos--0.22.0", "mesos-config--justmesos"],
+            ["mesos--0.22.0"]]:
+        check_call(["pkgpanda", "activate"] + package_ids + options)
+
+    # The active and previous (active.old) sets are always kept.
+    result = json.loads(run(["pkgpanda", "gc", "--dry-run", "--json", "--keep=1", "--min-age=0"] + options))
+    assert result["dry_run"]
+    assert result["removed"] == [
+        "env--setup", "mesos--0.23.0", "mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8"]
+    assert result["reclaimed_bytes"] > 0
+    expect_fs(str(repo_path), [
+        "env--setup",
+        "invalid-package",
+        "mesos--0.22.0",
+        "mesos--0.23.0",
+        "mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8",
+        "mesos-config--justmesos"])
+
+    # By default the last 3 active sets are kept, as well as packages which
+    # were just added to the repository (env--setup, unlike the copied ones).
+    output = run(["pkgpanda", "gc"] + options)
+    assert output.startswith("Removed mesos--0.23.0 (")
+    assert "Reclaimed " in output
+    assert run(["pkgpanda", "gc", "--min-age=0"] + options).startswith("Removed env--setup (")
+    assert run(["pkgpanda", "gc", "--min-age=0"] + options) == "Reclaimed 0 bytes\n"
+    expect_fs(str(repo_path), [
+        "invalid-package",
+        "mesos--0.22.0",
+        "mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8",
+        "mesos-config--justmesos"])
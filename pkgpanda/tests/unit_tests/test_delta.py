@@ -0,0 +1,94 @@
+import os
+import shutil
+
+import pytest
+
+from pkgpanda import Repository, requests_fetcher, write_manifest
+from pkgpanda.delta import apply_delta, delta_filename, make_delta, tree_digest
+from pkgpanda.exceptions import ValidationError
+from pkgpanda.util import extract_tarball, load_json, write_json
+
+
+@pytest.fixture
+def packages(tmpdir):
+    """Copies of two versions of the mesos package, with a few more kinds of change."""
+    base = str(tmpdir.join('mesos--0.22.0'))
+    target = str(tmpdir.join('mesos--0.23.0'))
+    shutil.copytree('../resources/packages/mesos--0.22.0', base, symlinks=True)
+    shutil.copytree('../resources/packages/mesos--0.23.0', target, symlinks=True)
+    os.symlink('bin/mesos', os.path.join(base, 'link'))
+    os.symlink('bin_master', os.path.join(target, 'link'))
+    os.mkdir(os.path.join(base, 'lib', 'plugins'))
+    with open(os.path.join(target, 'lib', 'plugins'), 'w') as f:
+        f.write('not a directory any more')
+    os.chmod(os.path.join(target, 'bin_master'), 0o700)
+    # Like packages built by mkpanda.
+    write_manifest(target)
+    return base, target
+
+
+def test_make_apply(tmpdir, packages):
+    base, target = packages
+    delta = str(tmpdir.join(delta_filename('mesos--0.22.0', 'mesos--0.23.0')))
+    make_delta('mesos--0.22.0', base, 'mesos--0.23.0', target, delta)
+
+    delta_dir = str(tmpdir.join('delta'))
+    extract_tarball(delta, delta_dir)
+    # Unchanged files aren't in the delta.
+    assert not os.path.exists(os.path.join(delta_dir, 'files', 'buildinfo.full.json'))
+
+    result = str(tmpdir.join('result'))
+    apply_delta(delta_dir, 'mesos--0.22.0', base, result)
+    assert tree_digest(result) == tree_digest(target)
+    assert os.readlink(os.path.join(result, 'link')) == 'bin_master'
+    assert os.stat(os.path.join(result, 'bin_master')).st_mode & 0o777 == 0o700
+
+    # The delta only applies to its own, unmodified, base.
+    with pytest.raises(ValidationError):
+        apply_delta(delta_dir, 'mesos--0.21.0', base, str(tmpdir.join('wrong-base')))
+    with open(os.path.join(base, 'buildinfo.full.json'), 'w') as f:
+        f.write('modified')
+    with pytest.raises(ValidationError):
+        apply_delta(delta_dir, 'mesos--0.22.0', base, str(tmpdir.join('modified-base')))
+
+
+@pytest.mark.parametrize('removed', ['/victim', '../../victim', 'bin/../../victim', '.', 'outside/file'])
+def test_apply_outside_package(tmpdir, packages, removed):
+    base, target = packages
+    victim = tmpdir.join('victim')
+    victim.ensure('file')
+    # A symlink in the base package out of it mustn't be followed either.
+    os.symlink(str(victim), os.path.join(base, 'outside'))
+    delta = str(tmpdir.join('delta.tar.xz'))
+    make_delta('mesos--0.22.0', base, 'mesos--0.23.0', target, delta)
+    delta_dir = str(tmpdir.join('delta'))
+    extract_tarball(delta, delta_dir)
+    info = load_json(os.path.join(delta_dir, 'delta.json'))
+    info['removed'].append(removed)
+    write_json(os.path.join(delta_dir, 'delta.json'), info)
+
+    with pytest.raises(ValidationError):
+        apply_delta(delta_dir, 'mesos--0.22.0', base, str(tmpdir.join('result')))
+    assert victim.join('file').check()
+
+
+def test_requests_fetcher(tmpdir, packages):
+    base, target = packages
+    repo_dir = tmpdir.join('remote', 'packages', 'mesos')
+    repo_dir.ensure(dir=True)
+    make_delta('mesos--0.22.0', base, 'mesos--0.23.0', target,
+               str(repo_dir.join(delta_filename('mesos--0.22.0', 'mesos--0.23.0'))))
+    repository = Repository(str(tmpdir.join('repository')))
+    url = 'file://' + str(tmpdir.join('remote'))
+
+    # The remote repository only has the delta, not the package itself.
+    def fetcher(id_, target):
+        return requests_fetcher(url, id_, target, str(tmpdir), base=('mesos--0.22.0', base))
+
+    repository.add(fetcher, 'mesos--0.23.0')
+    assert tree_digest(repository.package_path('mesos--0.23.0')) == tree_digest(target)
+
+    # Without the base the whole package is needed.
+    with pytest.raises(Exception):
+        repository.add(lambda id_, target: requests_fetcher(url, id_, target, str(tmpdir)), 'mesos--0.24.0')
+    assert not os.path.exists(repository.package_path('mesos--0.24.0'))
@@ -1,10 +1,14 @@
 """ Test reading and changing the active set of available packages"""
 
+import os
 import shutil
+from subprocess import CalledProcessError, check_output
 
 import pytest
 
-from pkgpanda import Install, Repository
+import pkgpanda
+from pkgpanda import Install, Repository, Systemd
+from pkgpanda.exceptions import ValidationError
 from pkgpanda.util import expect_fs
 
 
@@ -90,3 +94,104 @@ def test_recovery_move_new(tmpdir):
             "include": [".gitignore"],
             "lib": ["libmesos.so"]
         })
+
+
+def _tree(root):
+    """Map every path under root, except the archived .old state and history, to its symlink target or type."""
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            rel_path = os.path.relpath(path, root)
+            if rel_path.split('/')[0].endswith('.old') or rel_path in ('install_progress', 'active.history.json'):
+                continue
+            if os.path.islink(path):
+                tree[rel_path] = os.readlink(path)
+            elif os.path.isdir(path):
+                tree[rel_path] = 'dir'
+            else:
+                with open(path) as f:
+                    tree[rel_path] = f.read()
+    return tree
+
+
+def test_activate_incremental(tmpdir, repository):
+    root = str(tmpdir.join("install"))
+    shutil.copytree("../resources/install_empty", root, symlinks=True)
+    install = Install(root, "../resources/etc-active", True, False, True)
+
+    old_set = ['mesos--0.22.0', 'mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8']
+    new_set = ['mesos--0.23.0', 'mesos-config--justmesos']
+    # Lists rather than load_packages() so the environment files come out in the same order.
+    for from_set, to_set in [(old_set, new_set), (new_set, old_set)]:
+        install.activate(list(map(repository.load, from_set)))
+        install.activate(list(map(repository.load, to_set)), incremental=True)
+        assert install.get_active() == set(to_set)
+        incremental_tree = _tree(root)
+
+        install.activate(list(map(repository.load, to_set)))
+        assert incremental_tree == _tree(root)
+
+
+def test_activate_conflicting_files(tmpdir):
+    def add_package(id, files):
+        for path in files:
+            tmpdir.join("packages", id, path).write("", ensure=True)
+        tmpdir.join("packages", id, "pkginfo.json").write("{}", ensure=True)
+
+    add_package("a--1", ["bin/foo", "lib/x"])
+    add_package("b--1", ["bin_master/foo", "lib/x/y", "bin/bar"])
+    add_package("c--1", ["bin/baz", "etc_slave/bar"])
+    repository = Repository(str(tmpdir.join("packages")))
+    root = str(tmpdir.join("install"))
+    shutil.copytree("../resources/install_empty", root, symlinks=True)
+    install = Install(root, "../resources/etc-active", True, False, True)
+
+    with pytest.raises(ValidationError) as ex:
+        install.activate(repository.load_packages(["a--1", "b--1", "c--1"]))
+    assert str(ex.value).splitlines()[1:] == [
+        "bin/foo: {0}/a--1/bin/foo, {0}/b--1/bin_master/foo".format(repository.path),
+        "lib/x: {0}/a--1/lib/x, {0}/b--1/lib/x".format(repository.path)]
+
+    # Nothing was changed.
+    expect_fs(root, {".gitkeep": None, "active": [".gitkeep"]})
+
+
+def test_systemd_stop_all(tmpdir, monkeypatch):
+    for name in ["a.service", "b.service", "missing.service"]:
+        tmpdir.join(name).write("")
+    tmpdir.join("subdir").ensure(dir=True)
+
+    stopped = []
+
+    def check_call(cmd):
+        assert cmd[:2] == ["systemctl", "stop"]
+        if cmd[2] == "missing.service":
+            raise CalledProcessError(5, cmd)
+        stopped.append(cmd[2])
+
+    monkeypatch.setattr(pkgpanda, "check_call", check_call)
+    latencies = Systemd(str(tmpdir), True, True).stop_all()
+    assert sorted(stopped) == ["a.service", "b.service"]
+    assert set(latencies) == {"a.service", "b.service", "missing.service"}
+
+    # Other failures are still errors.
+    monkeypatch.setattr(pkgpanda, "check_call", lambda cmd: check_output(["false"]))
+    with pytest.raises(CalledProcessError):
+        Systemd(str(tmpdir), True, True).stop_all()
+
+    # Nothing is stopped when systemd isn't managed.
+    assert Systemd(str(tmpdir), False, True).stop_all() == {}
+
+
+def test_systemd_start_latencies(tmpdir, monkeypatch):
+    for name in ["a.service", "b.service"]:
+        tmpdir.join(name).write("")
+
+    def check_output(cmd):
+        assert cmd[-2:] == ["a.service", "b.service"]
+        return (b"Id=a.service\nInactiveExitTimestampMonotonic=1000000\nActiveEnterTimestampMonotonic=3500000\n\n"
+                b"Id=b.service\nInactiveExitTimestampMonotonic=2000000\nActiveEnterTimestampMonotonic=0\n")
+
+    monkeypatch.setattr(pkgpanda, "check_output", check_output)
+    assert Systemd(str(tmpdir), True, True).start_latencies() == {"a.service": 2.5}
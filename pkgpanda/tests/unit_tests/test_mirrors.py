@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+import requests
+
+from pkgpanda.exceptions import FetchError
+from pkgpanda.mirrors import get_mirrors, MirrorSet
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError(response=response)
+
+
+def test_parse():
+    assert get_mirrors('http://a/, http://b\nhttp://c').urls == ['http://a', 'http://b', 'http://c']
+    assert get_mirrors(['http://a']).urls == ['http://a']
+    mirrors = MirrorSet(['http://a'])
+    assert get_mirrors(mirrors) is mirrors
+    with pytest.raises(ValueError):
+        MirrorSet.parse(' ')
+
+
+def test_failover():
+    mirrors = MirrorSet(['http://a', 'http://b'])
+    calls = []
+
+    def fetch(url, tee):
+        calls.append(url)
+        if url == 'http://a':
+            raise FetchError(url, 'target', IOError('connection reset'), True)
+        return b''.join(tee([b'abc']))
+
+    assert mirrors.fetch(fetch) == b'abc'
+    # The failed mirror is avoided afterwards.
+    assert mirrors.fetch(fetch) == b'abc'
+    assert calls == ['http://a', 'http://b', 'http://b']
+
+    def fail(url, tee):
+        raise FetchError(url, 'target', IOError('connection reset'), True)
+
+    with pytest.raises(FetchError):
+        mirrors.fetch(fail)
+
+
+def test_missing_package_isnt_a_failure():
+    mirrors = MirrorSet(['http://a', 'http://b'])
+    calls = []
+
+    def fetch(url, tee):
+        calls.append(url)
+        if url == 'http://a':
+            raise FetchError(url, 'target', http_error(404), True)
+        return url
+
+    assert mirrors.fetch(fetch) == 'http://b'
+    assert mirrors.fetch(fetch) == 'http://b'
+    assert calls == ['http://a', 'http://b', 'http://a', 'http://b']
+
+
+def test_spread():
+    mirrors = MirrorSet(['http://a', 'http://b'])
+    started = threading.Barrier(2)
+    used = []
+
+    def fetch(url, tee):
+        used.append(url)
+        started.wait(timeout=10)
+
+    threads = [threading.Thread(target=mirrors.fetch, args=(fetch,)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(used) == ['http://a', 'http://b']
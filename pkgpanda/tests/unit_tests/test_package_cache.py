@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+import pkgpanda.util
+from pkgpanda.exceptions import ValidationError
+from pkgpanda.package_cache import PackageCache
+
+
+def make_tarball(path, contents):
+    with open(path, 'wb') as f:
+        f.write(contents)
+    return path
+
+
+def test_add_get(tmpdir):
+    cache = PackageCache(str(tmpdir.join('cache')))
+    tarball = make_tarball(str(tmpdir.join('mesos--0.22.0.tar.xz')), b'mesos')
+    sha1 = pkgpanda.util.sha1(tarball)
+
+    assert cache.get('mesos--0.22.0') is None
+    path = cache.add('mesos--0.22.0', tarball)
+    assert path == str(tmpdir.join('cache', 'mesos', 'mesos--0.22.0.{}.tar.xz'.format(sha1)))
+    assert PackageCache.entry_sha1(path) == sha1
+
+    assert cache.get('mesos--0.22.0') == path
+    assert cache.get('mesos--0.22.0', sha1) == path
+    assert cache.get('mesos--0.22.0', '0' * 40) is None
+    assert cache.get('mesos--0.22') is None
+    assert cache.hits == 2
+    assert cache.misses == 3
+
+
+def test_evict(tmpdir):
+    cache = PackageCache(str(tmpdir.join('cache')), max_size=10)
+    old = cache.add('a--1', make_tarball(str(tmpdir.join('a')), b'123456'))
+    os.utime(old, (0, 0))
+    cache.add('b--1', make_tarball(str(tmpdir.join('b')), b'123456'))
+
+    assert not os.path.exists(old)
+    assert cache.get('b--1') is not None
+    assert cache.size() == 6
+
+
+def test_tee(tmpdir):
+    cache = PackageCache(str(tmpdir.join('cache')))
+    assert b''.join(cache.tee('a--1', [b'abc', b'def'])) == b'abcdef'
+    path = cache.get('a--1')
+    with open(path, 'rb') as f:
+        assert f.read() == b'abcdef'
+    # Other users sharing the cache can read it.
+    assert os.stat(path).st_mode & 0o777 == 0o644
+
+    # Tarballs which don't match their expected sha1 are never cached.
+    with pytest.raises(ValidationError):
+        list(cache.tee('b--1', [b'abc'], '0' * 40))
+    assert cache.get('b--1') is None
+    assert os.listdir(str(tmpdir.join('cache', 'b'))) == []
@@ -1,8 +1,12 @@
 """Test functionality of the local package repository"""
 
+import os
+import time
+
 import pytest
 
 import pkgpanda.exceptions
+import pkgpanda.util
 from pkgpanda import Repository
 
 
@@ -28,3 +32,111 @@ def test_load_bad(repository):
 def test_load_nonexistant(repository):
     with pytest.raises(pkgpanda.exceptions.PackageError):
         repository.load_packages(["missing-package--42"])
+
+
+def test_manifest(repository):
+    manifest = repository.load("mesos--0.22.0").manifest
+    assert manifest['services'] == [
+        'dcos.target.wants_master/dcos-mesos-master.service',
+        'dcos.target.wants_slave/dcos-mesos-slave.service']
+    assert manifest['trees']['bin'] == {'dirs': ['mesos-dir'], 'files': ['mesos', 'mesos-dir/.gitignore']}
+    assert set(manifest['trees']) == {'bin', 'bin_master', 'dcos.target.wants_master', 'dcos.target.wants_slave', 'lib'}
+
+
+def test_add_writes_manifest(tmpdir):
+    repository = Repository(str(tmpdir))
+
+    def fetcher(id, target):
+        os.makedirs(os.path.join(target, 'bin'))
+        pkgpanda.util.write_string(os.path.join(target, 'bin', 'foo'), '')
+        pkgpanda.util.write_json(os.path.join(target, 'pkginfo.json'), {})
+
+    assert repository.add(fetcher, 'foo--1')
+    assert pkgpanda.util.load_json(str(tmpdir.join('foo--1', 'manifest.json'))) == {
+        'services': [],
+        'trees': {'bin': {'dirs': [], 'files': ['foo']}}}
+
+
+def test_index(tmpdir, monkeypatch):
+    repository = Repository(str(tmpdir))
+    assert repository.list() == set()
+
+    # add() and remove() update the index, it isn't rebuilt for their changes.
+    refresh = repository.refresh
+    refreshes = []
+    monkeypatch.setattr(repository, 'refresh', lambda: refreshes.append(1) or refresh())
+
+    def fetcher(id, target):
+        os.makedirs(target)
+        pkgpanda.util.write_json(os.path.join(target, 'pkginfo.json'), {})
+
+    repository.add(fetcher, 'foo--1')
+    repository.add(fetcher, 'foo--2')
+    repository.add(fetcher, 'bar--1')
+    assert repository.get_ids('foo') == ['foo--1', 'foo--2']
+    assert repository.get_package_id('bar--1').version == '1'
+    assert repository.has_package('bar--1')
+
+    repository.remove('bar--1')
+    assert not repository.has_package('bar--1')
+    assert repository.get_ids('bar') == []
+    with pytest.raises(pkgpanda.exceptions.PackageNotFound):
+        repository.get_package_id('bar--1')
+    assert refreshes == []
+
+    # Packages added by something else are picked up.
+    tmpdir.join('baz--1').ensure(dir=True)
+    assert repository.list() == {'foo--1', 'foo--2', 'baz--1'}
+    assert repository.get_ids('baz') == ['baz--1']
+
+
+def test_added_time(tmpdir):
+    repository = Repository(str(tmpdir))
+
+    def fetcher(id, target):
+        os.makedirs(target)
+        pkgpanda.util.write_json(os.path.join(target, 'pkginfo.json'), {})
+        # Extracting a tarball restores the folder's mtime to when it was built.
+        os.utime(target, (0, 0))
+
+    before = time.time()
+    repository.add(fetcher, 'foo--1')
+    assert repository.added_time('foo--1') >= before
+
+    # Packages added without a recorded time fall back to their folder's mtime.
+    tmpdir.join('legacy--1').ensure(dir=True)
+    os.utime(str(tmpdir.join('legacy--1')), (0, 1000))
+    assert repository.added_time('legacy--1') == 1000
+
+
+def test_integrity_check(tmpdir):
+    repository = Repository(str(tmpdir.join('repo')))
+
+    def fetcher(id, target):
+        os.makedirs(os.path.join(target, 'bin'))
+        pkgpanda.util.write_string(os.path.join(target, 'bin', 'foo'), 'foo')
+        pkgpanda.util.write_string(os.path.join(target, 'bin', 'bar'), 'bar')
+        os.symlink('foo', os.path.join(target, 'bin', 'baz'))
+        pkgpanda.util.write_json(os.path.join(target, 'pkginfo.json'), {})
+
+    repository.add(fetcher, 'foo--1')
+    repository.add(fetcher, 'foo--2')
+    tmpdir.join('repo', 'legacy--1').ensure(dir=True)
+    assert repository.integrity_check() == {'foo--1': [], 'foo--2': [], 'legacy--1': None}
+
+    bin_dir = tmpdir.join('repo', 'foo--1', 'bin')
+    bin_dir.join('foo').remove()
+    bin_dir.join('baz').remove()
+    bin_dir.join('baz').mksymlinkto('bar')
+    # Same size, different contents, same mtime.
+    bar_stat = os.stat(str(bin_dir.join('bar')))
+    bin_dir.join('bar').write('BAR')
+    os.utime(str(bin_dir.join('bar')), ns=(bar_stat.st_atime_ns, bar_stat.st_mtime_ns))
+
+    expected = ['bin/foo: missing', 'bin/baz: symlink changed from foo to bar']
+    assert repository.integrity_check(['foo--1']) == {'foo--1': expected}
+    assert repository.integrity_check(['foo--1'], full=True) == {
+        'foo--1': ['bin/bar: contents changed'] + expected}
+
+    with pytest.raises(pkgpanda.exceptions.PackageNotFound):
+        repository.integrity_check(['missing--1'])
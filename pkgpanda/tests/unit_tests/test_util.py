@@ -1,8 +1,14 @@
+import hashlib
+import os
+import pwd
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
 import pytest
 
 import pkgpanda.util
 from pkgpanda import UserManagement
-from pkgpanda.exceptions import ValidationError
+from pkgpanda.exceptions import FetchError, ValidationError
 
 
 def test_variant_variations():
@@ -50,3 +56,263 @@ def test_validate_group():
 
     with pytest.raises(ValidationError):
         UserManagement.validate_group('group-should-not-exist')
+
+
+def test_ensure_users_exist():
+    sysusers = UserManagement(manage_users=True, add_users=False)
+    sysusers.add_user('dcos_should_not_exist', None)
+    sysusers.add_user('dcos_should_not_exist_either', None)
+    with pytest.raises(ValidationError) as excinfo:
+        sysusers.ensure_users_exist()
+    assert 'dcos_should_not_exist, dcos_should_not_exist_either' in str(excinfo.value)
+
+    # Users which aren't managed are only validated.
+    sysusers = UserManagement(manage_users=False, add_users=False)
+    sysusers.add_user('dcos_should_not_exist', None)
+    sysusers.ensure_users_exist()
+    with pytest.raises(AssertionError):
+        sysusers.add_user('dcos_too_late', None)
+
+
+def test_ensure_users_exist_not_enumerable(monkeypatch):
+    # NSS sources like LDAP usually don't enumerate their users.
+    ldap_user = pwd.struct_passwd(('dcos_ldap', 'x', 1234, 1234, '', '/', '/sbin/nologin'))
+
+    def getpwnam(name):
+        if name == 'dcos_ldap':
+            return ldap_user
+        raise KeyError(name)
+
+    monkeypatch.setattr(pwd, 'getpwall', lambda: [])
+    monkeypatch.setattr(pwd, 'getpwnam', getpwnam)
+    sysusers = UserManagement(manage_users=True, add_users=False)
+    sysusers.add_user('dcos_ldap', None)
+    sysusers.ensure_users_exist()
+    assert sysusers.get_uid('dcos_ldap') == 1234
+
+
+def test_chown_tree(tmpdir):
+    tmpdir.ensure("state", "a", "b", "file")
+    os.symlink("/nonexistent", str(tmpdir.join("state", "a", "link")))
+    # Only the owner changes, which anyone may set to themselves.
+    pkgpanda.util.chown_tree(str(tmpdir.join("state")), os.getuid())
+    assert os.lstat(str(tmpdir.join("state", "a", "link"))).st_uid == os.getuid()
+
+
+def test_link_or_copy_concurrent(tmpdir):
+    src = tmpdir.join("src")
+    src.write("package")
+    dest = str(tmpdir.join("dest"))
+    errors = []
+
+    def link():
+        try:
+            for _ in range(200):
+                pkgpanda.util.link_or_copy(str(src), dest)
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=link) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert os.path.samefile(str(src), dest)
+    assert sorted(tmpdir.listdir()) == [tmpdir.join("dest"), src]
+
+
+def test_download_extract(tmpdir):
+    tarball = os.path.abspath("../resources/remote_repo/packages/mesos/mesos--0.22.0.tar.xz")
+    target = str(tmpdir.join("mesos"))
+
+    sha1 = pkgpanda.util.download_extract("file://" + tarball, target, str(tmpdir))
+    assert sha1 == pkgpanda.util.sha1(tarball)
+    pkgpanda.util.expect_fs(target, ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"])
+
+    # A tarball which doesn't match the expected sha1 is removed after extraction.
+    bad_target = str(tmpdir.join("bad"))
+    with pytest.raises(FetchError):
+        pkgpanda.util.download_extract("file://" + tarball, bad_target, str(tmpdir), sha1='0' * 40)
+    assert not os.path.exists(bad_target)
+
+    # Relative file urls are relative to the work dir.
+    relative_target = str(tmpdir.join("relative"))
+    pkgpanda.util.download_extract(
+        "file://remote_repo/packages/mesos/mesos--0.22.0.tar.xz",
+        relative_target,
+        os.path.abspath("../resources"))
+    assert os.path.exists(relative_target + "/pkginfo.json")
+
+
+@pytest.mark.parametrize('codec', ['xz', 'zstd', 'gzip', 'none'])
+def test_make_tar_codecs(tmpdir, codec):
+    src = tmpdir.join("src")
+    src.ensure("bin", "mesos").write("mesos")
+    tarball = str(tmpdir.join("pkg.tar.xz"))
+
+    try:
+        assert pkgpanda.util.make_tar(tarball, str(src), codec) == codec
+    except ValidationError:
+        pytest.skip("No {} compressor installed".format(codec))
+    assert pkgpanda.util.tarball_codec(tarball).name == codec
+
+    # Both ways of extracting detect the codec.
+    pkgpanda.util.extract_tarball(tarball, str(tmpdir.join("extracted")))
+    assert tmpdir.join("extracted", "bin", "mesos").read() == "mesos"
+    with open(tarball, 'rb') as f:
+        pkgpanda.util.extract_stream(iter(lambda: f.read(3), b''), str(tmpdir.join("streamed")))
+    assert tmpdir.join("streamed", "bin", "mesos").read() == "mesos"
+
+
+def test_get_codec(monkeypatch):
+    assert pkgpanda.util.get_codec().name == 'xz'
+    monkeypatch.setenv('PKGPANDA_COMPRESSION', 'gzip')
+    assert pkgpanda.util.get_codec().name == 'gzip'
+    assert pkgpanda.util.get_codec('none').name == 'none'
+    with pytest.raises(ValidationError):
+        pkgpanda.util.get_codec('lzma')
+
+
+@pytest.mark.parametrize('use_scandir', [True, False])
+def test_rewrite_symlinks(tmpdir, monkeypatch, use_scandir):
+    if not use_scandir:
+        monkeypatch.setattr(pkgpanda.util, 'scandir', None)
+    root = str(tmpdir.join("root"))
+    for i in range(3):
+        package = tmpdir.join("root", "packages", "pkg{}".format(i), "bin").ensure(dir=True)
+        os.symlink(root + "/packages/pkg{}/lib".format(i), str(package.join("lib")))
+        os.symlink("/usr/bin/env", str(package.join("env")))
+    os.symlink(root + "/packages", str(tmpdir.join("root", "packages-link")))
+
+    pkgpanda.util.rewrite_symlinks(root, root, "/opt/mesosphere", jobs=2)
+
+    for i in range(3):
+        bin_dir = tmpdir.join("root", "packages", "pkg{}".format(i), "bin")
+        assert os.readlink(str(bin_dir.join("lib"))) == "/opt/mesosphere/packages/pkg{}/lib".format(i)
+        # Symlinks outside of the old prefix are left alone.
+        assert os.readlink(str(bin_dir.join("env"))) == "/usr/bin/env"
+    assert os.readlink(str(tmpdir.join("root", "packages-link"))) == "/opt/mesosphere/packages"
+
+
+class RangeServer(HTTPServer):
+    """Serve `content` with an ETag, honouring Range / If-Range.
+
+    The first `failures` responses are cut off half way through."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RangeHandler)
+        self.content = b'0123456789' * 1000
+        self.etag = '"1"'
+        self.failures = 0
+        self.requests = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/file'.format(self.server_address[1])
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):  # noqa: N802
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.path != '/file':
+            self.send_error(404)
+            return
+
+        start = 0
+        if 'Range' in self.headers and self.headers.get('If-Range') == server.etag:
+            start = int(self.headers['Range'][len('bytes='):-1])
+        body = server.content[start:]
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(body)))
+        if start:
+            end = len(server.content) - 1
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(server.content)))
+        self.end_headers()
+        if server.failures:
+            server.failures -= 1
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def range_server():
+    server = RangeServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def test_download_resumes(tmpdir, range_server):
+    out = str(tmpdir.join('file'))
+    range_server.failures = 2
+    sha1 = pkgpanda.util.download_atomic(out, range_server.url, str(tmpdir), backoff=0, chunk_size=500)
+
+    assert sha1 == hashlib.sha1(range_server.content).hexdigest()
+    with open(out, 'rb') as f:
+        assert f.read() == range_server.content
+    assert os.listdir(str(tmpdir)) == ['file']
+
+    # Each retry only asked for what was still missing.
+    assert 'Range' not in range_server.requests[0]
+    assert range_server.requests[1]['Range'] == 'bytes=5000-'
+    assert range_server.requests[2]['Range'] == 'bytes=7500-'
+
+
+def test_iter_url_resumes(range_server):
+    range_server.failures = 2
+    chunks = pkgpanda.util._iter_url(range_server.url, '/', chunk_size=500, backoff=0)
+    assert b''.join(chunks) == range_server.content
+    assert 'Range' not in range_server.requests[0]
+    assert range_server.requests[1]['Range'] == 'bytes=5000-'
+    assert range_server.requests[2]['Range'] == 'bytes=7500-'
+
+    # What has been yielded can't be fetched again, so a file which changed
+    # part way through is an error.
+    range_server.requests.clear()
+    range_server.failures = 1
+    chunks = pkgpanda.util._iter_url(range_server.url, '/', chunk_size=500, backoff=0)
+    assert next(chunks) == range_server.content[:500]
+    range_server.etag = '"2"'
+    with pytest.raises(Exception, match="can't continue the download"):
+        list(chunks)
+    assert len(range_server.requests) == 2
+
+
+def test_download_keeps_partial(tmpdir, range_server):
+    out = str(tmpdir.join('file'))
+    range_server.failures = 1
+    with pytest.raises(FetchError):
+        pkgpanda.util.download_atomic(out, range_server.url, str(tmpdir), retries=0, chunk_size=500)
+    assert os.path.getsize(out + '.tmp') == 5000
+    assert os.path.exists(out + '.tmp.state')
+
+    # The next call continues the download, unless the file has changed since.
+    range_server.etag = '"2"'
+    range_server.content = b'abcdefghij' * 1000
+    pkgpanda.util.download_atomic(out, range_server.url, str(tmpdir), retries=0)
+    with open(out, 'rb') as f:
+        assert f.read() == range_server.content
+    assert os.listdir(str(tmpdir)) == ['file']
+
+
+def test_download_errors(tmpdir, range_server):
+    out = str(tmpdir.join('file'))
+    with pytest.raises(FetchError):
+        pkgpanda.util.download_atomic(out, range_server.url, str(tmpdir), expected_sha1='0' * 40)
+    assert os.listdir(str(tmpdir)) == []
+
+    # Client errors aren't retried.
+    with pytest.raises(FetchError):
+        pkgpanda.util.download_atomic(out, range_server.url + '-missing', str(tmpdir), backoff=0)
+    assert len(range_server.requests) == 2
+    assert os.listdir(str(tmpdir)) == []
@@ -3,15 +3,30 @@ import json
 import os
 import re
 import shutil
+import stat
 import subprocess
+import tempfile
+import time
+from concurrent.futures import as_completed, FIRST_COMPLETED, ThreadPoolExecutor, wait
 from itertools import chain
 from shutil import rmtree, which
 from subprocess import check_call
 
 import requests
 
+from pkgpanda.constants import (COMPRESSION_ENV, DEFAULT_COMPRESSION, DOWNLOAD_BACKOFF, DOWNLOAD_CHUNK_SIZE,
+                                DOWNLOAD_RETRIES, DOWNLOAD_TIMEOUT, REWRITE_SYMLINKS_JOBS)
 from pkgpanda.exceptions import FetchError, ValidationError
 
+try:
+    from os import scandir
+except ImportError:
+    # Python 3.4, use the backport if it is installed.
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 def variant_str(variant):
     """Return a string representation of variant."""
@@ -34,10 +49,102 @@ def variant_prefix(variant):
     return variant + '.'
 
 
-def download(out_filename, url, work_dir):
+class _IncompleteDownload(Exception):
+    pass
+
+
+def _load_download_state(state_filename):
+    try:
+        return if_exists(load_json, state_filename)
+    except ValueError:
+        return None
+
+
+def _is_retryable(ex):
+    if isinstance(ex, requests.exceptions.HTTPError):
+        return ex.response is not None and ex.response.status_code >= 500
+    return isinstance(ex, (
+        _IncompleteDownload,
+        requests.exceptions.ChunkedEncodingError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout))
+
+
+def _download_http(out_filename, url, state_filename, chunk_size):
+    """Download url to out_filename, continuing a previous partial download if possible.
+
+    A partial download is only continued if state_filename records a validator
+    (ETag or Last-Modified) for url. The validator is sent as If-Range, so if
+    the file changed on the server it is sent in full and the download starts
+    over.
+    """
+    state = _load_download_state(state_filename)
+    offset = 0
+    headers = {}
+    if state is not None and state.get('url') == url and os.path.exists(out_filename):
+        offset = os.path.getsize(out_filename)
+        validator = state.get('etag') or state.get('last_modified')
+        if offset and validator:
+            headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator}
+        else:
+            offset = 0
+
+    r = requests.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+    if r.status_code == 416:
+        # The partial download may already be the whole file.
+        if r.headers.get('Content-Range') == 'bytes */{}'.format(offset):
+            r.close()
+            return
+        r.close()
+        offset = 0
+        r = requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    if r.status_code == 301:
+        raise Exception("got a 301")
+    r.raise_for_status()
+
+    if r.status_code == 206 and r.headers.get('Content-Range', '').startswith('bytes {}-'.format(offset)):
+        mode = 'ab'
+    else:
+        offset = 0
+        mode = 'wb'
+        state = {'url': url, 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+        if state['etag'] or state['last_modified']:
+            write_json(state_filename, state)
+        elif os.path.exists(state_filename):
+            os.remove(state_filename)
+
+    expected_size = None
+    if 'Content-Length' in r.headers:
+        expected_size = offset + int(r.headers['Content-Length'])
+
+    with open(out_filename, mode) as f:
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            f.write(chunk)
+        size = f.tell()
+    if expected_size is not None and size != expected_size:
+        raise _IncompleteDownload("got {} of {} bytes".format(size, expected_size))
+
+
+def download(out_filename, url, work_dir, expected_sha1=None, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF,
+             chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Download url to out_filename.
+
+    file:// urls are copied, relative ones being relative to work_dir.
+
+    Failed requests are retried up to `retries` times, waiting `backoff`
+    seconds before the first retry and doubling the wait each time. When the
+    server supports it, retries (and later calls after a failure) continue
+    where the last attempt stopped rather than starting over: the partial file
+    is kept along with `<out_filename>.state`, which records the ETag /
+    Last-Modified of the file being downloaded.
+
+    If expected_sha1 is given, the completed file must match it. Returns the
+    SHA-1 of the downloaded file.
+    """
     assert os.path.isabs(out_filename)
     assert os.path.isabs(work_dir)
     work_dir = work_dir.rstrip('/')
+    state_filename = out_filename + '.state'
 
     # Strip off whitespace to make it so scheme matching doesn't fail because
     # of simple user whitespace.
@@ -51,41 +158,120 @@ def download(out_filename, url, work_dir):
                 src_filename = work_dir + '/' + src_filename
             shutil.copyfile(src_filename, out_filename)
         else:
-            # Download the file.
-            with open(out_filename, "w+b") as f:
-                r = requests.get(url, stream=True)
-                if r.status_code == 301:
-                    raise Exception("got a 301")
-                r.raise_for_status()
-                for chunk in r.iter_content(chunk_size=4096):
-                    f.write(chunk)
+            attempt = 0
+            while True:
+                try:
+                    _download_http(out_filename, url, state_filename, chunk_size)
+                    break
+                except Exception as ex:
+                    if attempt >= retries or not _is_retryable(ex):
+                        raise
+                    delay = backoff * 2 ** attempt
+                    print("Download of {} failed ({}), retrying in {}s".format(url, ex, delay))
+                    time.sleep(delay)
+                    attempt += 1
+
+        # Checksum the whole file, a resumed download could have been stitched
+        # together from two different versions of it.
+        file_sha1 = sha1(out_filename)
+        if expected_sha1 is not None and file_sha1 != expected_sha1:
+            raise ValidationError("sha1 of {} is {}, expected {}".format(url, file_sha1, expected_sha1))
     except Exception as fetch_exception:
+        # Keep partial downloads which can be continued by the next call.
+        resumable = _is_retryable(fetch_exception) and os.path.exists(state_filename)
         rm_passed = False
 
         # try / except so if remove fails we don't get an exception during an exception.
         # Sets rm_passed to true so if this fails we can include a special error message in the
         # FetchError
-        try:
-            os.remove(out_filename)
-            rm_passed = True
-        except Exception:
-            pass
+        if not resumable:
+            try:
+                os.remove(out_filename)
+                if os.path.exists(state_filename):
+                    os.remove(state_filename)
+                rm_passed = True
+            except Exception:
+                pass
 
         raise FetchError(url, out_filename, fetch_exception, rm_passed) from fetch_exception
 
+    if os.path.exists(state_filename):
+        os.remove(state_filename)
+    return file_sha1
+
+
+def download_atomic(out_filename, url, work_dir, **kwargs):
+    """Download url to out_filename via `<out_filename>.tmp`, see download.
 
-def download_atomic(out_filename, url, work_dir):
+    out_filename only ever exists once the download is complete."""
     assert os.path.isabs(out_filename)
     tmp_filename = out_filename + '.tmp'
+    file_sha1 = download(tmp_filename, url, work_dir, **kwargs)
+    os.rename(tmp_filename, out_filename)
+    return file_sha1
+
+
+class Codec:
+    """A compression format for tarballs.
+
+    compressors and decompressors are the commands tar can run to (de)compress
+    with this codec, best first. The first one which is installed is used,
+    falling back to tar_flag (tar's own support for the format) if none are.
+    """
+
+    def __init__(self, name, magic, tar_flag, compressors, decompressors):
+        self.name = name
+        self.magic = magic
+        self.tar_flag = tar_flag
+        self.compressors = compressors
+        self.decompressors = decompressors
+
+    def tar_args(self, compress):
+        """Return the arguments which make tar (de)compress with this codec."""
+        for program in self.compressors if compress else self.decompressors:
+            if which(program.split()[0]):
+                return ['--use-compress-program=' + program]
+        if self.tar_flag is None:
+            raise ValidationError("Compressing tarballs with {} requires one of: {}".format(
+                self.name, ', '.join(self.compressors if compress else self.decompressors)))
+        return [self.tar_flag]
+
+
+# The multithreaded commands come first. tar adds `-d` to decompress.
+CODECS = {
+    'xz': Codec('xz', b'\xfd7zXZ\x00', '--xz', ['pxz', 'xz -T0'], ['pixz', 'xz -T0']),
+    'zstd': Codec('zstd', b'\x28\xb5\x2f\xfd', None, ['zstd -T0 -12', 'pzstd -12'], ['zstd', 'pzstd']),
+    'gzip': Codec('gzip', b'\x1f\x8b', '--gzip', ['pigz'], ['pigz']),
+    'bzip2': Codec('bzip2', b'BZh', '--bzip2', ['lbzip2', 'pbzip2'], ['lbzip2', 'pbzip2']),
+    'none': Codec('none', b'', '--no-auto-compress', [], []),
+}
+
+# Enough of the start of a tarball to identify the codec it was compressed with.
+CODEC_MAGIC_SIZE = max(len(codec.magic) for codec in CODECS.values())
+
+
+def get_codec(name=None):
+    """Return the codec called name, by default the one set by PKGPANDA_COMPRESSION."""
+    name = name or os.environ.get(COMPRESSION_ENV) or DEFAULT_COMPRESSION
     try:
-        download(tmp_filename, url, work_dir)
-        os.rename(tmp_filename, out_filename)
-    except FetchError:
-        try:
-            os.remove(tmp_filename)
-        except:
-            pass
-        raise
+        return CODECS[name]
+    except KeyError:
+        raise ValidationError("Unknown compression {}, must be one of: {}".format(
+            name, ', '.join(sorted(CODECS))))
+
+
+def detect_codec(header):
+    """Return the codec of the tarball whose first bytes are header."""
+    for codec in CODECS.values():
+        if codec.magic and header.startswith(codec.magic):
+            return codec
+    return CODECS['none']
+
+
+def tarball_codec(path):
+    """Return the codec of the tarball at path."""
+    with open(path, 'rb') as f:
+        return detect_codec(f.read(CODEC_MAGIC_SIZE))
 
 
 def extract_tarball(path, target):
@@ -99,13 +285,226 @@ def extract_tarball(path, target):
     try:
         assert os.path.exists(path), "Path doesn't exist but should: {}".format(path)
         check_call(['mkdir', '-p', target])
-        check_call(['tar', '-xf', path, '-C', target])
+        check_call(['tar', '-x'] + tarball_codec(path).tar_args(compress=False) + ['-f', path, '-C', target])
     except:
         # If there are errors, we can't really cope since we are already in an error state.
         rmtree(target, ignore_errors=True)
         raise
 
 
+def _iter_url(url, work_dir, chunk_size=DOWNLOAD_CHUNK_SIZE, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF):
+    """Yield the contents of url as chunks of bytes.
+
+    Handles file:// urls, relative ones being relative to work_dir, as well as
+    anything requests can fetch.
+
+    Failed requests are retried like in download. Chunks which have been
+    yielded can't be taken back, so a retry part way through asks for the rest
+    of the file with Range / If-Range and fails if the server can't send just
+    that (it doesn't support ranges or the file has changed since).
+    """
+    if url.startswith('file://'):
+        src_filename = url[len('file://'):]
+        if not os.path.isabs(src_filename):
+            src_filename = work_dir + '/' + src_filename
+        with open(src_filename, 'rb') as f:
+            yield from iter(lambda: f.read(chunk_size), b'')
+        return
+
+    offset = 0
+    validator = None
+    expected_size = None
+    attempt = 0
+    while True:
+        headers = {}
+        if offset:
+            headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator}
+        try:
+            r = requests.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+            if r.status_code == 301:
+                raise Exception("got a 301")
+            r.raise_for_status()
+            if offset:
+                content_range = r.headers.get('Content-Range', '')
+                if r.status_code != 206 or not content_range.startswith('bytes {}-'.format(offset)):
+                    r.close()
+                    raise Exception("can't continue the download of {} from byte {}".format(url, offset))
+            else:
+                validator = r.headers.get('ETag') or r.headers.get('Last-Modified')
+                if 'Content-Length' in r.headers:
+                    expected_size = int(r.headers['Content-Length'])
+
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                offset += len(chunk)
+                yield chunk
+            if expected_size is not None and offset != expected_size:
+                raise _IncompleteDownload("got {} of {} bytes".format(offset, expected_size))
+            return
+        except Exception as ex:
+            # Without a validator there is no telling whether the rest of the
+            # file would belong with what has already been yielded.
+            if attempt >= retries or not _is_retryable(ex) or (offset and not validator):
+                raise
+            delay = backoff * 2 ** attempt
+            print("Download of {} failed ({}), retrying in {}s".format(url, ex, delay))
+            time.sleep(delay)
+            attempt += 1
+
+
+def extract_stream(chunks, target, expected_sha1=None):
+    """Extract the tarball made up of the byte strings in chunks into target.
+
+    The chunks are piped into tar as they arrive so decompression and
+    extraction overlap with reading the tarball, and the tarball never needs
+    to be written to disk. The SHA-1 of the (compressed) tarball is calculated
+    along the way and returned. If expected_sha1 is given and doesn't match,
+    ValidationError is raised.
+
+    The caller is responsible for cleaning up target on errors.
+    """
+    hasher = hashlib.sha1()
+    chunks = iter(chunks)
+
+    # tar can't detect the compression of a pipe, so look at the magic
+    # number at the start of the stream.
+    header = b''
+    for chunk in chunks:
+        header += chunk
+        if len(header) >= CODEC_MAGIC_SIZE:
+            break
+    hasher.update(header)
+
+    check_call(['mkdir', '-p', target])
+    tar = subprocess.Popen(
+        ['tar', '-x'] + detect_codec(header).tar_args(compress=False) + ['-f', '-', '-C', target],
+        stdin=subprocess.PIPE)
+    try:
+        tar.stdin.write(header)
+        for chunk in chunks:
+            hasher.update(chunk)
+            tar.stdin.write(chunk)
+    finally:
+        # Closing stdin lets tar finish, or stop if reading failed part way.
+        try:
+            tar.stdin.close()
+        except BrokenPipeError:
+            pass
+        tar.wait()
+    if tar.returncode != 0:
+        raise subprocess.CalledProcessError(tar.returncode, tar.args)
+
+    sha1 = hasher.hexdigest()
+    if expected_sha1 is not None and sha1 != expected_sha1:
+        raise ValidationError("sha1 of tarball {} doesn't match the expected sha1 {}".format(sha1, expected_sha1))
+    return sha1
+
+
+def download_extract(url, target, work_dir, sha1=None, tee=None, **kwargs):
+    """Download the tarball at url and extract it into target.
+
+    The tarball is streamed straight into tar (see extract_stream), for both
+    remote and file:// urls. If sha1 is given the tarball must match it.
+    tee optionally wraps the iterator of downloaded chunks, for instance to
+    also write them to a PackageCache. kwargs (retries, backoff, chunk_size)
+    are passed on to _iter_url. Returns the SHA-1 of the tarball.
+
+    If there are any errors, delete the folder being extracted to.
+    """
+    assert os.path.isabs(target)
+    assert os.path.isabs(work_dir)
+    work_dir = work_dir.rstrip('/')
+
+    # Strip off whitespace to make it so scheme matching doesn't fail because
+    # of simple user whitespace.
+    url = url.strip()
+
+    try:
+        chunks = _iter_url(url, work_dir, **kwargs)
+        if tee is not None:
+            chunks = tee(chunks)
+        return extract_stream(chunks, target, sha1)
+    except Exception as fetch_exception:
+        rm_passed = False
+
+        # try / except so if remove fails we don't get an exception during an exception.
+        try:
+            shutil.rmtree(target)
+            rm_passed = True
+        except FileNotFoundError:
+            rm_passed = True
+        except Exception:
+            pass
+
+        raise FetchError(url, target, fetch_exception, rm_passed) from fetch_exception
+
+
+def run_concurrently(fn, items, jobs):
+    """Call fn(item) for every item, running at most `jobs` calls at once.
+
+    Yields (item, result, seconds) tuples in the order the calls complete. If a
+    call raises, calls which haven't started yet are cancelled and the exception
+    is re-raised once the calls already running have finished.
+    """
+    def timed(item):
+        start = time.monotonic()
+        result = fn(item)
+        return result, time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(timed, item): item for item in items}
+        try:
+            for future in as_completed(futures):
+                result, seconds = future.result()
+                yield futures[future], result, seconds
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def link_or_copy(src, dest):
+    """Atomically make dest a hardlink of src, or a copy of it if they are on different filesystems."""
+    # The temporary name is unique to this call, several threads may be making
+    # the same dest. mkstemp only reserves it, a hardlink can't replace a file.
+    fd, tmp_dest = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(dest) or '.')
+    os.close(fd)
+    try:
+        try:
+            os.remove(tmp_dest)
+            os.link(src, tmp_dest)
+        except OSError:
+            shutil.copyfile(src, tmp_dest)
+            os.chmod(tmp_dest, 0o644)
+        os.rename(tmp_dest, dest)
+    finally:
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
+
+
+def disk_usage(path):
+    """Return the bytes allocated to the files under path, counting hardlinked files once."""
+    seen = set()
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in chain(dirs, files):
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def chown_tree(path, uid):
+    """Make uid the owner of path and of everything under it, like `chown -R uid path`.
+
+    Symlinks are changed themselves rather than what they point to."""
+    os.lchown(path, uid, -1)
+    for root, dirs, files in os.walk(path):
+        for name in chain(dirs, files):
+            os.lchown(os.path.join(root, name), uid, -1)
+
+
 def load_json(filename):
     try:
         with open(filename) as f:
@@ -146,7 +545,7 @@ def sha1(filename):
 
     with open(filename, 'rb') as fh:
         while 1:
-            buf = fh.read(4096)
+            buf = fh.read(DOWNLOAD_CHUNK_SIZE)
             if not buf:
                 break
             hasher.update(buf)
@@ -172,31 +571,70 @@ def expect_fs(folder, contents):
         raise ValueError("Invalid type {0} passed to expect_fs".format(type(contents)))
 
 
-def make_tar(result_filename, change_folder):
-    tar_cmd = ["tar", "--numeric-owner", "--owner=0", "--group=0"]
-    if which("pxz"):
-        tar_cmd += ["--use-compress-program=pxz", "-cf"]
-    else:
-        tar_cmd += ["-cJf"]
-    tar_cmd += [result_filename, "-C", change_folder, "."]
+def make_tar(result_filename, change_folder, codec=None):
+    """Make a tarball of the contents of change_folder compressed with codec, see get_codec.
+
+    Returns the name of the codec used."""
+    codec = get_codec(codec)
+    tar_cmd = ["tar", "--numeric-owner", "--owner=0", "--group=0"] + codec.tar_args(compress=True)
+    tar_cmd += ["-cf", result_filename, "-C", change_folder, "."]
     check_call(tar_cmd)
+    return codec.name
+
 
+def _scan_dir(path):
+    """Return the paths of the symlinks and of the (not symlinked) directories in path.
 
-def rewrite_symlinks(root, old_prefix, new_prefix):
-    # Find the symlinks and rewrite them from old_prefix to new_prefix
-    # All symlinks not beginning with old_prefix are ignored because
-    # packages may contain arbitrary symlinks.
-    for root_dir, dirs, files in os.walk(root):
-        for name in chain(files, dirs):
-            full_path = os.path.join(root_dir, name)
-            if os.path.islink(full_path):
-                # Rewrite old_prefix to new_prefix if present.
-                target = os.readlink(full_path)
-                if target.startswith(old_prefix):
-                    new_target = os.path.join(new_prefix, target[len(old_prefix) + 1:].lstrip('/'))
-                    # Remove the old link and write a new one.
-                    os.remove(full_path)
-                    os.symlink(new_target, full_path)
+    Uses the file types readdir returns where possible rather than a stat per entry."""
+    symlinks = []
+    dirs = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_symlink():
+                symlinks.append(entry.path)
+            elif entry.is_dir():
+                dirs.append(entry.path)
+    else:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            mode = os.lstat(full_path).st_mode
+            if stat.S_ISLNK(mode):
+                symlinks.append(full_path)
+            elif stat.S_ISDIR(mode):
+                dirs.append(full_path)
+    return symlinks, dirs
+
+
+def rewrite_symlinks(root, old_prefix, new_prefix, jobs=REWRITE_SYMLINKS_JOBS):
+    """Rewrite the symlinks under root pointing into old_prefix to point into new_prefix.
+
+    All symlinks not beginning with old_prefix are ignored because packages may
+    contain arbitrary symlinks. Directories are scanned by `jobs` threads, each
+    directory queueing its subdirectories as it is scanned."""
+    def rewrite_dir(path):
+        symlinks, dirs = _scan_dir(path)
+        for full_path in symlinks:
+            # Rewrite old_prefix to new_prefix if present.
+            target = os.readlink(full_path)
+            if target.startswith(old_prefix):
+                new_target = os.path.join(new_prefix, target[len(old_prefix) + 1:].lstrip('/'))
+                # Remove the old link and write a new one.
+                os.remove(full_path)
+                os.symlink(new_target, full_path)
+        return dirs
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        pending = {executor.submit(rewrite_dir, root)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for path in future.result():
+                        pending.add(executor.submit(rewrite_dir, path))
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
 
 
 def check_forbidden_services(path, services):
@@ -258,6 +258,21 @@ def get_package_artifact(package_id_str):
         'local_path': 'packages/cache/' + package_filename}
 
 
+def get_package_delta_artifacts(package_id_str):
+    """Return the artifacts of the deltas to package_id_str made with `mkpanda delta`, see pkgpanda.delta."""
+    package_id = pkgpanda.PackageId(package_id_str)
+    package_dir = 'packages/{}'.format(package_id.name)
+    local_dir = 'packages/cache/' + package_dir
+    prefix = package_id_str + '.from-'
+    artifacts = []
+    for filename in sorted(os.listdir(local_dir)) if os.path.isdir(local_dir) else []:
+        if filename.startswith(prefix) and filename.endswith('.delta.tar.xz'):
+            artifacts.append({
+                'reproducible_path': package_dir + '/' + filename,
+                'local_path': local_dir + '/' + filename})
+    return artifacts
+
+
 def get_gen_package_artifact(package_id_str):
     package_id = pkgpanda.PackageId(package_id_str)
     package_filename = 'packages/{}/{}.tar.xz'.format(package_id.name, package_id_str)
@@ -327,6 +342,8 @@ def make_stable_artifacts(cache_repository_url):
             return
         metadata['packages'].add(package_id)
         add_file(get_package_artifact(package_id))
+        for artifact in get_package_delta_artifacts(package_id):
+            add_file(artifact)
 
     # Add the bootstrap, active.json, packages as reproducible_path artifacts
     # Add the <variant>.bootstrap.latest as a channel_path
@@ -584,6 +601,33 @@ def get_storage_provider_factory(kind):
     return module.factories[name]
 
 
+def make_storage_provider(options: dict):
+    """Construct the storage provider described by a storage config entry.
+
+    options has the provider `kind`, optionally `read_only`, and the arguments
+    of the provider."""
+    options = copy.deepcopy(options)
+    if 'kind' not in options:
+        raise ConfigError("Must set the config kind for storage")
+    factory = get_storage_provider_factory(options['kind'])
+
+    # Remove meta parameters
+    del options['kind']
+    read_only = options.get('read_only', False)
+    if 'read_only' in options:
+        del options['read_only']
+
+    # Construct the storage, making sure all remaining configuration options
+    # are used.
+    storage = call_matching_arguments(factory, options)
+
+    # If read only wrap in the read_only proxy
+    if read_only:
+        storage = release.storage.ReadOnlyProxy(storage)
+
+    return storage
+
+
 def apply_storage_commands(storage_providers: dict, storage_commands: dict) -> None:
     assert storage_commands.keys() == {'stage1', 'stage2'}
 
@@ -613,26 +657,9 @@ class ReleaseManager():
     def _setup_storage(self, storage_config):
         self.__storage_providers = {}
         for name, options in storage_config.items():
-            options = copy.deepcopy(options)
             if 'kind' not in options:
                 raise ConfigError("Must set the config kind for storage {}".format(name))
-            factory = get_storage_provider_factory(options['kind'])
-
-            # Remove meta parameters
-            del options['kind']
-            read_only = options.get('read_only', False)
-            if 'read_only' in options:
-                del options['read_only']
-
-            # Construct the storage, making sure all remaining configuration options
-            # are used.
-            storage = call_matching_arguments(factory, options)
-
-            # If read only wrap in the read_only proxy
-            if read_only:
-                storage = release.storage.ReadOnlyProxy(storage)
-
-            self.__storage_providers[name] = storage
+            self.__storage_providers[name] = make_storage_provider(options)
 
     def __init__(self, config, noop):
         self._setup_storage(config.get('storage', dict()))
@@ -105,6 +105,9 @@ class ReadOnlyProxy(AbstractStorageProvider):
                content_type=None):
         raise UnsupportedOperation("upload on read-only storage")
 
+    def download_inner(self, path, local_path):
+        return self._storage_provider.download_inner(path, local_path)
+
     def download(self, path, local_path):
         return self._storage_provider.download(path, local_path)
 
@@ -118,10 +121,11 @@ class ReadOnlyProxy(AbstractStorageProvider):
         raise UnsupportedOperation("remove_recursive on read-only storage")
 
     def list_recursive(self, folder):
-        raise UnsupportedOperation()
+        return self._storage_provider.list_recursive(folder)
 
+    @property
     def url(self):
-        return self._storage_provider.url(self)
+        return self._storage_provider.url
 
     @property
     def read_only(self):
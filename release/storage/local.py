@@ -1,5 +1,6 @@
 import os.path
 import subprocess
+import uuid
 
 from release.storage import AbstractStorageProvider
 
@@ -26,10 +27,20 @@ class LocalStorageProvider(AbstractStorageProvider):
     def download_inner(self, path, local_path):
         subprocess.check_call(['cp', self.__full_path(path), local_path])
 
-    # Copy between fully qualified paths
+    # Copy between fully qualified paths. The copy is renamed into place so
+    # readers never see a partially written file.
     def __copy(self, full_source_path, full_destination_path):
         subprocess.check_call(['mkdir', '-p', os.path.dirname(full_destination_path)])
-        subprocess.check_call(['cp', full_source_path, full_destination_path])
+        tmp_path = self.__tmp_path(full_destination_path)
+        try:
+            subprocess.check_call(['cp', full_source_path, tmp_path])
+            os.rename(tmp_path, full_destination_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def __tmp_path(self, full_path):
+        return '{}.tmp-{}'.format(full_path, uuid.uuid4().hex)
 
     def copy(self, source_path, destination_path):
         self.__copy(self.__full_path(source_path), self.__full_path(destination_path))
@@ -45,8 +56,14 @@ class LocalStorageProvider(AbstractStorageProvider):
             self.__copy(local_path, destination_full_path)
         else:
             assert isinstance(blob, bytes)
-            with open(destination_full_path, 'wb') as f:
-                f.write(blob)
+            tmp_path = self.__tmp_path(destination_full_path)
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(blob)
+                os.rename(tmp_path, destination_full_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
 
     def exists(self, path):
         assert path[0] != '/'
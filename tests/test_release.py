@@ -465,6 +465,19 @@ def test_get_package_artifact(tmpdir):
     }
 
 
+def test_get_package_delta_artifacts(tmpdir):
+    with tmpdir.as_cwd():
+        assert release.get_package_delta_artifacts('foo--test') == []
+        for filename in ['foo--test.tar.xz',
+                         'foo--test.from-foo--old.delta.tar.xz',
+                         'foo--new.from-foo--test.delta.tar.xz']:
+            tmpdir.join('packages', 'cache', 'packages', 'foo', filename).write('', ensure=True)
+        assert release.get_package_delta_artifacts('foo--test') == [{
+            'reproducible_path': 'packages/foo/foo--test.from-foo--old.delta.tar.xz',
+            'local_path': 'packages/cache/packages/foo/foo--test.from-foo--old.delta.tar.xz'
+        }]
+
+
 def mock_do_build_packages(cache_repository_url):
     subprocess.check_call(['mkdir', '-p', 'packages/cache/bootstrap'])
     write_string("packages/cache/bootstrap/bootstrap_id.bootstrap.tar.xz", "bootstrap_contents")